@@ -2,23 +2,38 @@
 An object to ask questions to an Azure LLM and interrogate documents in azure AI Search.
 """
 
+from collections import deque
 from dotenv import load_dotenv
 import json
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
-from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
 from langchain_core.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceholder
-from langchain_openai import AzureChatOpenAI
+from langchain_openai import AzureOpenAIEmbeddings
 import os
+import threading
+import time
 
+from helper.cache_client import ResponseCacheClient
+from helper.catalog_client import CatalogClient
+from helper.llm_backend_client import LLMBackendClient
+from helper.memory_client import ConversationMemoryClient
+from helper.resilience_client import record_deployments
+from helper.resource_client import get_shared_resource
+from helper.result_summary_client import ResultSummaryClient
+from helper.rollup_client import RollupClient
+from helper.schema_index_client import SchemaIndexClient
+from helper.token_client import TokenClient
+from helper.trace_client import TraceCallbackHandler, TraceClient
 from template.operation_template import OperationInstruction
-from template.figure_template import FigureInstruction, FigureTemplate
+from template.figure_template import FigureAnswer, FigureInstruction, FigureTemplate
 
 load_dotenv(override=True)
 
 
-class LLMClient:
+class LLMResources:
     """
-    An object to ask questions to an Azure LLM and interrogate documents in azure AI Search.
+    The immutable objects needed by LLMClient (parsers, system prompts and the chat model).
+    They are created once per process and shared by every session.
     """
     def __init__(self) -> None:
         # OpenAI configuration
@@ -29,7 +44,20 @@ class LLMClient:
         self.instruction_template_parser = JsonOutputParser(pydantic_object=OperationInstruction)
         self.figure_instruction_template_parser = JsonOutputParser(pydantic_object=FigureInstruction)
         self.figure_template_parser = JsonOutputParser(pydantic_object=FigureTemplate)
+        self.figure_answer_parser = JsonOutputParser(pydantic_object=FigureAnswer)
         
+        # The description of the tables is generated from the catalog and the profiles of the tables.
+        # When the catalog is large, only the tables relevant to the question are described, at the end of the user message
+        # (SCHEMA_RETRIEVAL=auto by default, 1 to always retrieve the tables, 0 to always describe every table).
+        self.token_client = get_shared_resource("token_client", TokenClient)
+        catalog_client = get_shared_resource("catalog_client", CatalogClient)
+        data_description = catalog_client.get_prompt_schema()
+        schema_retrieval = os.environ.get("SCHEMA_RETRIEVAL", "auto")
+        self.schema_index_client = None
+        if schema_retrieval == "1" or (schema_retrieval == "auto" and self.token_client.count_text(data_description) > int(os.environ.get("SCHEMA_RETRIEVAL_MIN_TOKENS", "3000"))):
+            self.schema_index_client = SchemaIndexClient(catalog_client)
+            data_description = "            Les tables utiles pour répondre sont décrites à la fin du message de l'utilisateur."
+        rollup_description = RollupClient().get_prompt_description() if RollupClient.SOURCE_TABLE in catalog_client.list_table_name else ""
         self.LIST_INSTRUCTION_SYSTEM_MESSAGE = SystemMessage(f"""
         Tu es un chatbot qui génère des insights à partir de données utilisateurs. Ton but est de donner une liste d'operations à faire sur les données utilisateurs afin d'obtenir les informations pour répondre à une question utilisateur.
         Tes réponses doivent avoir la forme du json suivant :
@@ -38,35 +66,8 @@ class LLMClient:
         **Consigne importante** : Tu ne rajoute rien en dehors de ces deux champs et tu ne retourne que ces deux champs. Il ne faut pas que tu rajoutes d'autres champs.
 
         Les données à ta disposition sont les suivantes :
-            driver_ml (un dataframe qui contient les coefficients associés à chacun des drivers de coûts):
-                - driver
-                - product (valeurs possibles : Copper, Lead)
-                - country (valeurs possibles : US, China)
-                - value
-
-            historical_sales_data (un dataframe présentant l'évolution des coûts réels en fonction des produits et des fournisseurs. Ce dataframe donne aussi des prédictions de prix.):
-                - product (valeurs possibles : Copper, Lead)
-                - date
-                - year
-                - month (valeurs possibles : 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12)
-                - country (valeurs possibles : US, China)
-                - provider (valeurs possibles : provider A, provider B, provider C, provider D, provider E, prediction)
-                - price
-            
-            variation_prediction_df (un dataframe qui décompose les prédictions des prix selon plusieurs criteres. Ce dataframe ne contient que les informations sur les predictions.):
-                - product (valeurs possibles : Copper, Lead)
-                - date
-                - year
-                - month (valeurs possibles : 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12)
-                - country (valeurs possibles : US, China)
-                - delta_price (variation des prix des produits)
-                - delta_wage (part de la variation des prix dû aux salaires)
-                - delta_electrical (part de la variation des prix dû à l'énergie)
-                - delta_treatment_price (part de la variation des prix dû au traitement des produits)
-                - delta_london_metal_exchange (part de la variation des prix des produits à London Metal Exchange)
-                - delta_mechanical (part de la variation des prix dû à la mécanisation)
-                - delta_replacement (part de la variation des prix dû au remplacement du matériel par un autre)
-                - delta_other (part de la variation des prix d'étiers autres que les precedents)
+{data_description}
+{rollup_description}
         
         Ton rôle n'est pas de répondre directement à la question mais de retourner les informations pertinentes pour la prise de décision. Renvoie **TOUTES** les colonnes pertinentes.
         """)
@@ -81,53 +82,161 @@ class LLMClient:
         **Consigne importante** : Si on te demande de concaténer les valeurs de deux colonnes, fait colonne_a || " " || colonne_b.
 
         Les données à ta disposition sont les suivantes :
-            driver_ml (un dataframe qui contient les coefficients associés à chacun des drivers de coûts):
-                - driver
-                - product (valeurs possibles : Copper, Lead)
-                - country (valeurs possibles : US, China)
-                - value
-
-            historical_sales_data (un dataframe présentant l'évolution des coûts réels en fonction des produits et des fournisseurs. Ce dataframe donne aussi des prédictions de prix.):
-                - product (valeurs possibles : Copper, Lead)
-                - date
-                - year
-                - month (valeurs possibles : 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12)
-                - country (valeurs possibles : US, China)
-                - provider (valeurs possibles : provider A, provider B, provider C, provider D, provider E, prediction)
-                - price
-            
-            variation_prediction_df (un dataframe qui décompose les prédictions des prix selon plusieurs criteres. Ce dataframe ne contient que les informations sur les predictions.):
-                - product (valeurs possibles : Copper, Lead)
-                - date
-                - year
-                - month (valeurs possibles : 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12)
-                - country (valeurs possibles : US, China)
-                - delta_price (variation des prix des produits)
-                - delta_wage (part de la variation des prix dû aux salaires)
-                - delta_electrical (part de la variation des prix dû à l'énergie)
-                - delta_treatment_price (part de la variation des prix dû au traitement des produits)
-                - delta_london_metal_exchange (part de la variation des prix des produits à London Metal Exchange)
-                - delta_mechanical (part de la variation des prix dû à la mécanisation)
-                - delta_replacement (part de la variation des prix dû au remplacement du matériel par un autre)
-                - delta_other (part de la variation des prix d'étiers autres que les precedents)
+{data_description}
+{rollup_description}
         
         Ton rôle n'est pas de répondre directement à la question mais de retourner les informations pertinentes pour la prise de décision. Renvoie **TOUTES** les colonnes pertinentes.
             """)
         self.figure_example = "data/plot_figure_example_conversation.json"
 
-        self.llm = AzureChatOpenAI(
-            azure_endpoint=self.OPENAI_API_ENDPOINT,
-            openai_api_key=self.OPENAI_API_KEY,
-            api_version=self.OPENAI_API_VERSION,
-            azure_deployment=self.OPENAI_DEPLOYMENT_ID,
-            temperature=0,
-            top_p = 0,
-            max_tokens=2048,
-            seed=42
-            )
+        # Single call giving the query and the figure (FIGURE_FLOW=combined) instead of get_operation_figure then get_figure_template.
+        self.FIGURE_ANSWER_SYSTEM_MESSAGE = SystemMessage(f"""
+        Tu es un chatbot qui génère des figures afin d'aider un utilisateur à comprendre sa donnée. Ton but est de donner la requête SQL qui permet d'obtenir les données de la figure qui répond à sa demande et la figure à tracer avec le résultat de cette requête.
+        Tes réponses doivent avoir la forme du json suivant :
+        {self.figure_answer_parser.get_format_instructions()}
+
+        **Consigne importante** : Tu ne rajoute rien en dehors de ces champs.
+        **Consigne importante** : Si on te demande de concaténer les valeurs de deux colonnes, fait colonne_a || " " || colonne_b.
+        **Instruction importante** : Il est **très important** que x_label, y_label et color soient des noms de colonnes du résultat de ta requête SQL. Respecte les noms de colonnes et la casse des noms.
+
+        Les données à ta disposition sont les suivantes :
+{data_description}
+{rollup_description}
+            """)
+
+        # Cache of the answers of the LLM (the model is deterministic so the same prompt gives the same answer).
+        # LLM_RESPONSE_CACHE=0 disables it, OPENAI_EMBEDDING_DEPLOYMENT_ID enables the similarity tier for the
+        # stages listed in LLM_SIMILARITY_NAMESPACES, whose prompt is only the question of the user. No stage is
+        # listed by default : questions differing only by a product or a year embed very close to each other and
+        # would get the SQL query of the other question.
+        self.response_cache = None
+        if os.environ.get("LLM_RESPONSE_CACHE", "1") != "0":
+            embedding_function = None
+            if os.environ.get("OPENAI_EMBEDDING_DEPLOYMENT_ID"):
+                embedding_function = AzureOpenAIEmbeddings(
+                    azure_endpoint=self.OPENAI_API_ENDPOINT,
+                    openai_api_key=self.OPENAI_API_KEY,
+                    api_version=self.OPENAI_API_VERSION,
+                    azure_deployment=os.environ.get("OPENAI_EMBEDDING_DEPLOYMENT_ID")
+                    ).embed_query
+            self.response_cache = ResponseCacheClient(
+                cache_file=os.environ.get("LLM_RESPONSE_CACHE_FILE", "data/.cache/llm_responses.sqlite"),
+                embedding_function=embedding_function,
+                similarity_namespaces=[namespace for namespace in os.environ.get("LLM_SIMILARITY_NAMESPACES", "").split(",") if namespace]
+                )
+
+        # The static instructions are in the system messages so that every prompt starts with the same prefix,
+        # which can be cached by Azure OpenAI. The dynamic content (question, reasoning, sql, table) always comes last.
+        self.FIGURE_TEMPLATE_SYSTEM_MESSAGE = SystemMessage(f"""
+        Tu es un chatbot d'aide à la création de figures. On te donne la demande d'un utilisateur, la démarche que tu as proposée pour y répondre et la requête SQL que tu as executée sur ta base de donnée.
+        **Instruction importante** : Il est **très important** que tu utilises les noms de colonnes de la table sql. Respecte les noms de colonnes de la table sql et la casse des noms.
+        Il faut maintenant tracer une figure qui permet de répondre à la demande de l'utilisateur.
+        Ta réponse doit répondre en suivant ce template : {self.figure_template_parser.get_format_instructions()}.
+        """)
+        self.INTERPRETATION_SYSTEM_MESSAGE = SystemMessage("""
+        Tu es un chatbot d'aide à l'analyse et à la décision. On te donne la question d'un utilisateur, la démarche que tu as proposée pour y répondre, la requête SQL que tu as executée sur ta base de donnée et la table obtenue.
+
+        Tu veux avoir les prix les plus bas possibles sur les produits et tu donnes des conseils aux utilisateurs pour choisir la meilleure période et le meilleur fournisseur pour cela.
+        En utilisant ces informations et en expliquant tes raisonnements, réponds à la question utilisateur.
+        Tes réponses sont courtes, claires et précises.
+        """)
+
+        # Token budgets of the prompts : the chat history and the tables are trimmed to stay within them.
+        self.result_summary_client = get_shared_resource("result_summary_client", ResultSummaryClient)
+        self.prompt_token_budget = int(os.environ.get("LLM_PROMPT_TOKEN_BUDGET", "16000"))
+        self.table_token_budget = int(os.environ.get("LLM_TABLE_TOKEN_BUDGET", "4000"))
+
+        # The prompts and chains are compiled once and rebuilt only when their example file changes.
+        self.chain_definition = {
+            "list_operation": (self.LIST_INSTRUCTION_SYSTEM_MESSAGE, self.list_instruction_example, self.instruction_template_parser),
+            "operation_figure": (self.FIGURE_SYSTEM_MESSAGE, self.list_instruction_example, self.figure_instruction_template_parser),
+            "figure_template": (self.FIGURE_TEMPLATE_SYSTEM_MESSAGE, self.figure_example, self.figure_template_parser),
+            "interpretation": (self.INTERPRETATION_SYSTEM_MESSAGE, None, StrOutputParser()),
+            "figure_answer": (self.FIGURE_ANSWER_SYSTEM_MESSAGE, None, self.figure_answer_parser),
+        }
+        self.compiled_chain = {}
+        self.compiled_chain_lock = threading.Lock()
+        # The calls to the chat model and the parsing of its answers are spans of the trace of the request.
+        self.trace_client = get_shared_resource("trace_client", TraceClient)
+
+        # The Azure deployment, or a fake model answering from a script (LLM_BACKEND=fake) to run without network.
+        self.llm_backend_client = LLMBackendClient()
+        self.llm = self.llm_backend_client.create_chat_model(
+            {system_message.content: chain_name for chain_name, (system_message, _, _) in self.chain_definition.items()})
+        # Identifies the model in the keys of the response cache, so that fake answers and real answers are never mixed.
+        self.model_id = self.OPENAI_DEPLOYMENT_ID if self.llm_backend_client.backend == "azure" else self.llm_backend_client.backend
+
+    @staticmethod
+    def load_example_messages(address):
+        """
+        Reads a file of an example conversation and converts it into messages for few shot learning.
+
+        input:
+            address (str)
+
+        output:
+            (list) of HumanMessage and AIMessage
+        """
+        with open(address, "r") as f:
+            all_messages = json.load(f)
+        example_messages = []
+        for message in all_messages:
+            if message["role"] == "user":
+                example_messages.append(HumanMessage(content = message["content"]))
+            if message["role"] == "assistant":
+                example_messages.append(AIMessage(content = str(message["content"])))
+        return example_messages
+
+    def get_chain(self, chain_name):
+        """
+        Returns the compiled chain (system message + few shot examples + LLM + parser) of a stage.
+        The chain is rebuilt only if its example file was modified since it was compiled.
+
+        input:
+            chain_name (str) list_operation, operation_figure, figure_template or interpretation
+
+        output:
+            chain (langchain runnable)
+            context (tuple) content of the static messages of the chain, used by the cache
+        """
+        system_message, example_address, parser = self.chain_definition[chain_name]
+        signature = os.stat(example_address).st_mtime_ns if example_address is not None else None
+        with self.compiled_chain_lock:
+            if chain_name not in self.compiled_chain or self.compiled_chain[chain_name][0] != signature:
+                static_messages = [system_message] + (self.load_example_messages(example_address) if example_address is not None else [])
+                chat_template = ChatPromptTemplate.from_messages(static_messages + [MessagesPlaceholder(variable_name="messages")])
+                context = tuple(message.content for message in static_messages)
+                chain = (chat_template | self.llm | parser).with_config(callbacks=[TraceCallbackHandler(self.trace_client)])
+                self.compiled_chain[chain_name] = (signature, chain, context)
+            return self.compiled_chain[chain_name][1:]
+
+
+class LLMClient:
+    """
+    An object to ask questions to an Azure LLM and interrogate documents in azure AI Search.
+    """
+    # Chains receiving the memory of the insights conversation, the other ones only receive self.messages.
+    MEMORY_CHAINS = ("list_operation",)
+
+    def __init__(self) -> None:
+        # Prompts, parsers and the chat model are shared by every session of the process.
+        self.resources = get_shared_resource("llm_resources", LLMResources)
+        self.instruction_template_parser = self.resources.instruction_template_parser
+        self.figure_instruction_template_parser = self.resources.figure_instruction_template_parser
+        self.figure_template_parser = self.resources.figure_template_parser
+        self.LIST_INSTRUCTION_SYSTEM_MESSAGE = self.resources.LIST_INSTRUCTION_SYSTEM_MESSAGE
+        self.list_instruction_example = self.resources.list_instruction_example
+        self.FIGURE_SYSTEM_MESSAGE = self.resources.FIGURE_SYSTEM_MESSAGE
+        self.figure_example = self.resources.figure_example
+        self.llm = self.resources.llm
+        self.response_cache = self.resources.response_cache
 
         # Initialize the message history.
         self.messages = []
+        # Turns of the conversation of the session : the last ones verbatim, the older ones summarized.
+        self.conversation_memory = ConversationMemoryClient()
+        # Prompt and completion tokens of the last calls, per stage.
+        self.token_usage = deque(maxlen=100)
 
     def load_example_conversation(self, address):
         """
@@ -137,11 +246,7 @@ class LLMClient:
 
         no output
         """
-        self.clear_chat_memory()
-        with open(address, "r") as f:
-            all_messages = json.load(f)
-        for message in all_messages:
-            self.add_message_to_history(role = message["role"], content = message["content"])
+        self.messages = list(self.resources.load_example_messages(address))
 
     def add_message_to_history(self, role, content):
         """
@@ -158,6 +263,22 @@ class LLMClient:
         if role == "assistant":
             self.messages.append(AIMessage(content = str(content)))
         
+    def add_turn_to_history(self, prompt, full_response, table, answer, data_stamp=None):
+        """
+        Adds a turn of the insight conversation to the memory : the question, the SQL query, a reference to its
+        result and the conclusion.
+
+        input:
+            prompt (str)
+            full_response (dict)
+            table (pd.DataFrame)
+            answer (str)
+            data_stamp (str) version of the data the query ran on
+
+        no output
+        """
+        self.conversation_memory.add_turn(prompt, full_response, table, answer, data_stamp)
+
     def clear_chat_memory(self):
         """
         Clear chat history and resets conversation
@@ -167,18 +288,306 @@ class LLMClient:
         no output 
         """
         self.messages = []
+        self.conversation_memory.clear()
     
     def get_message_history(self):
         """
-        Returns the message history
+        Returns the message history : the memory of the conversation, then the messages added one by one.
 
         no input
 
         output:
             message_list (list)
         """
-        return self.messages
+        return self.conversation_memory.get_messages() + self.messages
     
+    def invoke_with_cache(self, namespace, context, prompt, invoke):
+        """
+        Returns the cached answer to a prompt if there is one, otherwise calls the LLM and caches its answer.
+
+        input:
+            namespace (str) name of the calling method
+            context (list) everything sent to the LLM besides the prompt (system message, examples, etc.)
+            prompt (str)
+            invoke (callable) function calling the LLM
+
+        output:
+            (object)
+        """
+        if self.response_cache is None:
+            response = invoke()
+            self.record_token_usage(namespace, context, prompt, response)
+            return response
+        context_hash = self.response_cache.hash_context(self.resources.model_id, *context)
+        response = self.response_cache.get(namespace, context_hash, prompt)
+        self.resources.trace_client.add_attributes(**{"llm.cache_hits": int(response is not None)})
+        if response is None:
+            with record_deployments() as deployments:
+                response = invoke()
+            if self.is_cacheable(deployments):
+                self.response_cache.set(namespace, context_hash, prompt, response)
+            self.record_token_usage(namespace, context, prompt, response)
+        return response
+
+    async def ainvoke_with_cache(self, namespace, context, prompt, ainvoke):
+        """
+        Asynchronous version of invoke_with_cache.
+
+        input:
+            namespace (str) name of the calling method
+            context (list) everything sent to the LLM besides the prompt (system message, examples, etc.)
+            prompt (str)
+            ainvoke (callable) function returning a coroutine calling the LLM
+
+        output:
+            (object)
+        """
+        if self.response_cache is None:
+            response = await ainvoke()
+            self.record_token_usage(namespace, context, prompt, response)
+            return response
+        context_hash = self.response_cache.hash_context(self.resources.model_id, *context)
+        response = self.response_cache.get(namespace, context_hash, prompt)
+        self.resources.trace_client.add_attributes(**{"llm.cache_hits": int(response is not None)})
+        if response is None:
+            with record_deployments() as deployments:
+                response = await ainvoke()
+            if self.is_cacheable(deployments):
+                self.response_cache.set(namespace, context_hash, prompt, response)
+            self.record_token_usage(namespace, context, prompt, response)
+        return response
+
+    def stream_with_cache(self, namespace, context, prompt, chain, chain_input):
+        """
+        Streams the answer of a chain and caches the complete answer. A cached answer is returned as a single chunk.
+        For text chains the chunks are pieces of text, for json chains they are the partially parsed json.
+        The time to first token is an attribute of the current span (llm.time_to_first_token_seconds).
+
+        input:
+            namespace (str) name of the calling method
+            context (list) everything sent to the LLM besides the prompt (system message, examples, etc.)
+            prompt (str)
+            chain (langchain runnable)
+            chain_input (dict or list)
+
+        output:
+            (generator)
+        """
+        context_hash = None
+        if self.response_cache is not None:
+            context_hash = self.response_cache.hash_context(self.resources.model_id, *context)
+            response = self.response_cache.get(namespace, context_hash, prompt)
+            self.resources.trace_client.add_attributes(**{"llm.cache_hits": int(response is not None)})
+            if response is not None:
+                yield response
+                return
+
+        start_time = time.perf_counter()
+        response = None
+        # The deployments are recorded chunk by chunk : the stream can be consumed from another context.
+        deployments = []
+        stream = iter(chain.stream(chain_input))
+        while True:
+            with record_deployments(deployments):
+                chunk = next(stream, None)
+            if chunk is None:
+                break
+            if response is None:
+                self.resources.trace_client.add_attributes(**{"llm.time_to_first_token_seconds": time.perf_counter() - start_time})
+            response = response + chunk if isinstance(chunk, str) and response is not None else chunk
+            yield chunk
+        if response is not None:
+            self.record_token_usage(namespace, context, prompt, response)
+            if self.response_cache is not None and self.is_cacheable(deployments):
+                self.response_cache.set(namespace, context_hash, prompt, response)
+
+    def is_cacheable(self, deployments):
+        """
+        Returns True if an answer can be cached. The keys of the cache identify the primary deployment, so the
+        answers of the fallback deployment are not cached.
+
+        input:
+            deployments (list) of str, the deployments which answered
+
+        output:
+            (bool)
+        """
+        return all(deployment == self.resources.OPENAI_DEPLOYMENT_ID for deployment in deployments)
+
+    def record_token_usage(self, namespace, context, prompt, response):
+        """
+        Counts the prompt and completion tokens of a call to the LLM, stores them in self.token_usage and adds
+        them to the span of the current stage.
+
+        input:
+            namespace (str) name of the calling method
+            context (list) everything sent to the LLM besides the prompt
+            prompt (str)
+            response (str or dict)
+
+        no output
+        """
+        completion = response if isinstance(response, str) else json.dumps(response, ensure_ascii=False)
+        usage = {
+            "stage": namespace,
+            "prompt_tokens": self.resources.token_client.count_messages(list(context) + [prompt]),
+            "completion_tokens": self.resources.token_client.count_text(completion),
+        }
+        self.token_usage.append(usage)
+        self.resources.trace_client.add_attributes(**{"llm.prompt_tokens": usage["prompt_tokens"], "llm.completion_tokens": usage["completion_tokens"]})
+
+    def get_token_usage(self):
+        """
+        Returns the prompt and completion tokens of the last calls to the LLM.
+
+        no input
+
+        output:
+            (list) of dict with the keys stage, prompt_tokens and completion_tokens
+        """
+        return list(self.token_usage)
+
+    def prepare_chain(self, chain_name, user_message):
+        """
+        Builds the input of a compiled chain : the chat history, trimmed to stay within the token budget, and the user message.
+        The memory of the insights conversation is only part of the history of the chains of MEMORY_CHAINS.
+
+        input:
+            chain_name (str)
+            user_message (str)
+
+        output:
+            chain (langchain runnable)
+            chain_input (dict)
+            context (list) what is sent besides the user message, used by the cache
+            user_message (str)
+        """
+        chain, static_context = self.resources.get_chain(chain_name)
+        token_client = self.resources.token_client
+        history_budget = self.resources.prompt_token_budget - token_client.count_messages(list(static_context) + [user_message])
+        messages = self.get_message_history() if chain_name in self.MEMORY_CHAINS else self.messages
+        history = token_client.trim_messages(messages, history_budget)
+        context = list(static_context) + [message.content for message in history]
+        return chain, {"messages": history + [HumanMessage(content = user_message)]}, context, user_message
+
+    def add_schema(self, user_query):
+        """
+        Adds the description of the tables relevant to the question at the end of the user message, when the
+        catalog is too large to be described in the system messages.
+
+        input:
+            user_query (str)
+
+        output:
+            (str)
+        """
+        if self.resources.schema_index_client is None:
+            return user_query
+        return f"""{user_query}
+
+        Les données à ta disposition sont les suivantes :
+{self.resources.schema_index_client.get_prompt_schema(user_query)}"""
+
+    def prepare_interpretation(self, prompt, full_response, table):
+        """
+        Builds the chain and the input needed to ask for an interpretation of the answer.
+
+        input:
+            prompt (str)
+            full_response (dict)
+            table (str or pd.DataFrame) a DataFrame is serialized compactly and summarized if it is too large
+
+        output:
+            chain (langchain runnable)
+            chain_input (dict)
+            context (list) what is sent besides the prompt, used by the cache
+            instruction_prompt (str)
+        """
+        if not isinstance(table, str):
+            table = self.resources.result_summary_client.serialize(table)
+        table = self.resources.token_client.trim_table(table, self.resources.table_token_budget)
+        instruction_prompt = f"""
+        Un utilisateur a posé la question suivante : {prompt}. 
+        Afin de répondre à cette question, tu as proposé la démarche suivante : {full_response['reasoning']} et tu as executé sur ta base de donnée la requête SQL suivante : {full_response['sql']}.
+        La requête a donné la table suivante : {table}.
+        """
+        return self.prepare_chain("interpretation", instruction_prompt)
+
+    def prepare_operation_figure(self, user_query):
+        """
+        Builds the chain and the input needed to ask for the SQL query retrieving the data of a figure.
+
+        input:
+            user_query (str)
+
+        output:
+            chain (langchain runnable)
+            chain_input (dict)
+            context (list) what is sent besides the prompt, used by the cache
+            user_query (str)
+        """
+        return self.prepare_chain("operation_figure", self.add_schema(user_query))
+
+    def prepare_figure_template(self, prompt, full_response):
+        """
+        Builds the chain and the input needed to ask for the template of a figure.
+
+        input:
+            prompt (str)
+            full_response (dict)
+
+        output:
+            chain (langchain runnable)
+            chain_input (dict)
+            context (list) what is sent besides the prompt, used by the cache
+            user_message_reworked (str)
+        """
+        user_message_reworked = f"""Un utilisateur a fait la demande suivante : {prompt}. 
+            Afin de répondre à cette question, tu as proposé la démarche suivante : {full_response['reasoning']} et tu as executé sur ta base de donnée la requête SQL suivante : {full_response['sql']}.
+            """
+        return self.prepare_chain("figure_template", user_message_reworked)
+
+    def prepare_figure_template_repair(self, prompt, full_response, figure_instruction, result_description, problems):
+        """
+        Builds the chain and the input needed to ask for a fixed template of a figure, when the template doesn't
+        match the result of the query.
+
+        input:
+            prompt (str)
+            full_response (dict)
+            figure_instruction (dict) the template which doesn't match the result
+            result_description (str) the columns of the result and their types
+            problems (list) of str
+
+        output:
+            chain (langchain runnable)
+            chain_input (dict)
+            context (list) what is sent besides the prompt, used by the cache
+            user_message_reworked (str)
+        """
+        user_message_reworked = f"""Un utilisateur a fait la demande suivante : {prompt}. 
+            Afin de répondre à cette question, tu as proposé la démarche suivante : {full_response['reasoning']} et tu as executé sur ta base de donnée la requête SQL suivante : {full_response['sql']}.
+            Tu as proposé la figure suivante : {json.dumps(figure_instruction, ensure_ascii=False)}.
+            Cette figure ne correspond pas au résultat de la requête : {" ".join(problems)}
+            Les colonnes du résultat sont : {result_description}. Corrige la figure en utilisant uniquement ces colonnes.
+            """
+        return self.prepare_chain("figure_template", user_message_reworked)
+
+    def prepare_list_operation(self, user_query):
+        """
+        Builds the chain and the input needed to ask for the SQL query answering a question.
+
+        input:
+            user_query (str)
+
+        output:
+            chain (langchain runnable)
+            chain_input (dict)
+            context (list) what is sent besides the prompt, used by the cache
+            user_query (str)
+        """
+        return self.prepare_chain("list_operation", self.add_schema(user_query))
+
     def get_interpretation(self, prompt, full_response, table):
         """
         Method to ask a question to an LLM when we want an interpretation of the answer.
@@ -186,24 +595,45 @@ class LLMClient:
         input:
             prompt (str)
             full_response (str)
-            table (str)
+            table (str or pd.DataFrame)
             
         output:
             (str)
             
         """
-        instruction_prompt = f"""
-        Tu es un chatbot d'aide à l'analyse et à la décision. Un utilisateur a posé la question suivante : {prompt}. 
-        Afin de répondre à cette question, tu as proposé la démarche suivante : {full_response['reasoning']} et tu as executé sur ta base de donnée la requête SQL suivante : {full_response['sql']}.
-        La requête a donné la table suivante : {table}.
+        chain, chain_input, context, instruction_prompt = self.prepare_interpretation(prompt, full_response, table)
+        # We send the request
+        return self.invoke_with_cache("get_interpretation", context, instruction_prompt, lambda: chain.invoke(chain_input))
 
-        Tu veux avoir les prix les plus bas possibles sur les produits et tu donnes des conseils aux utilisateurs pour choisir la meilleure période et le meilleur fournisseur pour cela.
-        En utilisant ces informations et en expliquant tes raisonnements, réponds à la question utilisateur.
-        Tes réponses sont courtes, claires et précises.
+    async def aget_interpretation(self, prompt, full_response, table):
         """
-        # We send the request
-        llm_response = self.llm.invoke([{"role": "user", "content": instruction_prompt}])
-        return llm_response.content
+        Asynchronous version of get_interpretation.
+
+        input:
+            prompt (str)
+            full_response (str)
+            table (str or pd.DataFrame)
+
+        output:
+            (str)
+        """
+        chain, chain_input, context, instruction_prompt = self.prepare_interpretation(prompt, full_response, table)
+        return await self.ainvoke_with_cache("get_interpretation", context, instruction_prompt, lambda: chain.ainvoke(chain_input))
+
+    def stream_interpretation(self, prompt, full_response, table):
+        """
+        Streaming version of get_interpretation, yields the answer piece by piece.
+
+        input:
+            prompt (str)
+            full_response (dict)
+            table (str or pd.DataFrame)
+
+        output:
+            (generator) of str
+        """
+        chain, chain_input, context, instruction_prompt = self.prepare_interpretation(prompt, full_response, table)
+        yield from self.stream_with_cache("get_interpretation", context, instruction_prompt, chain, chain_input)
 
     def get_operation_figure(self, user_query):
         """
@@ -216,13 +646,74 @@ class LLMClient:
             (str)
             
         """
-        self.load_example_conversation(self.list_instruction_example)
-        chat_template = ChatPromptTemplate.from_messages([self.FIGURE_SYSTEM_MESSAGE, MessagesPlaceholder(variable_name="messages")])
-        chain = chat_template | self.llm | self.figure_instruction_template_parser
+        chain, chain_input, context, user_query = self.prepare_operation_figure(user_query)
+        return self.invoke_with_cache("get_operation_figure", context, user_query, lambda: chain.invoke(chain_input))
 
-        response = chain.invoke({"messages": self.messages + [HumanMessage(content = user_query)]})
-        return response
+    async def aget_operation_figure(self, user_query):
+        """
+        Asynchronous version of get_operation_figure.
+
+        input:
+            user_query (str)
+
+        output:
+            (dict)
+        """
+        chain, chain_input, context, user_query = self.prepare_operation_figure(user_query)
+        return await self.ainvoke_with_cache("get_operation_figure", context, user_query, lambda: chain.ainvoke(chain_input))
     
+    def get_figure_answer(self, user_query):
+        """
+        Asks in a single call for the SQL query retrieving the data of a figure and the template of the figure.
+
+        input:
+            user_query (str)
+
+        output:
+            (dict) with the keys reasoning, sql, figure_type, title, x_label, y_label and color
+        """
+        chain, chain_input, context, user_query = self.prepare_chain("figure_answer", self.add_schema(user_query))
+        return self.invoke_with_cache("get_figure_answer", context, user_query, lambda: chain.invoke(chain_input))
+
+    async def aget_figure_answer(self, user_query):
+        """
+        Asynchronous version of get_figure_answer.
+
+        input:
+            user_query (str)
+
+        output:
+            (dict)
+        """
+        chain, chain_input, context, user_query = self.prepare_chain("figure_answer", self.add_schema(user_query))
+        return await self.ainvoke_with_cache("get_figure_answer", context, user_query, lambda: chain.ainvoke(chain_input))
+
+    def stream_figure_answer(self, user_query):
+        """
+        Streaming version of get_figure_answer, yields the json answer as it is being parsed.
+
+        input:
+            user_query (str)
+
+        output:
+            (generator) of dict, the last one is the complete answer
+        """
+        chain, chain_input, context, user_query = self.prepare_chain("figure_answer", self.add_schema(user_query))
+        yield from self.stream_with_cache("get_figure_answer", context, user_query, chain, chain_input)
+
+    def stream_operation_figure(self, user_query):
+        """
+        Streaming version of get_operation_figure, yields the json answer as it is being parsed.
+
+        input:
+            user_query (str)
+
+        output:
+            (generator) of dict, the last one is the complete answer
+        """
+        chain, chain_input, context, user_query = self.prepare_operation_figure(user_query)
+        yield from self.stream_with_cache("get_operation_figure", context, user_query, chain, chain_input)
+
     def get_figure_template(self, prompt, full_response):
         """
         Method to ask a question to an LLM when we want as output a list of operations to do on data.
@@ -234,19 +725,39 @@ class LLMClient:
             (str)
             
         """
-        self.load_example_conversation(self.figure_example)
-        chat_template = ChatPromptTemplate.from_messages([MessagesPlaceholder(variable_name="messages")])
-        user_message_reworked = f"""Tu es un chatbot d'aide à la création de figures. Un utilisateur a fait la demande suivante : {prompt}. 
-            Afin de répondre à cette question, tu as proposé la démarche suivante : {full_response['reasoning']} et tu as executé sur ta base de donnée la requête SQL suivante : {full_response['sql']}.
-            **Instruction importante** : Il est **très important** que tu utilises les noms de colonnes de la table sql. Respecte les noms de colonnes de la table sql et la casse des noms.
-            Il faut maintenant tracer une figure qui permet de répondre à la demande de l'utilisateur.
-            Ta réponse doit répondre en suivant ce template : {self.figure_template_parser.get_format_instructions()}.
-            """
-        #print(figure_prompt.format(prompt = prompt))
-        chain = chat_template | self.llm | self.figure_template_parser
+        chain, chain_input, context, user_message_reworked = self.prepare_figure_template(prompt, full_response)
+        return self.invoke_with_cache("get_figure_template", context, user_message_reworked, lambda: chain.invoke(chain_input))
 
-        response = chain.invoke({"messages": self.messages + [HumanMessage(content = user_message_reworked)]})
-        return response
+    async def aget_figure_template(self, prompt, full_response):
+        """
+        Asynchronous version of get_figure_template.
+
+        input:
+            prompt (str)
+            full_response (dict)
+
+        output:
+            (dict)
+        """
+        chain, chain_input, context, user_message_reworked = self.prepare_figure_template(prompt, full_response)
+        return await self.ainvoke_with_cache("get_figure_template", context, user_message_reworked, lambda: chain.ainvoke(chain_input))
+
+    async def arepair_figure_template(self, prompt, full_response, figure_instruction, result_description, problems):
+        """
+        Asks the LLM once to fix a template of a figure which doesn't match the result of the query.
+
+        input:
+            prompt (str)
+            full_response (dict)
+            figure_instruction (dict)
+            result_description (str)
+            problems (list) of str
+
+        output:
+            (dict)
+        """
+        chain, chain_input, context, user_message_reworked = self.prepare_figure_template_repair(prompt, full_response, figure_instruction, result_description, problems)
+        return await self.ainvoke_with_cache("repair_figure_template", context, user_message_reworked, lambda: chain.ainvoke(chain_input))
 
     def get_list_operation(self, user_query):
         """
@@ -259,9 +770,18 @@ class LLMClient:
             (str)
             
         """
-        self.load_example_conversation(self.list_instruction_example)
-        chat_template = ChatPromptTemplate.from_messages([self.LIST_INSTRUCTION_SYSTEM_MESSAGE, MessagesPlaceholder(variable_name="messages")])
-        chain = chat_template | self.llm | self.instruction_template_parser
+        chain, chain_input, context, user_query = self.prepare_list_operation(user_query)
+        return self.invoke_with_cache("get_list_operation", context, user_query, lambda: chain.invoke(chain_input))
 
-        response = chain.invoke({"messages": self.messages + [HumanMessage(content = user_query)]})
-        return response
+    async def aget_list_operation(self, user_query):
+        """
+        Asynchronous version of get_list_operation.
+
+        input:
+            user_query (str)
+
+        output:
+            (dict)
+        """
+        chain, chain_input, context, user_query = self.prepare_list_operation(user_query)
+        return await self.ainvoke_with_cache("get_list_operation", context, user_query, lambda: chain.ainvoke(chain_input))
@@ -0,0 +1,294 @@
+"""
+A runner answering a file of questions without the interface : the insight and figure flows run for every question
+with a pool of workers, the questions are retried when the LLM is rate limited and the results are written as they
+come, so that an interrupted run resumes where it stopped. With --fake-llm, the answers of the LLM are read from the
+questions file and the run needs no network.
+Usage : python -m helper.batch_client [questions.jsonl] [--output results.jsonl] [--workers 4] [--fake-llm]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+from helper.figure_spec_client import FigureSpecError
+from helper.guardrail_client import QueryRejectedError
+from helper.resilience_client import LLMUnavailableError, ResilienceClient
+
+
+# Questions of the README (PoC 1 : insights, PoC 2 : figures), used when no questions file is given.
+DEFAULT_QUESTIONS = [
+    {"id": "poc1-1", "flow": "insight", "question": "Je suis en octobre 2024. Mon fournisseur de cuivre me propose un prix de 6000. Est-ce que je devrais acheter chez lui ou chez un autre fournisseur ?"},
+    {"id": "poc1-2", "flow": "insight", "question": "D'après les prédictions, quel sera le meilleur mois pour acheter du plomb en 2025 et dans quel pays ?"},
+    {"id": "poc1-3", "flow": "insight", "question": "Nous sommes en 2024. Est-ce que je devrais faire du stock de cuivre cette année ou est-ce que je devrais acheter l'année prochaine ?"},
+    {"id": "poc1-4", "flow": "insight", "question": "Je suis en octobre 2024. J'ai envie d'acheter du cuivre, est-ce que je le fais maintenant ou est-ce que j'attends quelques mois ? Utilise les derniers mois d'avant pour justifier ta réponse."},
+    {"id": "poc1-5", "flow": "insight", "question": "Nous sommes en Octobre 2024. Sur les six derniers mois, sommes-nous sur une tendance à la hausse pour le plomb ?"},
+    {"id": "poc1-6", "flow": "insight", "question": "En utilisant les drivers, comment expliquer le hausse du prix du cuivre en 2025 ?"},
+    {"id": "poc2-1", "flow": "figure", "question": "Trace l'évolution du prix du cuivre au cours du temps. Sépare les fournisseurs et inclut les prédictions."},
+    {"id": "poc2-2", "flow": "figure", "question": "pour les drivers de couts du cuivre aux US, tu peux me tracer un camembert qui m'indique leur importance (en valeur absolue) à chacun ?"},
+    {"id": "poc2-3", "flow": "figure", "question": "Pour chaque fournisseur de plomb, donne moi un bar chart qui présente la moyenne des prix pour chaque année entre 2023 et 2025"},
+    {"id": "poc2-4", "flow": "figure", "question": "Quelle est l'évolution du prix du cuivre au cours du temps en 2024 et 2025 pour le fournisseur A trace aussi les données de prédictions pour le cuivre aux US."},
+]
+
+
+class BatchClient:
+    """
+    A runner answering a file of questions with a pool of workers.
+    """
+    # Errors meaning that the SQL query written by the LLM is invalid or was rejected.
+    SQL_ERRORS = (QueryRejectedError, sqlite3.Error, pd.errors.DatabaseError)
+
+    def __init__(self, worker_count=None, max_retries=3, retry_delay=2.0, pipeline_factory=None) -> None:
+        # Each worker is a session : it has its own LLM client and chat history, the data is shared.
+        self.worker_count = worker_count or int(os.environ.get("BATCH_WORKERS", "4"))
+        # A question is run again at most max_retries times when the LLM is rate limited or a stage times out.
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.pipeline_factory = pipeline_factory or self.create_pipeline
+
+    @staticmethod
+    def create_pipeline():
+        """
+        Creates the pipeline of a worker, the same way as a session of the interface.
+
+        no input
+
+        output:
+            (PipelineClient)
+        """
+        from helper.LLM_client import LLMClient
+        from helper.operation_client import OperationClient
+        from helper.pipeline_client import PipelineClient
+        from helper.resource_client import get_shared_resource
+
+        return PipelineClient(LLMClient(), get_shared_resource("operation_client", OperationClient))
+
+    @staticmethod
+    def read_questions(address):
+        """
+        Reads a jsonl file of questions. Each line has a question and optionally an id (the line number by
+        default), a flow (insight or figure, insight by default) and the answers of the LLM for --fake-llm.
+
+        input:
+            address (str)
+
+        output:
+            (list) of dict
+        """
+        questions = []
+        with open(address, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                if line.strip():
+                    question = json.loads(line)
+                    question.setdefault("id", str(line_number))
+                    question.setdefault("flow", "insight")
+                    questions.append(question)
+        return questions
+
+    @staticmethod
+    def read_results(address):
+        """
+        Reads the results of a previous run, the last result of each question is kept.
+
+        input:
+            address (str)
+
+        output:
+            (dict) question id -> result
+        """
+        results = {}
+        if os.path.exists(address):
+            with open(address, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        results[result["id"]] = result
+        return results
+
+    def get_retry_delay(self, error, attempt):
+        """
+        Returns the time to wait before running a question again, or None if the error is not worth a retry.
+        The delay asked by the LLM (Retry-After header) is used when there is one, otherwise the delay doubles
+        at each attempt.
+
+        input:
+            error (Exception)
+            attempt (int) number of the failed attempt, starting at 1
+
+        output:
+            (float) or None
+        """
+        # The calls to the LLM were already retried : the question is run again later, once the deployment recovered.
+        is_rate_limited = getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+        if not is_rate_limited and not isinstance(error, (TimeoutError, LLMUnavailableError)):
+            return None
+        retry_after = ResilienceClient.get_retry_after(error)
+        return retry_after if retry_after is not None else self.retry_delay * 2 ** (attempt - 1)
+
+    async def answer_question(self, pipeline_client, question, result):
+        """
+        Runs the flow of a question and fills its result : SQL query, validity of the query, number of rows
+        and figure.
+
+        input:
+            pipeline_client (PipelineClient)
+            question (dict)
+            result (dict)
+
+        no output
+        """
+        llm_client = pipeline_client.llm_client
+        prompt = question["question"]
+        if question["flow"] == "figure" and pipeline_client.figure_flow == "combined":
+            full_response = await pipeline_client.run_stage("figure_answer", llm_client.aget_figure_answer(prompt))
+        elif question["flow"] == "figure":
+            full_response = await pipeline_client.run_stage("operation_figure", llm_client.aget_operation_figure(prompt))
+        else:
+            full_response = await pipeline_client.run_stage("list_operation", llm_client.aget_list_operation(prompt))
+        result["sql"] = full_response.get("sql")
+        try:
+            if question["flow"] == "figure":
+                figure_flow_answer = await pipeline_client.run_figure(prompt, full_response)
+                result["figure_type"] = figure_flow_answer["figure_answer"]["figure_type"]
+                result["figure_built"] = figure_flow_answer["plotly_figure"] is not None
+            else:
+                insight_answer = await pipeline_client.run_insight(prompt, full_response)
+                result["rows"] = len(insight_answer["table_answer"])
+            result["sql_valid"] = True
+        except self.SQL_ERRORS:
+            result["sql_valid"] = False
+            raise
+        except FigureSpecError:
+            result["sql_valid"] = True
+            result["figure_built"] = False
+            raise
+
+    async def run_question(self, pipeline_client, question):
+        """
+        Runs a question, again if the LLM is rate limited, and returns its result.
+
+        input:
+            pipeline_client (PipelineClient)
+            question (dict)
+
+        output:
+            (dict)
+        """
+        # The worker runs one question at a time, so the calls of its LLM client are the calls of the question.
+        pipeline_client.llm_client.token_usage.clear()
+        start = time.perf_counter()
+        for attempt in range(1, self.max_retries + 2):
+            result = {"id": question["id"], "flow": question["flow"], "question": question["question"], "status": "ok",
+                      "error": None, "attempts": attempt, "sql": None, "sql_valid": None, "rows": None, "figure_built": None}
+            try:
+                await self.answer_question(pipeline_client, question, result)
+            except Exception as e:
+                result.update({"status": "error", "error": f"{type(e).__name__}: {e}"})
+                delay = self.get_retry_delay(e, attempt)
+                if delay is not None and attempt <= self.max_retries:
+                    await asyncio.sleep(delay)
+                    continue
+            break
+        # Time to answer the question, retries included.
+        result["seconds"] = time.perf_counter() - start
+        token_usage = pipeline_client.llm_client.get_token_usage()
+        result["llm_calls"] = len(token_usage)
+        result["prompt_tokens"] = sum(usage["prompt_tokens"] for usage in token_usage)
+        result["completion_tokens"] = sum(usage["completion_tokens"] for usage in token_usage)
+        return result
+
+    async def run(self, questions, output_file):
+        """
+        Runs the questions which don't have a successful result in output_file yet. The results are appended
+        to output_file as soon as they are known.
+
+        input:
+            questions (list) of dict
+            output_file (str)
+
+        output:
+            (dict) summary of the results of the questions, see summarize
+        """
+        previous_results = self.read_results(output_file)
+        queue = asyncio.Queue()
+        for question in questions:
+            if previous_results.get(question["id"], {}).get("status") != "ok":
+                queue.put_nowait(question)
+        if os.path.dirname(output_file):
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+        start = time.perf_counter()
+        with open(output_file, "a", encoding="utf-8") as f:
+            async def work():
+                pipeline_client = self.pipeline_factory()
+                while not queue.empty():
+                    question = queue.get_nowait()
+                    result = await self.run_question(pipeline_client, question)
+                    previous_results[question["id"]] = result
+                    f.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+                    f.flush()
+            question_count = queue.qsize()
+            await asyncio.gather(*[work() for _ in range(min(self.worker_count, question_count))])
+        wall_seconds = time.perf_counter() - start
+
+        summary = self.summarize([previous_results[question["id"]] for question in questions if question["id"] in previous_results])
+        summary["questions_run"] = question_count
+        summary["wall_seconds"] = wall_seconds
+        summary["questions_per_second"] = question_count / wall_seconds if wall_seconds > 0 else 0.0
+        return summary
+
+    @staticmethod
+    def summarize(results):
+        """
+        Summarizes results : share of successful questions, of valid SQL queries and of built figures, latency
+        percentiles and tokens per question.
+
+        input:
+            results (list) of dict
+
+        output:
+            (dict)
+        """
+        def rate(values):
+            values = [value for value in values if value is not None]
+            return sum(values) / len(values) if values else None
+
+        def percentile(values, share):
+            values = sorted(values)
+            return values[min(int(share * len(values)), len(values) - 1)] if values else None
+
+        seconds = [result["seconds"] for result in results]
+        question_count = max(len(results), 1)
+        return {
+            "questions": len(results),
+            "success_rate": rate([result["status"] == "ok" for result in results]),
+            "sql_valid_rate": rate([result["sql_valid"] for result in results]),
+            "figure_success_rate": rate([result["figure_built"] for result in results if result["flow"] == "figure"]),
+            "p50_seconds": percentile(seconds, 0.5),
+            "p95_seconds": percentile(seconds, 0.95),
+            "retries": sum(result["attempts"] - 1 for result in results),
+            "llm_calls_per_question": sum(result["llm_calls"] for result in results) / question_count,
+            "prompt_tokens_per_question": sum(result["prompt_tokens"] for result in results) / question_count,
+            "completion_tokens_per_question": sum(result["completion_tokens"] for result in results) / question_count,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answers a jsonl file of questions with the insight and figure flows.")
+    parser.add_argument("questions_file", nargs="?", help="jsonl file of questions, the questions of the README by default")
+    parser.add_argument("--output", default="data/batch_results.jsonl", help="jsonl file of the results, an existing file is resumed")
+    parser.add_argument("--workers", type=int, default=None, help="number of questions run at the same time")
+    parser.add_argument("--retries", type=int, default=3, help="retries of a question when the LLM is rate limited")
+    parser.add_argument("--fake-llm", action="store_true", help="reads the answers of the LLM from the questions file")
+    arguments = parser.parse_args()
+
+    if arguments.fake_llm:
+        os.environ["LLM_BACKEND"] = "fake"
+        os.environ.setdefault("LLM_FAKE_SCRIPT", arguments.questions_file or "")
+    batch_questions = BatchClient.read_questions(arguments.questions_file) if arguments.questions_file else DEFAULT_QUESTIONS
+    batch_client = BatchClient(worker_count=arguments.workers, max_retries=arguments.retries)
+    print(json.dumps(asyncio.run(batch_client.run(batch_questions, arguments.output)), indent=4))
@@ -0,0 +1,161 @@
+"""
+A benchmark of the stages of the application under load : get_list_operation, get_figure_template, read_operation
+and plot_figure are called by several clients at the same time and their latency and throughput are measured.
+Run it with LLM_BACKEND=replay (recorded answers) or LLM_BACKEND=fake (scripted answers) to benchmark without network :
+python -m helper.benchmark_client questions.jsonl [--concurrency 1 4 16] [--requests 32] [--no-query-cache]
+"""
+
+import argparse
+import asyncio
+import time
+
+
+class BenchmarkClient:
+    """
+    A benchmark of the stages of the application under load.
+    """
+    STAGES = ("get_list_operation", "get_figure_template", "read_operation", "plot_figure")
+
+    def __init__(self, llm_client, operation_client, query_cache=True) -> None:
+        self.llm_client = llm_client
+        # The answers of the LLM are not taken from the response cache, to measure the backend.
+        self.llm_client.response_cache = None
+        self.operation_client = operation_client
+        # Without the query cache, every read_operation and plot_figure call runs its query.
+        self.query_cache = query_cache
+        self.inputs = {stage: [] for stage in self.STAGES}
+
+    async def prepare(self, questions):
+        """
+        Asks the LLM once per question for the inputs of the stages : the questions of the insight flow give the
+        SQL queries of read_operation, the questions of the figure flow give the answers of get_operation_figure
+        and the figure templates of plot_figure.
+
+        input:
+            questions (list) of dict with the keys question and flow (insight or figure)
+
+        no output
+        """
+        for question in questions:
+            prompt = question["question"]
+            try:
+                if question.get("flow", "insight") == "figure":
+                    full_response = await self.llm_client.aget_operation_figure(prompt)
+                    figure_answer = await self.llm_client.aget_figure_template(prompt, full_response)
+                    self.inputs["get_figure_template"].append((prompt, full_response))
+                    self.inputs["plot_figure"].append((full_response["sql"], figure_answer))
+                else:
+                    full_response = await self.llm_client.aget_list_operation(prompt)
+                    self.inputs["get_list_operation"].append((prompt,))
+                    self.inputs["read_operation"].append((full_response["sql"],))
+            except Exception as e:
+                print(f"The question {prompt[:80]} couldn't be prepared : {e}")
+
+    def call_stage(self, stage, arguments):
+        """
+        Returns the coroutine of a call to a stage.
+
+        input:
+            stage (str)
+            arguments (tuple)
+
+        output:
+            (coroutine)
+        """
+        if stage in ("read_operation", "plot_figure") and not self.query_cache:
+            self.operation_client.query_cache_client.clear()
+        if stage == "get_list_operation":
+            return self.llm_client.aget_list_operation(*arguments)
+        if stage == "get_figure_template":
+            return self.llm_client.aget_figure_template(*arguments)
+        if stage == "read_operation":
+            return self.operation_client.aread_operation(*arguments)
+        return self.operation_client.aplot_figure(*arguments)
+
+    async def run_stage(self, stage, concurrency, request_count):
+        """
+        Calls a stage request_count times, with concurrency calls running at the same time. The inputs of the
+        stage are used in turn.
+
+        input:
+            stage (str)
+            concurrency (int)
+            request_count (int)
+
+        output:
+            (dict) latency percentiles, throughput and number of errors
+        """
+        inputs = self.inputs[stage]
+        if not inputs:
+            return {"stage": stage, "concurrency": concurrency, "requests": 0}
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        errors = []
+
+        async def call(index):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await self.call_stage(stage, inputs[index % len(inputs)])
+                    latencies.append(time.perf_counter() - start)
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*[call(index) for index in range(request_count)])
+        wall_seconds = time.perf_counter() - start
+        latencies.sort()
+        return {
+            "stage": stage,
+            "concurrency": concurrency,
+            "requests": request_count,
+            "errors": len(errors),
+            "p50_seconds": latencies[len(latencies) // 2] if latencies else None,
+            "p95_seconds": latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)] if latencies else None,
+            "requests_per_second": len(latencies) / wall_seconds if wall_seconds > 0 else 0.0,
+        }
+
+    async def run(self, questions, concurrency_levels=(1, 4, 16), request_count=32, stages=None):
+        """
+        Prepares the inputs of the stages and benchmarks each stage at each level of concurrency.
+
+        input:
+            questions (list) of dict
+            concurrency_levels (tuple) of int
+            request_count (int) calls per stage and level of concurrency
+            stages (list) stages to benchmark, all of them by default
+
+        output:
+            (list) of dict, see run_stage
+        """
+        await self.prepare(questions)
+        measures = []
+        for stage in stages or self.STAGES:
+            for concurrency in concurrency_levels:
+                measures.append(await self.run_stage(stage, concurrency, request_count))
+        return measures
+
+
+if __name__ == "__main__":
+    from helper.batch_client import DEFAULT_QUESTIONS, BatchClient
+    from helper.LLM_client import LLMClient
+    from helper.operation_client import OperationClient
+    from helper.resource_client import get_shared_resource
+
+    parser = argparse.ArgumentParser(description="Benchmarks the stages of the application under load.")
+    parser.add_argument("questions_file", nargs="?", help="jsonl file of questions (same format as the batch runner), the questions of the README by default")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="numbers of calls running at the same time")
+    parser.add_argument("--requests", type=int, default=32, help="calls per stage and level of concurrency")
+    parser.add_argument("--stages", nargs="+", choices=BenchmarkClient.STAGES, default=None, help="stages to benchmark")
+    parser.add_argument("--no-query-cache", action="store_true", help="runs the query of every read_operation and plot_figure call")
+    arguments = parser.parse_args()
+
+    benchmark_questions = BatchClient.read_questions(arguments.questions_file) if arguments.questions_file else DEFAULT_QUESTIONS
+    benchmark_client = BenchmarkClient(LLMClient(), get_shared_resource("operation_client", OperationClient), query_cache=not arguments.no_query_cache)
+    benchmark_measures = asyncio.run(benchmark_client.run(benchmark_questions, arguments.concurrency, arguments.requests, arguments.stages))
+    print("stage\tconcurrency\trequests\terrors\tp50_seconds\tp95_seconds\trequests_per_second")
+    for measure in benchmark_measures:
+        if measure.get("p50_seconds") is not None:
+            print(f"{measure['stage']}\t{measure['concurrency']}\t{measure['requests']}\t{measure['errors']}\t{measure['p50_seconds']:.3f}\t{measure['p95_seconds']:.3f}\t{measure['requests_per_second']:.1f}")
+        elif measure["requests"]:
+            print(f"{measure['stage']}\t{measure['concurrency']}\t{measure['requests']}\t{measure['errors']}\t-\t-\t0.0")
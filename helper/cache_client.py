@@ -0,0 +1,429 @@
+"""
+A cache for the answers of the LLM, with an exact-match tier and an optional embedding-similarity tier.
+Entries expire after a TTL, the in-memory tier is bounded with LRU eviction and every entry is persisted on disk.
+Can be checked with a fake LLM : python -m helper.cache_client
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class ResponseCacheClient:
+    """
+    A cache for the answers of the LLM, with an exact-match tier and an optional embedding-similarity tier.
+    """
+    def __init__(self, cache_file="data/.cache/llm_responses.sqlite", max_entries=512, max_disk_entries=10000, ttl_seconds=7 * 24 * 3600, embedding_function=None, similarity_threshold=0.97, similarity_namespaces=()) -> None:
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        # embedding_function takes a text and returns a list of floats. Without it the similarity tier is disabled.
+        self.embedding_function = embedding_function
+        self.similarity_threshold = similarity_threshold
+        # Only the namespaces whose answer depends on the meaning of the prompt alone use the similarity tier.
+        # Prompts holding data (tables, numbers) can be very close and still need different answers.
+        self.similarity_namespaces = frozenset(similarity_namespaces)
+        self.memory_cache = OrderedDict()
+        # Normalized embeddings of the entries per (namespace, context hash), loaded from the disk on first use.
+        self.vectors = {}
+        # Embeddings computed by get for the prompts that missed, reused by set. Keys are the exact-match keys.
+        self.pending_embeddings = OrderedDict()
+        self.lock = threading.RLock()
+        self.statistics = {"exact_hit": 0, "semantic_hit": 0, "miss": 0}
+
+        self.connection = None
+        if cache_file is not None:
+            if os.path.dirname(cache_file):
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            self.connection = sqlite3.connect(cache_file, check_same_thread=False)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    namespace TEXT,
+                    context_hash TEXT,
+                    prompt TEXT,
+                    response TEXT,
+                    embedding TEXT,
+                    created_at REAL,
+                    accessed_at REAL
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS response_cache_context ON response_cache (namespace, context_hash)")
+            self.connection.commit()
+
+    @staticmethod
+    def hash_context(*parts):
+        """
+        Hashes everything that is sent to the LLM besides the user prompt (system message, few shot examples, etc.)
+
+        input:
+            parts (str)
+
+        output:
+            (str)
+        """
+        context_hash = hashlib.sha256()
+        for part in parts:
+            context_hash.update(str(part).encode("utf-8"))
+            context_hash.update(b"\x00")
+        return context_hash.hexdigest()
+
+    def make_key(self, namespace, context_hash, prompt):
+        """
+        Returns the key of the exact-match tier.
+
+        input:
+            namespace (str) name of the calling method
+            context_hash (str)
+            prompt (str)
+
+        output:
+            (str)
+        """
+        return self.hash_context(namespace, context_hash, prompt)
+
+    def is_expired(self, created_at):
+        """
+        Checks if an entry created at a given time is expired.
+
+        input:
+            created_at (float)
+
+        output:
+            (bool)
+        """
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def get(self, namespace, context_hash, prompt):
+        """
+        Looks for the answer to a prompt in the cache. Returns None if there is no answer.
+        The prompt is embedded outside of the lock, the other threads keep reading the cache meanwhile.
+
+        input:
+            namespace (str)
+            context_hash (str)
+            prompt (str)
+
+        output:
+            (object) the cached answer or None
+        """
+        key = self.make_key(namespace, context_hash, prompt)
+        with self.lock:
+            response = self.get_exact(key)
+            if response is not None:
+                self.statistics["exact_hit"] += 1
+                return response
+        if self.uses_similarity(namespace):
+            prompt_embedding = self.embed(prompt)
+            with self.lock:
+                self.pending_embeddings[key] = prompt_embedding
+                while len(self.pending_embeddings) > self.max_entries:
+                    self.pending_embeddings.popitem(last=False)
+                response = self.get_similar(namespace, context_hash, prompt_embedding)
+                if response is not None:
+                    self.statistics["semantic_hit"] += 1
+                    return response
+        with self.lock:
+            self.statistics["miss"] += 1
+        return None
+
+    def uses_similarity(self, namespace):
+        """
+        Checks if the similarity tier is used for a namespace.
+
+        input:
+            namespace (str)
+
+        output:
+            (bool)
+        """
+        return self.embedding_function is not None and self.connection is not None and namespace in self.similarity_namespaces
+
+    def embed(self, prompt):
+        """
+        Returns the normalized embedding of a prompt.
+
+        input:
+            prompt (str)
+
+        output:
+            (np.ndarray)
+        """
+        embedding = np.asarray(self.embedding_function(prompt), dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def get_exact(self, key):
+        """
+        Looks for an entry with the exact same key in memory and then on disk.
+
+        input:
+            key (str)
+
+        output:
+            (object) the cached answer or None
+        """
+        if key in self.memory_cache:
+            created_at, response = self.memory_cache[key]
+            if not self.is_expired(created_at):
+                self.memory_cache.move_to_end(key)
+                return response
+            del self.memory_cache[key]
+
+        if self.connection is None:
+            return None
+        row = self.connection.execute("SELECT response, created_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if self.is_expired(row[1]):
+            self.connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            self.connection.commit()
+            return None
+        response = json.loads(row[0])
+        self.connection.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        self.store_in_memory(key, row[1], response)
+        return response
+
+    def get_similar(self, namespace, context_hash, prompt_embedding):
+        """
+        Looks for an entry whose prompt embedding is close enough to the embedding of the prompt.
+        Only entries sharing the same namespace and context are compared, in a single matrix product.
+
+        input:
+            namespace (str)
+            context_hash (str)
+            prompt_embedding (np.ndarray) normalized
+
+        output:
+            (object) the cached answer or None
+        """
+        keys, matrix = self.get_vectors(namespace, context_hash)
+        if not keys or matrix.shape[1] != prompt_embedding.shape[0]:
+            return None
+        similarities = matrix @ prompt_embedding
+        # The entries removed from the disk since they were loaded are skipped.
+        for index in np.argsort(-similarities):
+            if similarities[index] < self.similarity_threshold:
+                return None
+            response = self.get_exact(keys[index])
+            if response is not None:
+                return response
+        return None
+
+    def get_vectors(self, namespace, context_hash):
+        """
+        Returns the keys and the matrix of normalized embeddings of the entries sharing a namespace and a context.
+        They are read from the disk on first call and then kept in memory.
+
+        input:
+            namespace (str)
+            context_hash (str)
+
+        output:
+            (list) of str
+            (np.ndarray) one row per key
+        """
+        if (namespace, context_hash) not in self.vectors:
+            keys, rows = [], []
+            for key, embedding, created_at in self.connection.execute(
+                    "SELECT key, embedding, created_at FROM response_cache WHERE namespace = ? AND context_hash = ? AND embedding IS NOT NULL",
+                    (namespace, context_hash)):
+                if not self.is_expired(created_at):
+                    keys.append(key)
+                    rows.append(json.loads(embedding))
+            matrix = np.asarray(rows, dtype=np.float32) if rows else np.empty((0, 0), dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            self.vectors[(namespace, context_hash)] = (keys, matrix / np.where(norms == 0, 1, norms))
+        return self.vectors[(namespace, context_hash)]
+
+    def add_vector(self, namespace, context_hash, key, embedding):
+        """
+        Adds the normalized embedding of an entry to the matrix of its namespace and context.
+
+        input:
+            namespace (str)
+            context_hash (str)
+            key (str)
+            embedding (np.ndarray)
+
+        no output
+        """
+        keys, matrix = self.get_vectors(namespace, context_hash)
+        if key in keys:
+            return
+        if matrix.shape[1] != embedding.shape[0]:
+            # No vector yet, or the embedding model changed and the previous vectors can't be compared anymore.
+            keys, matrix = [], np.empty((0, embedding.shape[0]), dtype=np.float32)
+        matrix = np.vstack([matrix, embedding])
+        self.vectors[(namespace, context_hash)] = (keys + [key], matrix)
+
+    def set(self, namespace, context_hash, prompt, response):
+        """
+        Stores the answer to a prompt in memory and on disk.
+
+        input:
+            namespace (str)
+            context_hash (str)
+            prompt (str)
+            response (object) must be json serializable
+
+        no output
+        """
+        key = self.make_key(namespace, context_hash, prompt)
+        created_at = time.time()
+        embedding = None
+        if self.uses_similarity(namespace):
+            with self.lock:
+                embedding = self.pending_embeddings.pop(key, None)
+            if embedding is None:
+                embedding = self.embed(prompt)
+        with self.lock:
+            self.store_in_memory(key, created_at, response)
+            if self.connection is None:
+                return
+            self.connection.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, namespace, context_hash, prompt, json.dumps(response), None if embedding is None else json.dumps(embedding.tolist()), created_at, created_at))
+            if embedding is not None:
+                self.add_vector(namespace, context_hash, key, embedding)
+            self.prune_disk()
+            self.connection.commit()
+
+    def store_in_memory(self, key, created_at, response):
+        """
+        Stores an entry in the in-memory tier and evicts the least recently used entries.
+
+        input:
+            key (str)
+            created_at (float)
+            response (object)
+
+        no output
+        """
+        self.memory_cache[key] = (created_at, response)
+        self.memory_cache.move_to_end(key)
+        while len(self.memory_cache) > self.max_entries:
+            self.memory_cache.popitem(last=False)
+
+    def prune_disk(self):
+        """
+        Removes the expired entries from the disk and the least recently used ones above max_disk_entries.
+
+        no input
+
+        no output
+        """
+        if self.ttl_seconds is not None:
+            self.connection.execute("DELETE FROM response_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        self.connection.execute(
+            "DELETE FROM response_cache WHERE key NOT IN (SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT ?)",
+            (self.max_disk_entries,))
+
+    def clear(self):
+        """
+        Empties the cache in memory and on disk.
+
+        no input
+
+        no output
+        """
+        with self.lock:
+            self.memory_cache.clear()
+            self.vectors.clear()
+            self.pending_embeddings.clear()
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM response_cache")
+                self.connection.commit()
+
+    def get_statistics(self):
+        """
+        Returns the hit and miss counters of the cache.
+
+        no input
+
+        output:
+            (dict)
+        """
+        with self.lock:
+            statistics = dict(self.statistics)
+        total = sum(statistics.values())
+        statistics["hit_rate"] = (statistics["exact_hit"] + statistics["semantic_hit"]) / total if total else 0.0
+        return statistics
+
+
+def run_cache_check():
+    """
+    Checks the cache in front of a fake LLM counting its calls, with a fake embedding counting the words of the prompt.
+
+    no input
+
+    output:
+        (dict) the calls to the fake LLM and to the embedding, and the statistics of the cache
+    """
+    import tempfile
+
+    calls = {"llm": 0, "embedding": 0}
+    vocabulary = ["prix", "moyen", "fournisseur", "mois", "2023", "2024", "table"]
+
+    def fake_llm(prompt):
+        calls["llm"] += 1
+        return f"réponse à : {prompt}"
+
+    def fake_embedding(prompt):
+        calls["embedding"] += 1
+        words = prompt.lower().replace("?", "").split()
+        return [words.count(word) for word in vocabulary]
+
+    def ask(cache, namespace, prompt):
+        response = cache.get(namespace, "context", prompt)
+        if response is None:
+            response = fake_llm(prompt)
+            cache.set(namespace, "context", prompt, response)
+        return response
+
+    with tempfile.TemporaryDirectory() as folder:
+        cache_file = os.path.join(folder, "llm_responses.sqlite")
+        cache = ResponseCacheClient(cache_file=cache_file, max_entries=2, embedding_function=fake_embedding, similarity_namespaces=["get_list_operation"])
+
+        ask(cache, "get_list_operation", "prix moyen par fournisseur ?")
+        assert calls == {"llm": 1, "embedding": 1}, "the embedding computed by get is reused by set"
+        ask(cache, "get_list_operation", "prix moyen par fournisseur ?")
+        assert calls["llm"] == 1 and cache.statistics["exact_hit"] == 1
+        # The same words in another order : answered by the similarity tier.
+        assert ask(cache, "get_list_operation", "par fournisseur prix moyen ?") == "réponse à : prix moyen par fournisseur ?"
+        assert calls["llm"] == 1 and cache.statistics["semantic_hit"] == 1
+        # A different question is sent to the LLM.
+        ask(cache, "get_list_operation", "prix moyen par mois en 2024 ?")
+        assert calls["llm"] == 2
+
+        # The stages outside of the allow-list never use the similarity tier, nor the embedding.
+        embedding_calls = calls["embedding"]
+        ask(cache, "get_interpretation", "table 2023 prix moyen")
+        ask(cache, "get_interpretation", "table 2024 prix moyen")
+        assert calls["llm"] == 4 and calls["embedding"] == embedding_calls
+
+        # Only max_entries stay in memory, the others are read from the disk, also by a new process.
+        assert len(cache.memory_cache) == 2
+        cache = ResponseCacheClient(cache_file=cache_file, embedding_function=fake_embedding, similarity_namespaces=["get_list_operation"])
+        ask(cache, "get_list_operation", "prix moyen par fournisseur ?")
+        ask(cache, "get_list_operation", "fournisseur prix moyen par ?")
+        assert calls["llm"] == 4
+
+        # The expired entries are not returned.
+        cache.ttl_seconds = 0
+        time.sleep(0.01)
+        ask(cache, "get_list_operation", "prix moyen par fournisseur ?")
+        assert calls["llm"] == 5
+        statistics = cache.get_statistics()
+        cache.connection.close()
+    return {"llm_calls": calls["llm"], "embedding_calls": calls["embedding"], **statistics}
+
+
+if __name__ == "__main__":
+    print(run_cache_check())
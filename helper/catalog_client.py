@@ -0,0 +1,254 @@
+"""
+A catalog of the tables the application works on : the tables described in a config file and the csv files
+found in the data folder. Each table is profiled (types, cardinalities, distinct values) in a single pass and
+the profile is cached next to the data. The profiles are used to write the description of the data in the prompts.
+"""
+
+import json
+import os
+
+import pandas as pd
+
+from helper.data_cache_client import DataCacheClient
+
+
+class CatalogClient:
+    """
+    A catalog of the tables the application works on.
+    """
+    # Catalog used when there is no config file in the data folder.
+    DEFAULT_CATALOG = {
+        "scan_data_folder": True,
+        "tables": {
+            "driver_ml": {
+                "description": "un dataframe qui contient les coefficients associés à chacun des drivers de coûts",
+                "keywords": ["driver", "coefficient", "importance", "explication", "expliquer", "cause", "cuivre", "plomb"],
+            },
+            "historical_sales_data": {
+                "description": "un dataframe présentant l'évolution des coûts réels en fonction des produits et des fournisseurs. Ce dataframe donne aussi des prédictions de prix.",
+                "keywords": ["prix", "fournisseur", "acheter", "achat", "stock", "mois", "année", "tendance", "évolution", "moyenne", "cuivre", "plomb"],
+            },
+            "variation_prediction_df": {
+                "description": "un dataframe qui décompose les prédictions des prix selon plusieurs criteres. Ce dataframe ne contient que les informations sur les predictions.",
+                "keywords": ["hausse", "baisse", "variation", "décomposer", "expliquer", "cuivre", "plomb"],
+                "columns": {
+                    "delta_price": "variation des prix des produits",
+                    "delta_wage": "part de la variation des prix dû aux salaires",
+                    "delta_electrical": "part de la variation des prix dû à l'énergie",
+                    "delta_treatment_price": "part de la variation des prix dû au traitement des produits",
+                    "delta_london_metal_exchange": "part de la variation des prix des produits à London Metal Exchange",
+                    "delta_mechanical": "part de la variation des prix dû à la mécanisation",
+                    "delta_replacement": "part de la variation des prix dû au remplacement du matériel par un autre",
+                    "delta_other": "part de la variation des prix d'étiers autres que les precedents",
+                },
+            },
+        },
+    }
+
+    def __init__(self, data_folder="data", separator=";", catalog_file=None, max_distinct_values=20, max_prompt_columns=40, chunk_size=None) -> None:
+        self.data_folder = data_folder
+        self.separator = separator
+        self.catalog_file = catalog_file or os.path.join(data_folder, "catalog.json")
+        # Columns with at most max_distinct_values values have their values listed in the prompts.
+        self.max_distinct_values = max_distinct_values
+        # Columns of a table described in the prompts at most, so that a wide table doesn't bloat every prompt.
+        self.max_prompt_columns = max_prompt_columns
+        self.data_cache_client = DataCacheClient(data_folder, separator)
+        # When the tables stay on disk (DATABASE_FILE), they are profiled by chunks of chunk_size rows.
+        self.chunk_size = chunk_size or (int(os.environ.get("DATABASE_CHUNK_SIZE", "100000")) if os.environ.get("DATABASE_FILE") else None)
+        self.catalog = self.read_catalog()
+        self.list_table_name = list(self.catalog["tables"])
+
+    def read_catalog(self):
+        """
+        Reads the config file and adds the csv files of the data folder which are not in it (unless
+        scan_data_folder is false). Tables listed in exclude are ignored.
+
+        no input
+
+        output:
+            (dict) {"tables": {table name: {"description": str, "keywords": list, "columns": {column: description}}}}
+        """
+        if os.path.exists(self.catalog_file):
+            with open(self.catalog_file, "r", encoding="utf-8") as f:
+                config = json.load(f)
+        else:
+            config = self.DEFAULT_CATALOG
+        tables = {table_name: dict(table_config) for table_name, table_config in config.get("tables", {}).items()}
+        if config.get("scan_data_folder", True) and os.path.isdir(self.data_folder):
+            for file_name in sorted(os.listdir(self.data_folder)):
+                table_name, extension = os.path.splitext(file_name)
+                if extension == ".csv" and table_name not in tables:
+                    tables[table_name] = {}
+        for table_name in config.get("exclude", []):
+            tables.pop(table_name, None)
+        return {"tables": tables}
+
+    def get_profile_path(self, table_name):
+        """
+        Returns the address of the cached profile of a table.
+
+        input:
+            table_name (str)
+
+        output:
+            (str)
+        """
+        return os.path.join(self.data_cache_client.cache_folder, f"{table_name}.profile.json")
+
+    def compute_profile(self, table):
+        """
+        Profiles a table : type, number of missing values and of distinct values of each column, the distinct
+        values of the columns having few of them (except measures) and the range of the numeric columns.
+
+        input:
+            table (pd.DataFrame)
+
+        output:
+            (dict) column -> profile
+        """
+        distinct_count = table.nunique()
+        missing_count = table.isna().sum()
+        numeric_table = table.select_dtypes("number")
+        numeric_range = numeric_table.agg(["min", "max"]) if not numeric_table.empty else pd.DataFrame()
+        profile = {}
+        for column in table.columns:
+            column_profile = {
+                "type": str(table[column].dtype),
+                "distinct_count": int(distinct_count[column]),
+                "missing_count": int(missing_count[column]),
+            }
+            if column in numeric_range.columns:
+                column_profile["min"] = numeric_range.at["min", column].item()
+                column_profile["max"] = numeric_range.at["max", column].item()
+            # The values of the measures (float columns) are not listed, even when there are few of them.
+            if distinct_count[column] <= self.max_distinct_values and not pd.api.types.is_float_dtype(table[column]):
+                values = [value.item() if hasattr(value, "item") else value for value in table[column].dropna().unique()]
+                try:
+                    column_profile["values"] = sorted(values)
+                except TypeError:
+                    # Column mixing several types.
+                    column_profile["values"] = sorted(values, key=str)
+            profile[column] = column_profile
+        return profile
+
+    def compute_profile_by_chunk(self, chunks):
+        """
+        Profiles a table read by chunks, without loading it entirely. Gives the same profile as compute_profile
+        except that the distinct values stop being counted once there are more than max_distinct_values of them
+        (distinct_count is then a lower bound).
+
+        input:
+            chunks (iterator of pd.DataFrame)
+
+        output:
+            (dict) column -> profile
+        """
+        column_type, missing_count, minimum, maximum, distinct_values = {}, {}, {}, {}, {}
+        for chunk in chunks:
+            chunk_missing_count = chunk.isna().sum()
+            numeric_chunk = chunk.select_dtypes("number")
+            numeric_range = numeric_chunk.agg(["min", "max"]) if not numeric_chunk.empty else pd.DataFrame()
+            for column in chunk.columns:
+                chunk_type = str(chunk[column].dtype)
+                if column_type.setdefault(column, chunk_type) != chunk_type:
+                    # A column can be read as integers in a chunk and as floats in another one.
+                    column_type[column] = "float64" if column in numeric_range.columns and column in minimum else "object"
+                missing_count[column] = missing_count.get(column, 0) + int(chunk_missing_count[column])
+                if column in numeric_range.columns:
+                    chunk_minimum, chunk_maximum = numeric_range.at["min", column].item(), numeric_range.at["max", column].item()
+                    minimum[column] = min(minimum.get(column, chunk_minimum), chunk_minimum)
+                    maximum[column] = max(maximum.get(column, chunk_maximum), chunk_maximum)
+                values = distinct_values.setdefault(column, set())
+                if len(values) <= self.max_distinct_values:
+                    values.update(value.item() if hasattr(value, "item") else value for value in chunk[column].dropna().unique())
+
+        profile = {}
+        for column, values in distinct_values.items():
+            column_profile = {"type": column_type[column], "distinct_count": len(values), "missing_count": missing_count[column]}
+            if column in minimum:
+                column_profile["min"], column_profile["max"] = minimum[column], maximum[column]
+            if len(values) <= self.max_distinct_values and not column_type[column].startswith("float"):
+                try:
+                    column_profile["values"] = sorted(values)
+                except TypeError:
+                    column_profile["values"] = sorted(values, key=str)
+            profile[column] = column_profile
+        return profile
+
+    def get_profile(self, table_name):
+        """
+        Returns the profile of a table, from the cache if the csv file didn't change since it was computed.
+
+        input:
+            table_name (str)
+
+        output:
+            (dict) column -> profile
+        """
+        file_stat = os.stat(self.data_cache_client.get_csv_path(table_name))
+        signature = [file_stat.st_mtime_ns, file_stat.st_size]
+        profile_path = self.get_profile_path(table_name)
+        if os.path.exists(profile_path):
+            with open(profile_path, "r", encoding="utf-8") as f:
+                cached_profile = json.load(f)
+            if cached_profile.get("signature") == signature:
+                return cached_profile["columns"]
+
+        if self.chunk_size is not None:
+            profile = self.compute_profile_by_chunk(pd.read_csv(self.data_cache_client.get_csv_path(table_name), sep=self.separator, chunksize=self.chunk_size))
+        else:
+            profile = self.compute_profile(self.data_cache_client.load_table(table_name))
+        os.makedirs(self.data_cache_client.cache_folder, exist_ok=True)
+        temporary_path = profile_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump({"signature": signature, "columns": profile}, f, ensure_ascii=False, default=str)
+        os.replace(temporary_path, profile_path)
+        return profile
+
+    def describe_column(self, column, column_profile, description=None):
+        """
+        Returns the line describing a column in the prompts.
+
+        input:
+            column (str)
+            column_profile (dict)
+            description (str)
+
+        output:
+            (str)
+        """
+        details = [description] if description else []
+        if "values" in column_profile and not description:
+            details.append("valeurs possibles : " + ", ".join(str(value) for value in column_profile["values"]))
+        return f"- {column} ({'; '.join(details)})" if details else f"- {column}"
+
+    def get_prompt_schema(self, list_table_name=None, columns=None):
+        """
+        Returns the description of the tables for the prompts of the LLM.
+
+        input:
+            list_table_name (list) tables to describe, all the tables of the catalog by default
+            columns (dict) table name -> columns to describe, the first max_prompt_columns columns by default
+
+        output:
+            (str)
+        """
+        descriptions = []
+        for table_name in list_table_name or self.list_table_name:
+            table_config = self.catalog["tables"][table_name]
+            profile = self.get_profile(table_name)
+            column_descriptions = table_config.get("columns", {})
+            described_columns = columns[table_name] if columns is not None and table_name in columns else list(profile)[:self.max_prompt_columns]
+            title = f"{table_name} ({table_config['description']})" if table_config.get("description") else table_name
+            lines = [f"            {title}:"]
+            lines += [f"                {self.describe_column(column, profile[column], column_descriptions.get(column))}" for column in described_columns]
+            if len(described_columns) < len(profile):
+                lines.append(f"                - ... ({len(profile) - len(described_columns)} autres colonnes non décrites)")
+            descriptions.append("\n".join(lines))
+        return "\n\n".join(descriptions)
+
+
+if __name__ == "__main__":
+    catalog_client = CatalogClient()
+    print(catalog_client.get_prompt_schema())
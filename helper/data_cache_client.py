@@ -0,0 +1,214 @@
+"""
+A client to convert our csv tables into a typed columnar cache (parquet), read faster than the csv files.
+Can be run as a build step : python -m helper.data_cache_client
+"""
+
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import threading
+
+import pandas as pd
+
+
+class BoundedReader(io.RawIOBase):
+    """
+    Reads only the first bytes of a binary file, to parse the part of a csv file present at a given time.
+    """
+    def __init__(self, f, size) -> None:
+        self.f = f
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.f.readinto(memoryview(buffer)[:max(self.remaining, 0)])
+        self.remaining -= count
+        return count
+
+
+class DataCacheClient:
+    """
+    A client to convert our csv tables into a typed columnar cache (parquet), read faster than the csv files.
+    """
+    # Only one thread of the process (re)builds the caches at a time.
+    _build_lock = threading.Lock()
+
+    def __init__(self, data_folder="data", separator=";", cache_folder=None) -> None:
+        self.data_folder = data_folder
+        self.separator = separator
+        self.cache_folder = cache_folder or os.path.join(data_folder, ".cache")
+        # Parquet needs pyarrow, without it we read the csv files directly.
+        self.use_parquet = importlib.util.find_spec("pyarrow") is not None
+
+    def get_csv_path(self, table_name):
+        """
+        Returns the address of the csv file of a table.
+
+        input:
+            table_name (str)
+
+        output:
+            (str)
+        """
+        return os.path.join(self.data_folder, f"{table_name}.csv")
+
+    def get_parquet_path(self, table_name):
+        """
+        Returns the address of the columnar cache of a table.
+
+        input:
+            table_name (str)
+
+        output:
+            (str)
+        """
+        return os.path.join(self.cache_folder, f"{table_name}.parquet")
+
+    def get_metadata_path(self, table_name):
+        """
+        Returns the address of the file describing which version of the csv file is in the cache.
+
+        input:
+            table_name (str)
+
+        output:
+            (str)
+        """
+        return os.path.join(self.cache_folder, f"{table_name}.json")
+
+    def compute_file_hash(self, address, size=None):
+        """
+        Computes the sha256 of the first size bytes of a file (the whole file if size is None), chunk by chunk
+        so that large files are not loaded in memory.
+
+        input:
+            address (str)
+            size (int)
+
+        output:
+            (str)
+        """
+        file_hash = hashlib.sha256()
+        with open(address, "rb") as f:
+            reader = io.BufferedReader(BoundedReader(f, size)) if size is not None else f
+            for chunk in iter(lambda: reader.read(1 << 20), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def read_csv(self, table_name, size=None, chunksize=None):
+        """
+        Reads the first size bytes of the csv file of a table, the whole file if size is None.
+
+        input:
+            table_name (str)
+            size (int)
+            chunksize (int) if set, the table is read by chunks of chunksize rows
+
+        output:
+            (pd.DataFrame or iterator of pd.DataFrame)
+        """
+        if chunksize is not None:
+            return self.read_csv_chunks(table_name, size, chunksize)
+        with open(self.get_csv_path(table_name), "rb") as f:
+            return pd.read_csv(io.BufferedReader(BoundedReader(f, size)) if size is not None else f, sep=self.separator)
+
+    def read_csv_chunks(self, table_name, size, chunksize):
+        # The file stays open until the last chunk is read.
+        with open(self.get_csv_path(table_name), "rb") as f:
+            yield from pd.read_csv(io.BufferedReader(BoundedReader(f, size)) if size is not None else f, sep=self.separator, chunksize=chunksize)
+
+    def read_metadata(self, table_name):
+        """
+        Reads the metadata of the cache of a table, returns an empty dict if there is no cache.
+
+        input:
+            table_name (str)
+
+        output:
+            (dict)
+        """
+        address = self.get_metadata_path(table_name)
+        if not os.path.exists(address) or not os.path.exists(self.get_parquet_path(table_name)):
+            return {}
+        with open(address, "r") as f:
+            return json.load(f)
+
+    def write_metadata(self, table_name, metadata):
+        """
+        Writes the metadata of the cache of a table.
+
+        input:
+            table_name (str)
+            metadata (dict)
+
+        no output
+        """
+        with open(self.get_metadata_path(table_name), "w") as f:
+            json.dump(metadata, f)
+
+    def build(self, table_name):
+        """
+        Makes sure the columnar cache of a table corresponds to its csv file and rebuilds it if needed.
+        The hash is only computed when the modification time or the size of the csv file changed.
+
+        input:
+            table_name (str)
+
+        output:
+            (str) hash of the csv file in the cache
+        """
+        csv_path = self.get_csv_path(table_name)
+        file_stat = os.stat(csv_path)
+        metadata = self.read_metadata(table_name)
+        if metadata.get("mtime_ns") == file_stat.st_mtime_ns and metadata.get("size") == file_stat.st_size:
+            return metadata["sha256"]
+
+        # Only the size taken above is hashed and read, so that the cache is exactly the version its metadata describes.
+        file_hash = self.compute_file_hash(csv_path, file_stat.st_size)
+        if metadata.get("sha256") != file_hash:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            table = self.read_csv(table_name, file_stat.st_size)
+            # We write in a temporary file first so that a session never reads a half written cache.
+            temporary_path = self.get_parquet_path(table_name) + ".tmp"
+            table.to_parquet(temporary_path, index=False)
+            os.replace(temporary_path, self.get_parquet_path(table_name))
+        self.write_metadata(table_name, {"mtime_ns": file_stat.st_mtime_ns, "size": file_stat.st_size, "sha256": file_hash})
+        return file_hash
+
+    def load_table(self, table_name, size=None):
+        """
+        Returns a table as a DataFrame, read from the columnar cache with memory mapping. The DataFrame is not
+        kept : once the SQL engine has loaded the table, the data is only held by the engine.
+        With size, only the first size bytes of the csv file are read, the cache is used if it holds exactly them.
+
+        input:
+            table_name (str)
+            size (int)
+
+        output:
+            (pd.DataFrame)
+        """
+        if not self.use_parquet:
+            return self.read_csv(table_name, size)
+
+        with self._build_lock:
+            self.build(table_name)
+            cache_size = self.read_metadata(table_name).get("size")
+        if size is not None and cache_size != size:
+            # The file changed since the size was taken.
+            return self.read_csv(table_name, size)
+        return pd.read_parquet(self.get_parquet_path(table_name), memory_map=True)
+
+
+if __name__ == "__main__":
+    from helper.catalog_client import CatalogClient
+
+    data_cache_client = DataCacheClient()
+    if not data_cache_client.use_parquet:
+        raise SystemExit("pyarrow is needed to build the columnar cache.")
+    for table_name in CatalogClient().list_table_name:
+        print(table_name, data_cache_client.build(table_name))
@@ -0,0 +1,437 @@
+"""
+A client to keep our data tables loaded in a long-lived SQL engine shared by every session.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from helper.data_cache_client import DataCacheClient
+from helper.guardrail_client import QueryRejectedError
+from helper.index_client import IndexClient
+from helper.ingestion_client import FileWatcherClient, IngestionClient
+from helper.resource_client import get_shared_resource
+from helper.rollup_client import RollupClient
+from helper.trace_client import TraceClient
+
+
+class DatabaseClient:
+    """
+    A client to keep our data tables loaded in a long-lived SQL engine shared by every session.
+    """
+    # Table of the engine describing which version of each csv file is loaded, kept when the engine is a file.
+    LOADED_FILE_TABLE = "engine_loaded_file"
+    # Actions allowed to the queries written by the LLM. The engine denies every other action (writes, schema
+    # changes, ATTACH, PRAGMA, transactions) whatever the checks of the query text let through.
+    READ_ACTIONS = frozenset([sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE])
+    DENIED_FUNCTIONS = frozenset(["load_extension"])
+
+    def __init__(self, list_table_name, data_folder="data", separator=";", database_file=None, chunk_size=None) -> None:
+        self.list_table_name = list(list_table_name)
+        self.data_folder = data_folder
+        self.separator = separator
+        # With a database file (DATABASE_FILE), the tables stay on disk : the csv files are loaded and the results
+        # read by chunks of chunk_size rows, the tables are never entirely in memory and are kept between restarts.
+        self.database_file = database_file or os.environ.get("DATABASE_FILE")
+        self.chunk_size = chunk_size or int(os.environ.get("DATABASE_CHUNK_SIZE", "100000"))
+        self.data_cache_client = DataCacheClient(data_folder, separator)
+        # Detects the rows appended to the csv files so that only them are loaded.
+        self.ingestion_client = IngestionClient(data_folder, separator)
+        # A single connection is shared between threads, every access goes through the lock.
+        self.connection = sqlite3.connect(self.database_file or ":memory:", check_same_thread=False)
+        # The connection is read only : a query can't change the data of the other sessions (or of the database
+        # file). Only the loading of the tables makes it writable, see writable.
+        self.connection.execute("PRAGMA query_only = ON")
+        # SQL_MAX_MEMORY_MB limits the heap of SQLite in the process (the tables count when they are in memory),
+        # a query going above is stopped by the engine.
+        self.max_memory_mb = float(os.environ["SQL_MAX_MEMORY_MB"]) if os.environ.get("SQL_MAX_MEMORY_MB") else None
+        if self.max_memory_mb is not None:
+            self.connection.execute(f"PRAGMA hard_heap_limit = {int(self.max_memory_mb * 1024 * 1024)}")
+        self.lock = threading.RLock()
+        # Signature (modification time, size) of each csv file currently loaded in the engine.
+        self.table_signature = {}
+        # Number of rows of each table, used to estimate the cost of the queries.
+        self.table_row_count = {}
+        # Secondary indexes, declared ones and ones created from the columns the queries filter on.
+        self.index_client = IndexClient()
+        # The adaptive indexes are created by a background thread, the session whose query reached the threshold
+        # doesn't wait for them.
+        self.index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index_creation")
+        self.trace_client = get_shared_resource("trace_client", TraceClient)
+        # Pre-aggregated tables of the sales history, the aggregate queries are rewritten to use them.
+        self.rollup_client = RollupClient()
+        self.data_version = 0
+        # Stamp identifying the loaded version of the data, used as a key by the caches.
+        self.data_stamp = None
+        if self.database_file is not None:
+            self.restore_loaded_files()
+        self.refresh()
+
+    @contextlib.contextmanager
+    def writable(self):
+        """
+        Makes the connection writable inside the block, to load the tables, the indexes and the rollups.
+        The lock is held during the block so that no query runs while the connection is writable.
+
+        no input
+
+        no output
+        """
+        with self.lock:
+            self.connection.execute("PRAGMA query_only = OFF")
+            try:
+                yield
+            finally:
+                self.connection.execute("PRAGMA query_only = ON")
+
+    @contextlib.contextmanager
+    def read_only_statements(self):
+        """
+        Only allows the read actions to the statements prepared inside the block, the others are denied by the
+        engine and raise QueryRejectedError. The lock is held during the block.
+
+        no input
+
+        no output
+        """
+        denied_actions = []
+
+        def authorize(action, argument_1, argument_2, database_name, trigger_name):
+            if action in self.READ_ACTIONS and not (action == sqlite3.SQLITE_FUNCTION and str(argument_2).lower() in self.DENIED_FUNCTIONS):
+                return sqlite3.SQLITE_OK
+            denied_actions.append(action)
+            return sqlite3.SQLITE_DENY
+
+        with self.lock:
+            self.connection.set_authorizer(authorize)
+            try:
+                yield
+            except Exception as e:
+                if denied_actions:
+                    raise QueryRejectedError("Seules les requêtes de lecture (SELECT) sont autorisées.") from e
+                raise
+            finally:
+                self.connection.set_authorizer(None)
+
+    def get_table_path(self, table_name):
+        """
+        Returns the address of the csv file of a table.
+
+        input:
+            table_name (str)
+
+        output:
+            (str)
+        """
+        return os.path.join(self.data_folder, f"{table_name}.csv")
+
+    def get_file_signature(self, table_name):
+        """
+        Returns a cheap signature of a csv file to know if it changed since it was loaded.
+
+        input:
+            table_name (str)
+
+        output:
+            (tuple)
+        """
+        file_stat = os.stat(self.get_table_path(table_name))
+        return (file_stat.st_mtime_ns, file_stat.st_size)
+
+    def restore_loaded_files(self):
+        """
+        Reads which version of each csv file is already in the database file, so that the tables which didn't
+        change are not loaded again.
+
+        no input
+
+        no output
+        """
+        with self.writable():
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.LOADED_FILE_TABLE} (table_name TEXT PRIMARY KEY, signature TEXT, state TEXT)")
+            for table_name, signature, state in self.connection.execute(f"SELECT table_name, signature, state FROM {self.LOADED_FILE_TABLE}").fetchall():
+                if table_name not in self.list_table_name:
+                    continue
+                state = json.loads(state)
+                state["header"] = state["header"].encode("latin-1")
+                self.ingestion_client.set_state(table_name, state)
+                self.table_signature[table_name] = tuple(json.loads(signature))
+            for table_name in list(self.table_signature) + [rollup_name for rollup_name in self.rollup_client.ROLLUPS if self.rollup_client.SOURCE_TABLE in self.table_signature]:
+                self.table_row_count[table_name] = self.connection.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0]
+            if self.table_signature:
+                self.data_stamp = hashlib.sha256(repr(sorted(self.table_signature.items())).encode("utf-8")).hexdigest()
+
+    def save_loaded_file(self, table_name):
+        """
+        Writes which version of a csv file is loaded in the database file.
+
+        input:
+            table_name (str)
+
+        no output
+        """
+        state = dict(self.ingestion_client.get_state(table_name))
+        state["header"] = state["header"].decode("latin-1")
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO {self.LOADED_FILE_TABLE} (table_name, signature, state) VALUES (?, ?, ?)",
+            (table_name, json.dumps(self.table_signature[table_name]), json.dumps(state)))
+
+    def load_table(self, table_name, table):
+        """
+        (Re)loads a whole table in the SQL engine.
+
+        input:
+            table_name (str)
+            table (pd.DataFrame or iterator of pd.DataFrame) the table or its chunks
+
+        no output
+        """
+        chunks = [table] if isinstance(table, pd.DataFrame) else table
+        if_exists = "replace"
+        row_count = 0
+        for chunk in chunks:
+            chunk.to_sql(table_name, self.connection, if_exists=if_exists, index=False)
+            if_exists = "append"
+            row_count += len(chunk)
+        self.table_row_count[table_name] = row_count
+        self.index_client.create_table_indexes(self.connection, table_name)
+        self.table_row_count.update(self.rollup_client.build(self.connection, table_name))
+
+    def append_rows(self, table_name, appended_rows):
+        """
+        Loads rows appended to a table in the SQL engine and updates the rollups with them.
+
+        input:
+            table_name (str)
+            appended_rows (pd.DataFrame)
+
+        no output
+        """
+        appended_rows.to_sql(table_name, self.connection, if_exists="append", index=False)
+        self.table_row_count[table_name] += len(appended_rows)
+        if table_name == self.rollup_client.SOURCE_TABLE:
+            delta_table_name = f"delta_{table_name}"
+            appended_rows.to_sql(delta_table_name, self.connection, if_exists="replace", index=False)
+            self.table_row_count.update(self.rollup_client.update(self.connection, table_name, delta_table_name))
+            self.connection.execute(f"DROP TABLE {delta_table_name}")
+
+    def read_change(self, table_name):
+        """
+        Reads what changed in the csv file of a table : the appended rows if the file was only appended to,
+        the whole table otherwise.
+
+        input:
+            table_name (str)
+
+        output:
+            (tuple) ("append", rows, start offset, new offset) or ("load", table, 0, offset)
+        """
+        appended = self.ingestion_client.read_appended_rows(table_name)
+        if appended is not None:
+            return ("append", *appended)
+        # Only the complete lines present when the size is taken are read : the rows appended during the read (and
+        # a line still being written) are loaded at the next refresh, from this offset.
+        offset = self.ingestion_client.get_complete_offset(table_name, os.path.getsize(self.get_table_path(table_name)))
+        if self.database_file is not None:
+            # The chunks are read while the table is loaded, the whole table is never in memory.
+            return ("load", self.data_cache_client.read_csv(table_name, offset, chunksize=self.chunk_size), 0, offset)
+        return ("load", self.data_cache_client.load_table(table_name, offset), 0, offset)
+
+    def refresh(self):
+        """
+        Loads the changes of the csv files since the last time they were loaded : only the appended rows when
+        the files were appended to, the whole tables when they were rewritten. The files are read without
+        holding the lock so the queries in flight are not blocked, the lock is only taken to apply the changes.
+
+        no input
+
+        output:
+            (bool) True if at least one table changed
+        """
+        changes = {}
+        for table_name in self.list_table_name:
+            signature = self.get_file_signature(table_name)
+            if self.table_signature.get(table_name) != signature:
+                changes[table_name] = (signature, self.read_change(table_name))
+        if not changes:
+            return False
+
+        with self.writable():
+            has_changed = False
+            for table_name, (signature, (kind, rows, start_offset, offset)) in changes.items():
+                if self.table_signature.get(table_name) == signature:
+                    # Another thread applied this change while we were reading the file.
+                    continue
+                if kind == "append":
+                    if self.ingestion_client.get_offset(table_name) != start_offset:
+                        # Another thread loaded a part of these rows, they are read again at the next refresh.
+                        continue
+                    if len(rows) > 0:
+                        self.append_rows(table_name, rows)
+                else:
+                    self.load_table(table_name, rows)
+                self.ingestion_client.mark_loaded(table_name, offset)
+                self.table_signature[table_name] = signature
+                if self.database_file is not None:
+                    self.save_loaded_file(table_name)
+                has_changed = True
+            if has_changed:
+                self.connection.commit()
+                self.data_version += 1
+                self.data_stamp = hashlib.sha256(repr(sorted(self.table_signature.items())).encode("utf-8")).hexdigest()
+            return has_changed
+
+    def record_query(self, sql_operation):
+        """
+        Logs the columns a query filters on in the background, indexes are created on the columns used often.
+        Returns right away : the queries wait for the lock only while an index is built, not the session which
+        ran this query.
+
+        input:
+            sql_operation (str)
+
+        output:
+            (concurrent.futures.Future) of the list of indexes created
+        """
+        return self.index_executor.submit(self.create_adaptive_indexes, sql_operation)
+
+    def create_adaptive_indexes(self, sql_operation):
+        """
+        Logs the columns a query filters on and creates the indexes on the columns which reach the threshold.
+        The creations and the failures are traced and shown on the diagnostics page.
+
+        input:
+            sql_operation (str)
+
+        output:
+            (list) indexes created
+        """
+        span = self.trace_client.start_span("index_creation")
+        try:
+            with self.writable():
+                created_indexes = self.index_client.record_query(self.connection, sql_operation, self.list_table_name)
+        except Exception as e:
+            self.trace_client.end_span(span, e)
+            raise
+        if created_indexes:
+            self.trace_client.add_attributes(span, indexes=len(created_indexes))
+            self.trace_client.end_span(span)
+        return created_indexes
+
+    def rewrite_on_rollup(self, sql_operation):
+        """
+        Rewrites an aggregate query on the sales history into a query on a rollup when they give the same result.
+        The original query is kept when the rewritten one can't be prepared.
+
+        input:
+            sql_operation (str)
+
+        output:
+            (str)
+        """
+        with self.lock:
+            source_columns = self.index_client.get_table_columns(self.connection, self.rollup_client.SOURCE_TABLE)
+        return self.rollup_client.rewrite(sql_operation, source_columns, prepare=lambda rewritten: self.explain(rewritten.strip().rstrip(";")))
+
+    def explain(self, sql_operation):
+        """
+        Returns the plan SQLite would use to run a query, without running it.
+
+        input:
+            sql_operation (str)
+
+        output:
+            (list) rows of EXPLAIN QUERY PLAN (id, parent, notused, detail)
+        """
+        with self.read_only_statements():
+            return self.connection.execute(f"EXPLAIN QUERY PLAN {sql_operation}").fetchall()
+
+    def read_query(self, sql_operation):
+        """
+        Runs a query and returns its result. With a database file, the result is read by chunks so that
+        only the final result is materialized.
+
+        input:
+            sql_operation (str)
+
+        output:
+            (pd.DataFrame)
+        """
+        if self.database_file is None:
+            return pd.read_sql_query(sql_operation, self.connection)
+        chunks = list(pd.read_sql_query(sql_operation, self.connection, chunksize=self.chunk_size))
+        return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else (chunks[0] if chunks else pd.DataFrame())
+
+    def execute(self, sql_operation, timeout_seconds=None, cancel_event=None):
+        """
+        Runs a SQL query on the loaded tables. Only read queries are allowed. The query is interrupted if it runs
+        for more than timeout_seconds, if the engine goes above SQL_MAX_MEMORY_MB or when cancel_event is set.
+        Only this query is interrupted, the queries of the other sessions sharing the connection go on.
+        The changes of the csv files are not loaded here : the caller refreshes the tables (see OperationClient.execute).
+
+        input:
+            sql_operation (str)
+            timeout_seconds (float)
+            cancel_event (threading.Event) set from another thread to cancel the query
+
+        output:
+            (pd.DataFrame)
+        """
+        with self.read_only_statements():
+            # The query may have been cancelled while it waited for the queries of the other sessions.
+            if cancel_event is not None and cancel_event.is_set():
+                raise QueryRejectedError("La requête a été annulée.")
+
+            deadline = time.monotonic() + timeout_seconds if timeout_seconds is not None else None
+            abort_reason = []
+
+            def check_limits():
+                if cancel_event is not None and cancel_event.is_set():
+                    abort_reason.append("La requête a été annulée.")
+                    return 1
+                if deadline is not None and time.monotonic() > deadline:
+                    abort_reason.append(f"La requête a dépassé le temps maximal d'exécution ({timeout_seconds} s).")
+                    return 1
+                return 0
+
+            # The handler is called every 100 000 SQLite instructions and interrupts the query when it returns 1.
+            self.connection.set_progress_handler(check_limits, 100000)
+            try:
+                return self.read_query(sql_operation)
+            except Exception as e:
+                if abort_reason:
+                    raise QueryRejectedError(abort_reason[0]) from e
+                # SQLite reports the heap limit as a MemoryError.
+                if self.max_memory_mb is not None and (isinstance(e, MemoryError) or "out of memory" in str(e)):
+                    raise QueryRejectedError(f"La requête a dépassé la mémoire maximale autorisée ({self.max_memory_mb:g} Mo).") from e
+                raise
+            finally:
+                self.connection.set_progress_handler(None, 0)
+
+
+def get_shared_database_client(list_table_name, data_folder="data", separator=";"):
+    """
+    Returns the database client shared by all the sessions of the process, creates it on first call.
+    If DATA_WATCH_INTERVAL is set, a watcher loads the changes of the csv files every DATA_WATCH_INTERVAL seconds.
+
+    input:
+        list_table_name (list)
+        data_folder (str)
+        separator (str)
+
+    output:
+        (DatabaseClient)
+    """
+    key = ("database_client", tuple(list_table_name), data_folder, separator)
+    database_client = get_shared_resource(key, lambda: DatabaseClient(list_table_name, data_folder, separator))
+    if os.environ.get("DATA_WATCH_INTERVAL"):
+        file_watcher_client = get_shared_resource(("file_watcher", key), lambda: FileWatcherClient(database_client, float(os.environ["DATA_WATCH_INTERVAL"])))
+        file_watcher_client.start()
+    return database_client
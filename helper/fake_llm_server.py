@@ -0,0 +1,201 @@
+"""
+A local fake of the Azure OpenAI chat completions API, injecting latency and errors, to test how the application
+behaves when the LLM is slow or throttled. The faults of each deployment are planned request by request, or drawn
+at random from rates. Point OPENAI_API_ENDPOINT at it :
+python -m helper.fake_llm_server --port 8765 --latency 0.5 --rate-limit-rate 0.2 --error-rate 0.1
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+
+
+class FakeLLMRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers the chat completion requests of the fake server.
+    """
+    def log_message(self, format, *args):
+        # The requests are counted by the server, they are not printed.
+        pass
+
+    def send_json(self, status, content, headers=None):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        match = re.match(r"/openai/deployments/([^/]+)/chat/completions", self.path)
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if match is None:
+            self.send_json(404, {"error": {"code": "DeploymentNotFound", "message": f"Unknown path {self.path}"}})
+            return
+        deployment = match.group(1)
+        fault = self.server.start_request(deployment)
+        try:
+            time.sleep(fault.get("latency", 0.0))
+        finally:
+            # The request is answered : the client may send its next request before the answer is written.
+            self.server.end_request(deployment)
+        try:
+            status = fault.get("status", 200)
+            if status == 429:
+                self.send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}}, {"Retry-After": str(fault.get("retry_after", 1))})
+            elif status != 200:
+                self.send_json(status, {"error": {"code": str(status), "message": "The server had an error while processing your request."}})
+            elif request.get("stream"):
+                self.send_stream(deployment, fault.get("content", self.server.content))
+            else:
+                self.send_json(200, self.server.get_completion(deployment, fault.get("content", self.server.content)))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up (deadline of the call).
+            pass
+
+    def send_stream(self, deployment, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": deployment,
+                     "choices": [{"index": 0, "delta": {"role": "assistant", "content": word if index == 0 else " " + word}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """
+    A local fake of the Azure OpenAI chat completions API. Each request of a deployment takes the next planned
+    fault of the deployment, or a fault drawn from the rates when none is planned. A fault is a dict with the
+    keys latency (seconds), status (HTTP status, 200 to answer), retry_after (seconds, for the 429 errors) and content.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, content="ok", latency=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1, seed=42) -> None:
+        super().__init__(("127.0.0.1", port), FakeLLMRequestHandler)
+        self.content = content
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.planned_faults = {}
+        # Requests and errors per deployment, and the most requests waiting for their answer at the same time.
+        self.statistics = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def plan(self, deployment, faults):
+        """
+        Plans the faults of the next requests of a deployment.
+
+        input:
+            deployment (str)
+            faults (list) of dict
+
+        no output
+        """
+        with self.lock:
+            self.planned_faults.setdefault(deployment, []).extend(faults)
+
+    def start_request(self, deployment):
+        """
+        Counts a request and returns its fault.
+
+        input:
+            deployment (str)
+
+        output:
+            (dict)
+        """
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            statistics = self.statistics.setdefault(deployment, {"requests": 0, "errors": 0})
+            statistics["requests"] += 1
+            if self.planned_faults.get(deployment):
+                fault = self.planned_faults[deployment].pop(0)
+            else:
+                draw = self.random.random()
+                if draw < self.rate_limit_rate:
+                    fault = {"latency": self.latency, "status": 429, "retry_after": self.retry_after}
+                elif draw < self.rate_limit_rate + self.error_rate:
+                    fault = {"latency": self.latency, "status": 500}
+                else:
+                    fault = {"latency": self.latency}
+            if fault.get("status", 200) != 200:
+                statistics["errors"] += 1
+            return fault
+
+    def end_request(self, deployment):
+        with self.lock:
+            self.in_flight -= 1
+
+    @staticmethod
+    def get_completion(deployment, content):
+        """
+        Returns a chat completion in the format of the API.
+
+        input:
+            deployment (str)
+            content (str)
+
+        output:
+            (dict)
+        """
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": len(content.split()), "total_tokens": 10 + len(content.split())},
+        }
+
+    def start(self):
+        """
+        Serves the requests in a background thread.
+
+        no input
+
+        output:
+            (FakeLLMServer)
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a fake Azure OpenAI chat completions API injecting latency and errors.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--content", default="ok", help="answer of every request")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the requests answered with an error 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of the requests answered with an error 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After header of the 429 errors, in seconds")
+    arguments = parser.parse_args()
+
+    fake_llm_server = FakeLLMServer(arguments.port, arguments.content, arguments.latency, arguments.error_rate, arguments.rate_limit_rate, arguments.retry_after)
+    print(f"Fake LLM server listening on {fake_llm_server.endpoint}")
+    try:
+        fake_llm_server.serve_forever()
+    except KeyboardInterrupt:
+        fake_llm_server.server_close()
@@ -0,0 +1,240 @@
+"""
+A client to reduce the data sent to the browser by the figures of large results : the line and scatter series are
+downsampled (LTTB or min-max), the histograms are binned in NumPy and WebGL is used above a number of points.
+Can be run to benchmark the figures : python -m helper.figure_render_client
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class FigureRenderClient:
+    """
+    A client to reduce the data sent to the browser by the figures of large results.
+    """
+    def __init__(self, max_points_per_series=None, webgl_threshold=None, histogram_bins=50, line_method="lttb", scatter_method="min_max") -> None:
+        # Series having more points are downsampled to max_points_per_series points.
+        self.max_points_per_series = max_points_per_series or int(os.environ.get("FIGURE_MAX_POINTS_PER_SERIES", "2000"))
+        # Figures drawing more points are rendered with WebGL (Scattergl).
+        self.webgl_threshold = webgl_threshold or int(os.environ.get("FIGURE_WEBGL_THRESHOLD", "5000"))
+        self.histogram_bins = histogram_bins
+        # LTTB keeps the shape of a line, min-max keeps the extreme points of a cloud.
+        self.line_method = line_method
+        self.scatter_method = scatter_method
+
+    @staticmethod
+    def to_numeric_axis(values):
+        """
+        Converts the values of an axis into floats to compare the points : numbers are kept, dates are converted
+        into timestamps and other values are replaced by their position.
+
+        input:
+            values (pd.Series)
+
+        output:
+            (np.ndarray)
+        """
+        if pd.api.types.is_numeric_dtype(values):
+            return values.to_numpy(dtype=float)
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return values.astype("int64").to_numpy(dtype=float)
+        dates = pd.to_datetime(values, errors="coerce", format="mixed")
+        if dates.notna().all():
+            return dates.astype("int64").to_numpy(dtype=float)
+        return np.arange(len(values), dtype=float)
+
+    @staticmethod
+    def lttb_indices(x, y, point_count, preselection_ratio=4):
+        """
+        Selects point_count points of a series with the Largest Triangle Three Buckets algorithm : the points are
+        split into buckets and the point of each bucket forming the largest triangle with the point selected in
+        the previous bucket and the mean of the next bucket is kept.
+        The buckets are computed at once with NumPy : a first pass selects the points against the mean of the
+        previous bucket, a second pass against the point selected in it by the first pass. Series longer than
+        preselection_ratio * point_count are first reduced to their minimum and maximum points (MinMaxLTTB).
+
+        input:
+            x (np.ndarray) sorted
+            y (np.ndarray)
+            point_count (int)
+            preselection_ratio (int)
+
+        output:
+            (np.ndarray) indices of the selected points
+        """
+        length = len(x)
+        if point_count >= length or point_count < 3:
+            return np.arange(length)
+        candidates = np.arange(length)
+        if length > preselection_ratio * point_count:
+            candidates = np.concatenate([[0], FigureRenderClient.min_max_indices(y[1:-1], preselection_ratio * point_count) + 1, [length - 1]])
+            x, y, length = x[candidates], y[candidates], len(candidates)
+
+        # Buckets of the inner points, padded to the same size with their first point.
+        edges = np.linspace(1, length - 1, point_count - 1).astype(int)
+        sizes = np.diff(edges)
+        positions = edges[:-1, None] + np.arange(sizes.max())
+        is_valid = positions < edges[1:, None]
+        positions = np.where(is_valid, positions, edges[:-1, None])
+        bucket_x, bucket_y = x[positions], y[positions]
+        mean_x = np.add.reduceat(x[1:length - 1], edges[:-1] - 1) / sizes
+        mean_y = np.add.reduceat(y[1:length - 1], edges[:-1] - 1) / sizes
+        next_x, next_y = np.append(mean_x[1:], x[-1]), np.append(mean_y[1:], y[-1])
+        previous_x, previous_y = np.insert(mean_x[:-1], 0, x[0]), np.insert(mean_y[:-1], 0, y[0])
+        for _ in range(2):
+            area = np.abs((previous_x - next_x)[:, None] * (bucket_y - previous_y[:, None])
+                          - (previous_x[:, None] - bucket_x) * (next_y - previous_y)[:, None])
+            area[~is_valid] = -1
+            selected = positions[np.arange(len(positions)), np.argmax(area, axis=1)]
+            previous_x, previous_y = np.insert(x[selected[:-1]], 0, x[0]), np.insert(y[selected[:-1]], 0, y[0])
+        return candidates[np.concatenate([[0], selected, [length - 1]])]
+
+    @staticmethod
+    def min_max_indices(y, point_count):
+        """
+        Selects about point_count points of a series by keeping the minimum and the maximum of each bucket.
+        The buckets have the same size (the remaining points form an additional bucket) and are computed at once.
+
+        input:
+            y (np.ndarray) values sorted along the x axis
+            point_count (int)
+
+        output:
+            (np.ndarray) indices of the selected points
+        """
+        length = len(y)
+        if point_count >= length or point_count < 2:
+            return np.arange(length)
+        bucket_count = point_count // 2
+        bucket_size = length // bucket_count
+        buckets = y[:bucket_count * bucket_size].reshape(bucket_count, bucket_size)
+        starts = np.arange(bucket_count) * bucket_size
+        indices = [starts + buckets.argmin(axis=1), starts + buckets.argmax(axis=1)]
+        if bucket_count * bucket_size < length:
+            remaining = y[bucket_count * bucket_size:]
+            indices.append(bucket_count * bucket_size + np.array([remaining.argmin(), remaining.argmax()]))
+        return np.unique(np.concatenate(indices))
+
+    def downsample(self, result, x_column, y_column, color_column=None, method="lttb"):
+        """
+        Downsamples each series (one per value of the color column) of a result having more than
+        max_points_per_series points. Smaller series are returned as they are.
+
+        input:
+            result (pd.DataFrame)
+            x_column (str)
+            y_column (str)
+            color_column (str)
+            method (str) lttb or min_max
+
+        output:
+            (pd.DataFrame)
+        """
+        if x_column not in result.columns or y_column not in result.columns or not pd.api.types.is_numeric_dtype(result[y_column]):
+            return result
+        groups = result.groupby(color_column, sort=False, dropna=False) if color_column in result.columns else [(None, result)]
+        if all(len(series) <= self.max_points_per_series for _, series in groups):
+            return result
+
+        downsampled = []
+        for _, series in groups:
+            series = series.dropna(subset=[y_column])
+            if len(series) <= self.max_points_per_series:
+                downsampled.append(series)
+                continue
+            x = self.to_numeric_axis(series[x_column])
+            order = np.argsort(x, kind="stable")
+            series, x = series.iloc[order], x[order]
+            y = series[y_column].to_numpy(dtype=float)
+            if method == "min_max":
+                indices = self.min_max_indices(y, self.max_points_per_series)
+            else:
+                indices = self.lttb_indices(x, y, self.max_points_per_series)
+            downsampled.append(series.iloc[indices])
+        return pd.concat(downsampled)
+
+    def bin_histogram(self, result, x_column, y_column=None, color_column=None):
+        """
+        Aggregates the rows of a histogram : a numeric x axis is split into histogram_bins bins with NumPy,
+        other values are grouped. The y values are summed (like plotly histograms) or the rows are counted.
+
+        input:
+            result (pd.DataFrame)
+            x_column (str)
+            y_column (str)
+            color_column (str)
+
+        output:
+            (pd.DataFrame) with the columns x_column, y_column (or "count"), color_column and, for numeric x, "width"
+        """
+        value_column = y_column if y_column in result.columns else "count"
+        groups = result.groupby(color_column, sort=False, dropna=False) if color_column in result.columns else [(None, result)]
+        if not pd.api.types.is_numeric_dtype(result[x_column]):
+            keys = [x_column] + ([color_column] if color_column in result.columns and color_column != x_column else [])
+            if value_column == "count":
+                return result.groupby(keys, sort=False, dropna=False).size().reset_index(name="count")
+            return result.groupby(keys, sort=False, dropna=False)[value_column].sum().reset_index()
+
+        x = result[x_column].to_numpy(dtype=float)
+        edges = np.histogram_bin_edges(x[~np.isnan(x)], bins=self.histogram_bins)
+        binned = []
+        for color, series in groups:
+            weights = series[value_column].to_numpy(dtype=float) if value_column != "count" else None
+            values, _ = np.histogram(series[x_column].to_numpy(dtype=float), bins=edges, weights=np.nan_to_num(weights) if weights is not None else None)
+            table = pd.DataFrame({x_column: (edges[:-1] + edges[1:]) / 2, value_column: values, "width": np.diff(edges)})
+            if color_column in result.columns:
+                table[color_column] = color
+            binned.append(table)
+        return pd.concat(binned, ignore_index=True)
+
+    def get_render_mode(self, point_count):
+        """
+        Returns the plotly render mode of a figure drawing point_count points.
+
+        input:
+            point_count (int)
+
+        output:
+            (str) webgl or svg
+        """
+        return "webgl" if point_count > self.webgl_threshold else "svg"
+
+
+def run_benchmark(row_counts=(1000, 10000, 100000, 500000), series_count=5):
+    """
+    Prints the size of the json of a line figure and the time to build and serialize it, with and without the
+    reduction of the points, for several numbers of rows.
+
+    input:
+        row_counts (tuple)
+        series_count (int)
+
+    no output
+    """
+    import time
+
+    import plotly.express as px
+
+    figure_render_client = FigureRenderClient()
+    print("rows\tjson_kb_raw\tseconds_raw\tjson_kb_reduced\tseconds_reduced")
+    for row_count in row_counts:
+        rng = np.random.default_rng(42)
+        result = pd.DataFrame({
+            "date": np.tile(pd.date_range("2000-01-01", periods=row_count // series_count, freq="h"), series_count),
+            "price": rng.normal(0, 1, row_count // series_count * series_count).cumsum(),
+            "provider": np.repeat([f"provider {i}" for i in range(series_count)], row_count // series_count),
+        })
+        measures = []
+        for reduce in (False, True):
+            start = time.perf_counter()
+            figure_result = figure_render_client.downsample(result, "date", "price", "provider") if reduce else result
+            render_mode = figure_render_client.get_render_mode(len(figure_result)) if reduce else "auto"
+            figure_json = px.line(figure_result, x="date", y="price", color="provider", render_mode=render_mode).to_json()
+            measures.append((len(figure_json) / 1024, time.perf_counter() - start))
+        print(f"{row_count}\t{measures[0][0]:.0f}\t{measures[0][1]:.2f}\t{measures[1][0]:.0f}\t{measures[1][1]:.2f}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,207 @@
+"""
+A client to check the figure templates written by the LLM against the result of the query before plotting them.
+Column names which almost match a column of the result are fixed and a figure type is inferred when it is unknown,
+so that the LLM is only asked to fix the template when the problem can't be fixed locally.
+"""
+
+import difflib
+import re
+import threading
+import unicodedata
+
+import pandas as pd
+
+
+class FigureSpecError(ValueError):
+    """
+    Raised when a figure template doesn't match the result of the query.
+    """
+
+
+class FigureSpecClient:
+    """
+    A client to check the figure templates written by the LLM against the result of the query.
+    """
+    # Figure types built by OperationClient.build_figure (the other plotly express functions taking x, y and color also work).
+    FIGURE_TYPES = ("bar", "histogram", "scatter", "pie", "line", "area", "box", "violin", "funnel", "strip")
+    # French words the LLM sometimes uses instead of the column names.
+    ALIASES = {
+        "prix": "price", "fournisseur": "provider", "pays": "country", "produit": "product", "annee": "year",
+        "mois": "month", "valeur": "value", "jour": "date", "moyenne": "avg", "somme": "sum",
+    }
+    TIME_COLUMNS = ("date", "year", "month", "annee", "mois")
+
+    def __init__(self, similarity_cutoff=0.8) -> None:
+        self.similarity_cutoff = similarity_cutoff
+        # Outcome of the figures built from the LLM templates, to measure the calls to the LLM per figure.
+        self.statistics = {"valid": 0, "repaired_locally": 0, "repaired_by_llm": 0, "failed": 0, "template_calls": 0}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def normalize(cls, name):
+        """
+        Normalizes a column name : without table prefix, accents, case and special characters (AVG(h.price) -> avg_price).
+
+        input:
+            name (str)
+
+        output:
+            (str)
+        """
+        name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").lower()
+        name = re.sub(r"\b\w+\.(?=\w)", "", name)
+        return "_".join(re.findall(r"[a-z0-9]+", name))
+
+    def match_column(self, name, columns):
+        """
+        Returns the column of the result a name refers to : the same name, the same name with another case or
+        writing, a translated name, a close name or the only column containing the name. None if there is no match.
+
+        input:
+            name (str)
+            columns (list)
+
+        output:
+            (str) or None
+        """
+        if not name:
+            return None
+        if name in columns:
+            return name
+        normalized_columns = {self.normalize(column): column for column in columns}
+        normalized_name = self.normalize(name)
+        translated_name = "_".join(self.ALIASES.get(word, word) for word in normalized_name.split("_"))
+        for candidate in (normalized_name, translated_name):
+            if candidate in normalized_columns:
+                return normalized_columns[candidate]
+        close_names = difflib.get_close_matches(translated_name, list(normalized_columns), n=1, cutoff=self.similarity_cutoff)
+        if close_names:
+            return normalized_columns[close_names[0]]
+        name_words = set(translated_name.split("_"))
+        containing_columns = [column for normalized_column, column in normalized_columns.items() if name_words <= set(normalized_column.split("_")) or set(normalized_column.split("_")) <= name_words]
+        return containing_columns[0] if len(containing_columns) == 1 else None
+
+    def infer_figure_type(self, result, x_column, y_column):
+        """
+        Returns a sensible figure type for two columns : a line for a time axis, bars for categories, a scatter plot
+        for two numeric columns.
+
+        input:
+            result (pd.DataFrame)
+            x_column (str)
+            y_column (str)
+
+        output:
+            (str)
+        """
+        if x_column is None or y_column is None:
+            return "bar"
+        if pd.api.types.is_datetime64_any_dtype(result[x_column]) or self.normalize(x_column) in self.TIME_COLUMNS:
+            return "line"
+        if pd.api.types.is_numeric_dtype(result[x_column]) and pd.api.types.is_numeric_dtype(result[y_column]):
+            return "scatter"
+        return "bar"
+
+    def repair(self, figure_instruction, result):
+        """
+        Checks a figure template against the result of the query and fixes what can be fixed locally.
+
+        input:
+            figure_instruction (dict) with the keys figure_type, x_label, y_label, color and title
+            result (pd.DataFrame)
+
+        output:
+            (dict) the fixed template, its labels are columns of the result (color can be None)
+            (list) of str, the problems which couldn't be fixed
+        """
+        columns = list(result.columns)
+        numeric_columns = [column for column in columns if pd.api.types.is_numeric_dtype(result[column])]
+        problems = []
+        repaired = dict(figure_instruction)
+        repaired.setdefault("title", "")
+
+        x_column = self.match_column(figure_instruction.get("x_label"), columns)
+        y_column = self.match_column(figure_instruction.get("y_label"), columns)
+        if y_column is None or (y_column not in numeric_columns and figure_instruction.get("figure_type") != "histogram"):
+            # The only numeric column which is not on the x axis is the natural y axis.
+            candidates = [column for column in numeric_columns if column != x_column]
+            y_column = candidates[0] if len(candidates) == 1 else None
+        if x_column is None:
+            candidates = [column for column in columns if column != y_column and column not in numeric_columns] or [column for column in columns if column != y_column]
+            x_column = candidates[0] if len(candidates) >= 1 else None
+        if x_column is None:
+            problems.append(f"La colonne {figure_instruction.get('x_label')} de l'axe des abscisses n'existe pas dans le résultat.")
+        if y_column is None:
+            problems.append(f"La colonne {figure_instruction.get('y_label')} de l'axe des ordonnées n'existe pas dans le résultat ou n'est pas numérique.")
+        # The color is optional, an unknown color column is dropped.
+        color_column = self.match_column(figure_instruction.get("color"), columns)
+
+        figure_type = str(figure_instruction.get("figure_type", "")).lower().strip()
+        if figure_type not in self.FIGURE_TYPES and not problems:
+            figure_type = self.infer_figure_type(result, x_column, y_column)
+        repaired.update({"figure_type": figure_type, "x_label": x_column, "y_label": y_column, "color": color_column})
+        return repaired, problems
+
+    def get_default_template(self, result, title=""):
+        """
+        Chooses a figure for a result without the LLM : the first text or time column on the x axis, the first
+        numeric column on the y axis and the next text column as color.
+
+        input:
+            result (pd.DataFrame)
+            title (str)
+
+        output:
+            (dict) a figure template
+        """
+        numeric_columns = [column for column in result.columns if pd.api.types.is_numeric_dtype(result[column])]
+        time_columns = [column for column in result.columns if self.normalize(column) in self.TIME_COLUMNS]
+        other_columns = [column for column in result.columns if column not in numeric_columns and column not in time_columns]
+        x_column = (time_columns + other_columns + list(result.columns))[0] if len(result.columns) else None
+        y_column = next((column for column in numeric_columns if column != x_column), None)
+        color_column = next((column for column in other_columns if column != x_column), None)
+        figure_type = self.infer_figure_type(result, x_column, y_column)
+        return {"figure_type": figure_type, "title": title, "x_label": x_column, "y_label": y_column, "color": color_column}
+
+    def describe_result(self, result):
+        """
+        Describes the columns of a result and their types for the repair prompt.
+
+        input:
+            result (pd.DataFrame)
+
+        output:
+            (str)
+        """
+        return ", ".join(f"{column} ({'numérique' if pd.api.types.is_numeric_dtype(result[column]) else 'texte'})" for column in result.columns)
+
+    def record(self, outcome, template_calls):
+        """
+        Counts the outcome of a figure built from a template of the LLM.
+
+        input:
+            outcome (str) valid, repaired_locally, repaired_by_llm or failed
+            template_calls (int) calls to the LLM which wrote the SQL query and the template (2, 1 in the combined flow)
+
+        no output
+        """
+        with self.lock:
+            self.statistics[outcome] += 1
+            self.statistics["template_calls"] += template_calls
+
+    def get_statistics(self):
+        """
+        Returns the outcomes of the figures and the number of calls to the LLM per successful figure
+        (the calls of the flow of each figure plus the repair calls).
+
+        no input
+
+        output:
+            (dict)
+        """
+        with self.lock:
+            statistics = dict(self.statistics)
+        successes = statistics["valid"] + statistics["repaired_locally"] + statistics["repaired_by_llm"]
+        llm_calls = statistics["template_calls"] + statistics["repaired_by_llm"] + statistics["failed"]
+        statistics["llm_calls_per_figure"] = llm_calls / successes if successes else 0.0
+        return statistics
@@ -0,0 +1,342 @@
+"""
+A client to check the SQL queries written by the LLM before running them : only read queries are allowed,
+the cost of the query is estimated with EXPLAIN QUERY PLAN and the number of returned rows is limited.
+The engine denies anything else than reading anyway (see DatabaseClient.read_only_statements).
+A corpus of queries which must be rejected or bounded can be checked : python -m helper.guardrail_client
+"""
+
+import os
+import re
+
+try:
+    import sqlglot
+    from sqlglot import expressions
+    from sqlglot.tokens import TokenType
+except ImportError:
+    sqlglot = None
+
+
+class QueryRejectedError(ValueError):
+    """
+    Raised when a query is not allowed to run on the data.
+    """
+
+
+class GuardrailClient:
+    """
+    A client to check the SQL queries written by the LLM before running them.
+    """
+    READ_QUERY_PATTERN = re.compile(r"^\s*(?:--[^\n]*\n\s*|/\*.*?\*/\s*)*(select|with|values)\b", re.IGNORECASE | re.DOTALL)
+    TABLE_ALIAS_PATTERN = re.compile(r"(?:\bfrom|\bjoin|,)\s+(\w+)(?:\s+(?:as\s+)?(?!(?:from|where|join|on|using|group|order|limit|inner|left|right|cross|natural|full|union)\b)(\w+))?", re.IGNORECASE)
+    # Without sqlglot, the comments after the LIMIT are not removed.
+    LIMIT_PATTERN = re.compile(r"\blimit\s+\d+(?:\s*(?:offset|,)\s*\d+)?\s*;?\s*(?:--[^\n]*)?$", re.IGNORECASE)
+
+    # Comparisons which can join two tables.
+    JOIN_COMPARISONS = ("EQ", "NEQ", "GT", "GTE", "LT", "LTE")
+
+    def __init__(self, max_result_rows=None, figure_max_result_rows=None, max_estimated_rows=None, timeout_seconds=None, sql_parser=sqlglot) -> None:
+        # Number of rows returned at most by a query (a LIMIT is added when the query has none). The figures
+        # reduce their points themselves so their queries return more rows.
+        self.max_result_rows = max_result_rows or int(os.environ.get("SQL_MAX_RESULT_ROWS", "10000"))
+        self.figure_max_result_rows = figure_max_result_rows or int(os.environ.get("SQL_FIGURE_MAX_RESULT_ROWS", "1000000"))
+        # Estimated number of rows read by a query above which it is rejected.
+        self.max_estimated_rows = max_estimated_rows or float(os.environ.get("SQL_MAX_ESTIMATED_ROWS", "1e9"))
+        # Limit applied while the query runs (the memory is limited by the engine, see SQL_MAX_MEMORY_MB).
+        self.timeout_seconds = timeout_seconds or float(os.environ.get("SQL_TIMEOUT_SECONDS", "20"))
+        # sqlglot, or None to check the queries with regular expressions only.
+        self.sql_parser = sql_parser
+
+    def check_statement(self, sql_operation):
+        """
+        Checks that a query is a single read query and that its joins have a join condition.
+
+        input:
+            sql_operation (str)
+
+        no output (raises QueryRejectedError)
+        """
+        if self.sql_parser is None:
+            statements = [statement for statement in sql_operation.strip().rstrip(";").split(";") if statement.strip()]
+            if len(statements) != 1 or not self.READ_QUERY_PATTERN.match(statements[0]):
+                raise QueryRejectedError("Seules les requêtes de lecture (SELECT) sont autorisées.")
+            return
+
+        try:
+            statements = [statement for statement in self.sql_parser.parse(sql_operation, read="sqlite") if statement is not None]
+        except self.sql_parser.errors.ParseError as e:
+            raise QueryRejectedError(f"La requête n'a pas pu être analysée : {e}")
+        if len(statements) != 1 or not isinstance(statements[0], (expressions.Select, expressions.Union)):
+            raise QueryRejectedError("Seules les requêtes de lecture (SELECT) sont autorisées.")
+        for select in statements[0].find_all(expressions.Select):
+            if self.has_cartesian_join(select):
+                raise QueryRejectedError("La requête contient une jointure sans condition (produit cartésien).")
+
+    @classmethod
+    def is_join_comparison(cls, comparison, joined_name, allow_unqualified):
+        """
+        Checks if a comparison compares a column of the joined table with a column of another table.
+
+        input:
+            comparison (sqlglot Expression)
+            joined_name (str) name or alias of the joined table
+            allow_unqualified (bool) columns without table count as columns of different tables (join conditions)
+
+        output:
+            (bool)
+        """
+        if type(comparison).__name__ not in cls.JOIN_COMPARISONS:
+            return False
+        columns = [operand for operand in (comparison.left, comparison.right) if isinstance(operand, expressions.Column)]
+        if len(columns) != 2:
+            return False
+        if columns[0].table and columns[1].table:
+            return columns[0].table != columns[1].table and joined_name in (columns[0].table, columns[1].table)
+        return allow_unqualified and columns[0].sql() != columns[1].sql()
+
+    @classmethod
+    def has_cartesian_join(cls, select):
+        """
+        Checks if a select joins a table without a join condition, neither in the join nor in the where clause.
+        A join condition compares a column of the joined table with a column of another table : ON TRUE or
+        ON 1 = 1 is no condition.
+
+        input:
+            select (sqlglot Select)
+
+        output:
+            (bool)
+        """
+        where = select.args.get("where")
+        for join in select.args.get("joins") or []:
+            if join.args.get("using"):
+                continue
+            joined_name = join.this.alias_or_name
+            on = join.args.get("on")
+            if on is not None and any(cls.is_join_comparison(comparison, joined_name, True) for comparison in on.walk()):
+                continue
+            if where is not None and any(cls.is_join_comparison(comparison, joined_name, False) for comparison in where.walk()):
+                continue
+            return True
+        return False
+
+    def get_table_aliases(self, sql_operation):
+        """
+        Returns the tables referenced by their alias in a query.
+
+        input:
+            sql_operation (str)
+
+        output:
+            (dict) alias -> table name
+        """
+        aliases = {}
+        for table_name, alias in self.TABLE_ALIAS_PATTERN.findall(sql_operation):
+            aliases[table_name] = table_name
+            if alias:
+                aliases[alias] = table_name
+        return aliases
+
+    def estimate_cost(self, query_plan, sql_operation, table_row_count):
+        """
+        Estimates the number of rows read by a query from its plan. Tables scanned in the same loop multiply
+        their number of rows (nested loops), searches through an index count as one row.
+
+        input:
+            query_plan (list) rows of EXPLAIN QUERY PLAN (id, parent, notused, detail)
+            sql_operation (str)
+            table_row_count (dict) table name -> number of rows
+
+        output:
+            (float)
+        """
+        aliases = self.get_table_aliases(sql_operation)
+        loop_cost = {}
+        for _, parent, _, detail in query_plan:
+            match = re.match(r"SCAN (\w+)", detail)
+            if match is None:
+                continue
+            # Unknown names (common table expressions, subqueries) count as one row, the runtime limits protect us.
+            row_count = table_row_count.get(aliases.get(match.group(1), match.group(1)), 1)
+            loop_cost[parent] = loop_cost.get(parent, 1) * max(row_count, 1)
+        return float(sum(loop_cost.values()))
+
+    def strip_query_end(self, sql_operation):
+        """
+        Removes the semicolons, and with sqlglot the comments, which follow the last token of a query.
+
+        input:
+            sql_operation (str)
+
+        output:
+            (str)
+        """
+        sql_operation = sql_operation.strip()
+        if self.sql_parser is not None:
+            try:
+                tokens = [token for token in self.sql_parser.tokenize(sql_operation, read="sqlite") if token.token_type != TokenType.SEMICOLON]
+            except self.sql_parser.errors.TokenError:
+                tokens = []
+            if tokens:
+                return sql_operation[:tokens[-1].end + 1]
+        return sql_operation.rstrip(";").strip()
+
+    def add_limit(self, sql_operation, max_result_rows=None):
+        """
+        Adds a LIMIT to a query that doesn't have one at its end. The limit is one row above max_result_rows so
+        that truncate can tell if rows were left out.
+
+        input:
+            sql_operation (str)
+            max_result_rows (int) default : self.max_result_rows
+
+        output:
+            (str)
+        """
+        sql_operation = self.strip_query_end(sql_operation)
+        if self.LIMIT_PATTERN.search(sql_operation):
+            return sql_operation
+        # On a new line in case the query ends with a comment.
+        return f"{sql_operation}\nLIMIT {(max_result_rows or self.max_result_rows) + 1}"
+
+    def prepare_query(self, sql_operation, query_plan, table_row_count, max_result_rows=None):
+        """
+        Checks a query, estimates its cost and adds a LIMIT. Returns the query to run.
+
+        input:
+            sql_operation (str)
+            query_plan (list) rows of EXPLAIN QUERY PLAN
+            table_row_count (dict)
+            max_result_rows (int) default : self.max_result_rows
+
+        output:
+            (str)
+        """
+        estimated_rows = self.estimate_cost(query_plan, sql_operation, table_row_count)
+        if estimated_rows > self.max_estimated_rows:
+            raise QueryRejectedError(f"La requête est trop coûteuse (environ {estimated_rows:.0e} lignes à lire). Ajoutez des conditions de jointure ou des filtres.")
+        return self.add_limit(sql_operation, max_result_rows)
+
+    @staticmethod
+    def truncate(result, max_result_rows):
+        """
+        Keeps the first max_result_rows rows of a result. A truncated result has the number of rows it was
+        truncated at in result.attrs["truncated_at"], to tell the LLM and the user.
+
+        input:
+            result (pd.DataFrame)
+            max_result_rows (int)
+
+        output:
+            (pd.DataFrame)
+        """
+        if len(result) <= max_result_rows:
+            return result
+        result = result.head(max_result_rows).copy()
+        result.attrs["truncated_at"] = max_result_rows
+        return result
+
+
+def run_rejection_check():
+    """
+    Runs a corpus of queries which must not change the data through the checks of the query text (with and without
+    sqlglot) and through the engine alone, on a small table. The engine must reject every query by itself.
+    Then runs the read queries which must be bounded through the whole guard : a cartesian join, a join too
+    costly to run and a SELECT * without LIMIT.
+
+    no input
+
+    output:
+        (list) of dict, which layer rejected or bounded each query
+    """
+    import sqlite3
+    import tempfile
+
+    import pandas as pd
+
+    from helper.database_client import DatabaseClient
+
+    bad_queries = [
+        "WITH t AS (SELECT 1) UPDATE sales SET price = 0",
+        "WITH t AS (SELECT 1) DELETE FROM sales",
+        "WITH t AS (SELECT 1) INSERT INTO sales SELECT * FROM sales",
+        "ATTACH DATABASE 'attached.sqlite' AS attached",
+        "PRAGMA query_only = OFF",
+        "SELECT * FROM sales; DROP TABLE sales",
+        "SELECT 1; UPDATE sales SET price = 0",
+        "CREATE TABLE copy AS SELECT * FROM sales",
+        "DROP TABLE sales",
+        "ALTER TABLE sales RENAME TO renamed",
+        "BEGIN",
+        "SELECT load_extension('extension')",
+    ]
+    # Read queries and the layer which must stop them : the check of the statement, the estimated cost or the LIMIT.
+    bounded_queries = [
+        ("SELECT * FROM sales a JOIN sales b", "statement"),
+        ("SELECT * FROM sales a JOIN sales b ON 1 = 1", "statement"),
+        ("SELECT * FROM sales a JOIN sales b ON TRUE", "statement"),
+        ("SELECT * FROM sales a JOIN sales b ON b.price > 6500", "statement"),
+        ("SELECT * FROM sales a JOIN sales b ON a.price < b.price", "cost"),
+        ("SELECT * FROM sales", "limit"),
+        ("SELECT * FROM sales LIMIT 5 -- every column", "limit"),
+    ]
+    row_count = 200
+    outcomes = []
+    with tempfile.TemporaryDirectory() as folder:
+        pd.DataFrame({"provider": ["A", "B"] * (row_count // 2), "price": [6000.0 + index for index in range(row_count)]}).to_csv(
+            os.path.join(folder, "sales.csv"), sep=";", index=False)
+        total_price = sum(6000.0 + index for index in range(row_count))
+        database_client = DatabaseClient(["sales"], folder, ";", database_file=os.path.join(folder, "engine.sqlite"))
+        guardrail_clients = {"regex": GuardrailClient(sql_parser=None), "sqlglot": GuardrailClient() if sqlglot is not None else None}
+
+        def is_rejected(check, query):
+            try:
+                check(query)
+            # ValueError : QueryRejectedError of this module and of helper.guardrail_client when run as a script.
+            except (ValueError, sqlite3.Error, pd.errors.DatabaseError):
+                return True
+            return False
+
+        for query in bad_queries:
+            outcome = {"query": query}
+            for name, guardrail_client in guardrail_clients.items():
+                outcome[name] = is_rejected(guardrail_client.check_statement, query) if guardrail_client is not None else "-"
+            outcome["engine"] = is_rejected(database_client.execute, query)
+            with database_client.lock:
+                outcome["data_unchanged"] = (database_client.connection.execute("SELECT sum(price) FROM sales").fetchone()[0] == total_price
+                                             and len(database_client.connection.execute("PRAGMA database_list").fetchall()) == 1)
+            assert outcome["engine"] and outcome["data_unchanged"], outcome
+            outcomes.append(outcome)
+
+        def guard(guardrail_client, query):
+            # The layer of the guard which stopped the query, or limit if it ran with at most max_result_rows rows.
+            try:
+                guardrail_client.check_statement(query)
+            except ValueError:
+                return "statement"
+            try:
+                prepared_query = guardrail_client.prepare_query(
+                    query, database_client.explain(guardrail_client.strip_query_end(query)), database_client.table_row_count)
+            except ValueError:
+                return "cost"
+            result = guardrail_client.truncate(database_client.execute(prepared_query), guardrail_client.max_result_rows)
+            return "limit" if len(result) <= guardrail_client.max_result_rows else "none"
+
+        for query, expected_layer in bounded_queries:
+            outcome = {"query": query}
+            for name in guardrail_clients:
+                if guardrail_clients[name] is None:
+                    outcome[name] = "-"
+                    continue
+                guardrail_client = GuardrailClient(max_result_rows=50, max_estimated_rows=10 * row_count, sql_parser=guardrail_clients[name].sql_parser)
+                outcome[name] = guard(guardrail_client, query)
+            # Without sqlglot, the cartesian joins are stopped by their cost.
+            assert outcome["sqlglot"] in (expected_layer, "-") and outcome["regex"] == ("cost" if expected_layer == "statement" else expected_layer), outcome
+            outcomes.append(outcome)
+        assert database_client.execute("SELECT provider, price FROM sales ORDER BY price").shape == (row_count, 2)
+        database_client.connection.close()
+    return outcomes
+
+
+if __name__ == "__main__":
+    for outcome in run_rejection_check():
+        print(outcome)
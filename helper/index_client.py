@@ -0,0 +1,239 @@
+"""
+A client to create the secondary indexes of the SQL engine : a declared set of indexes on the columns the
+queries usually filter or join on, completed by indexes on the columns the logged queries actually filter on.
+The latency of the queries with and without the indexes can be compared on a synthetic table :
+python -m helper.index_client [--rows 10000000]
+"""
+
+import argparse
+from collections import Counter
+import re
+import threading
+import time
+
+
+class IndexClient:
+    """
+    A client to create the secondary indexes of the SQL engine.
+    """
+    # Indexes created on every table having all their columns.
+    DECLARED_INDEXES = [
+        ("product", "country", "year", "month"),
+        ("provider",),
+        ("year", "month"),
+    ]
+    # A column compared to a value or to another column, optionally prefixed by its table or alias.
+    PREDICATE_PATTERN = re.compile(r"(?:\b(\w+)\.)?\b(\w+)\s*(?:=|==|!=|<>|<=|>=|<|>|\bin\b|\bbetween\b|\blike\b|\bis\b)", re.IGNORECASE)
+    # The right side of a join condition (a = b.column).
+    JOIN_PATTERN = re.compile(r"=\s*\b(\w+)\.(\w+)\b")
+    TABLE_ALIAS_PATTERN = re.compile(r"(?:\bfrom|\bjoin|,)\s+(\w+)(?:\s+(?:as\s+)?(\w+))?", re.IGNORECASE)
+
+    def __init__(self, declared_indexes=None, adaptive_threshold=5) -> None:
+        self.declared_indexes = declared_indexes if declared_indexes is not None else self.DECLARED_INDEXES
+        # Number of logged queries filtering on a column before an index is created on it.
+        self.adaptive_threshold = adaptive_threshold
+        self.predicate_count = Counter()
+        # Columns indexed because of the query log, recreated when a table is reloaded.
+        self.adaptive_indexes = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_index_name(table_name, columns):
+        """
+        Returns the name of the index of a table on some columns.
+
+        input:
+            table_name (str)
+            columns (tuple)
+
+        output:
+            (str)
+        """
+        return f"idx_{table_name}_{'_'.join(columns)}"
+
+    @staticmethod
+    def get_table_columns(connection, table_name):
+        """
+        Returns the columns of a table.
+
+        input:
+            connection (sqlite3 connection)
+            table_name (str)
+
+        output:
+            (set)
+        """
+        return {row[1] for row in connection.execute(f'PRAGMA table_info("{table_name}")')}
+
+    def create_index(self, connection, table_name, columns):
+        """
+        Creates an index on some columns of a table if it doesn't exist yet.
+
+        input:
+            connection (sqlite3 connection)
+            table_name (str)
+            columns (tuple)
+
+        no output
+        """
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        connection.execute(f'CREATE INDEX IF NOT EXISTS "{self.get_index_name(table_name, columns)}" ON "{table_name}" ({column_list})')
+
+    def create_table_indexes(self, connection, table_name):
+        """
+        Creates the declared and adaptive indexes of a table (called each time the table is loaded)
+        and updates the statistics used by the query planner.
+
+        input:
+            connection (sqlite3 connection)
+            table_name (str)
+
+        no output
+        """
+        table_columns = self.get_table_columns(connection, table_name)
+        with self.lock:
+            adaptive_indexes = [columns for indexed_table, columns in self.adaptive_indexes if indexed_table == table_name]
+        for columns in list(self.declared_indexes) + adaptive_indexes:
+            if set(columns) <= table_columns:
+                self.create_index(connection, table_name, columns)
+        connection.execute(f'ANALYZE "{table_name}"')
+
+    def get_filtered_columns(self, sql_operation, table_columns):
+        """
+        Returns the (table, column) pairs a query filters or joins on. A column without table prefix is
+        attributed to every table of the query having this column.
+
+        input:
+            sql_operation (str)
+            table_columns (dict) table name -> set of columns
+
+        output:
+            (set)
+        """
+        aliases = {}
+        for table_name, alias in self.TABLE_ALIAS_PATTERN.findall(sql_operation):
+            if table_name in table_columns:
+                aliases[table_name] = table_name
+                if alias:
+                    aliases[alias] = table_name
+        query_tables = set(aliases.values())
+
+        filtered_columns = set()
+        for prefix, column in self.PREDICATE_PATTERN.findall(sql_operation) + self.JOIN_PATTERN.findall(sql_operation):
+            candidate_tables = [aliases[prefix]] if prefix in aliases else query_tables
+            for table_name in candidate_tables:
+                if column in table_columns[table_name]:
+                    filtered_columns.add((table_name, column))
+        return filtered_columns
+
+    def record_query(self, connection, sql_operation, list_table_name):
+        """
+        Logs the columns a query filters on and creates an index on the columns which reach the threshold.
+
+        input:
+            connection (sqlite3 connection)
+            sql_operation (str)
+            list_table_name (list)
+
+        output:
+            (list) indexes created, as (table, columns) pairs
+        """
+        table_columns = {table_name: self.get_table_columns(connection, table_name) for table_name in list_table_name}
+        created_indexes = []
+        with self.lock:
+            for table_name, column in self.get_filtered_columns(sql_operation, table_columns):
+                self.predicate_count[(table_name, column)] += 1
+                index = (table_name, (column,))
+                if self.predicate_count[(table_name, column)] >= self.adaptive_threshold and index not in self.adaptive_indexes:
+                    if any(columns[0] == column for columns in self.declared_indexes if set(columns) <= table_columns[table_name]):
+                        # A declared index already starts with this column.
+                        continue
+                    self.adaptive_indexes.add(index)
+                    created_indexes.append(index)
+        for table_name, columns in created_indexes:
+            self.create_index(connection, table_name, columns)
+        if created_indexes:
+            connection.commit()
+        return created_indexes
+
+    def get_statistics(self):
+        """
+        Returns how many logged queries filtered on each column and the indexes created from the query log.
+
+        no input
+
+        output:
+            (dict)
+        """
+        with self.lock:
+            return {
+                "predicate_count": {f"{table_name}.{column}": count for (table_name, column), count in self.predicate_count.most_common()},
+                "adaptive_indexes": sorted(self.get_index_name(table_name, columns) for table_name, columns in self.adaptive_indexes),
+            }
+
+
+def run_index_benchmark(row_count=10_000_000, repeats=3):
+    """
+    Prints the latency of typical filters of the generated queries on a synthetic sales table of row_count rows,
+    with a full scan and then with the declared indexes, and checks that the indexed queries use an index.
+
+    input:
+        row_count (int)
+        repeats (int) runs of each query, the best one is kept
+
+    output:
+        (list) of dict, the latencies of each query
+    """
+    import os
+    import sqlite3
+    import tempfile
+
+    queries = {
+        "product_country_year_month": "SELECT avg(price) FROM historical_sales_data WHERE product = 'product 7' AND country = 'country 3' AND year = 2021 AND month = 6",
+        "provider": "SELECT count(*), avg(price) FROM historical_sales_data WHERE provider = 'provider 42'",
+        "year_month": "SELECT provider, avg(price) FROM historical_sales_data WHERE year = 2022 AND month = 1 GROUP BY provider",
+    }
+
+    def measure(connection, sql_operation):
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            connection.execute(sql_operation).fetchall()
+            seconds.append(time.perf_counter() - start)
+        return min(seconds)
+
+    measures = []
+    with tempfile.TemporaryDirectory() as folder:
+        connection = sqlite3.connect(os.path.join(folder, "benchmark.sqlite"))
+        start = time.perf_counter()
+        connection.execute("CREATE TABLE historical_sales_data (product TEXT, country TEXT, provider TEXT, year INTEGER, month INTEGER, price REAL)")
+        connection.execute(f"""
+            INSERT INTO historical_sales_data
+            WITH RECURSIVE row_number(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM row_number WHERE n + 1 < {int(row_count)})
+            SELECT 'product ' || (n % 50), 'country ' || (n / 7 % 20), 'provider ' || (n / 3 % 200), 2015 + n / 11 % 10, 1 + n / 13 % 12, 5000 + n % 4000
+            FROM row_number""")
+        connection.commit()
+        print(f"{row_count} rows generated in {time.perf_counter() - start:.1f} s")
+
+        scan_seconds = {name: measure(connection, sql_operation) for name, sql_operation in queries.items()}
+        start = time.perf_counter()
+        IndexClient().create_table_indexes(connection, "historical_sales_data")
+        connection.commit()
+        print(f"Declared indexes created in {time.perf_counter() - start:.1f} s")
+
+        print("query\tscan_seconds\tindexed_seconds\tspeedup")
+        for name, sql_operation in queries.items():
+            query_plan = " ".join(row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {sql_operation}"))
+            assert "USING" in query_plan and "INDEX" in query_plan, f"The query {name} doesn't use an index : {query_plan}"
+            indexed_seconds = measure(connection, sql_operation)
+            measures.append({"query": name, "scan_seconds": scan_seconds[name], "indexed_seconds": indexed_seconds})
+            print(f"{name}\t{scan_seconds[name]:.4f}\t{indexed_seconds:.4f}\t{scan_seconds[name] / max(indexed_seconds, 1e-9):.0f}x")
+        connection.close()
+    return measures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the latency of the queries with a full scan and with the declared indexes.")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="rows of the synthetic table")
+    arguments = parser.parse_args()
+    run_index_benchmark(arguments.rows)
@@ -0,0 +1,337 @@
+"""
+A client to detect the rows appended to our csv files since they were loaded, so that only these rows are
+loaded in the SQL engine, and a watcher refreshing the engine in the background when the files change.
+The loading of appended and rewritten files can be checked : python -m helper.ingestion_client
+"""
+
+import hashlib
+import io
+import os
+import threading
+
+import pandas as pd
+
+from helper.resource_client import get_shared_resource
+from helper.trace_client import TraceClient
+
+
+class IngestionClient:
+    """
+    A client to detect the rows appended to our csv files since they were loaded.
+    """
+    # Number of bytes compared at the beginning and before the end of the loaded part of a file
+    # to check that the file was appended to and not rewritten.
+    CHECK_BYTES = 4096
+
+    def __init__(self, data_folder="data", separator=";") -> None:
+        self.data_folder = data_folder
+        self.separator = separator
+        # State of the loaded part of each file : offset, header and hashes of its first and last bytes.
+        self.file_state = {}
+        self.lock = threading.Lock()
+
+    def get_csv_path(self, table_name):
+        """
+        Returns the address of the csv file of a table.
+
+        input:
+            table_name (str)
+
+        output:
+            (str)
+        """
+        return os.path.join(self.data_folder, f"{table_name}.csv")
+
+    def read_state(self, table_name, offset):
+        """
+        Computes the state of the first offset bytes of a file.
+
+        input:
+            table_name (str)
+            offset (int)
+
+        output:
+            (dict)
+        """
+        with open(self.get_csv_path(table_name), "rb") as f:
+            header = f.readline()
+            f.seek(0)
+            head = f.read(min(offset, self.CHECK_BYTES))
+            f.seek(max(offset - self.CHECK_BYTES, 0))
+            tail = f.read(min(offset, self.CHECK_BYTES))
+        return {
+            "offset": offset,
+            "header": header,
+            "head_hash": hashlib.sha256(head).hexdigest(),
+            "tail_hash": hashlib.sha256(tail).hexdigest(),
+        }
+
+    def mark_loaded(self, table_name, offset):
+        """
+        Records that the first offset bytes of a file are loaded in the engine.
+
+        input:
+            table_name (str)
+            offset (int)
+
+        no output
+        """
+        state = self.read_state(table_name, offset)
+        with self.lock:
+            self.file_state[table_name] = state
+
+    def get_state(self, table_name):
+        """
+        Returns the state of the loaded part of a file, to be saved with the data.
+
+        input:
+            table_name (str)
+
+        output:
+            (dict) or None if the file was never loaded
+        """
+        with self.lock:
+            return self.file_state.get(table_name)
+
+    def set_state(self, table_name, state):
+        """
+        Restores the state of the loaded part of a file saved with the data.
+
+        input:
+            table_name (str)
+            state (dict)
+
+        no output
+        """
+        with self.lock:
+            self.file_state[table_name] = state
+
+    def get_offset(self, table_name):
+        """
+        Returns the number of bytes of a file loaded in the engine.
+
+        input:
+            table_name (str)
+
+        output:
+            (int) or None if the file was never loaded
+        """
+        with self.lock:
+            state = self.file_state.get(table_name)
+        return state["offset"] if state is not None else None
+
+    def get_complete_offset(self, table_name, size):
+        """
+        Returns the end of the last complete line among the first size bytes of a file : a line still being
+        written is left for the next read.
+
+        input:
+            table_name (str)
+            size (int)
+
+        output:
+            (int)
+        """
+        with open(self.get_csv_path(table_name), "rb") as f:
+            end = size
+            while end > 0:
+                start = max(end - self.CHECK_BYTES, 0)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    return start + newline + 1
+                end = start
+        return 0
+
+    def read_appended_rows(self, table_name):
+        """
+        Reads the complete lines appended to a file since it was loaded. Returns None if the file was rewritten
+        (or never loaded), in which case the whole table must be reloaded.
+
+        input:
+            table_name (str)
+
+        output:
+            (tuple) (pd.DataFrame of the appended rows, offset they start at, new offset) or None
+        """
+        with self.lock:
+            state = self.file_state.get(table_name)
+        if state is None or os.path.getsize(self.get_csv_path(table_name)) < state["offset"]:
+            return None
+        current_state = self.read_state(table_name, state["offset"])
+        if any(current_state[key] != state[key] for key in ("header", "head_hash", "tail_hash")):
+            return None
+
+        with open(self.get_csv_path(table_name), "rb") as f:
+            f.seek(state["offset"])
+            delta = f.read()
+        # A line still being written is left for the next read.
+        delta = delta[:delta.rfind(b"\n") + 1]
+        new_offset = state["offset"] + len(delta)
+        if not delta.strip():
+            return pd.DataFrame(), state["offset"], new_offset
+        return pd.read_csv(io.BytesIO(state["header"] + delta), sep=self.separator), state["offset"], new_offset
+
+
+class FileWatcherClient:
+    """
+    A background thread refreshing the SQL engine when our csv files change.
+    """
+    def __init__(self, database_client, poll_interval=5.0) -> None:
+        self.database_client = database_client
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.thread = None
+        # The refreshes which changed the data or failed are traced and shown on the diagnostics page.
+        self.trace_client = get_shared_resource("trace_client", TraceClient)
+
+    def start(self):
+        """
+        Starts watching the files, does nothing if the watcher is already running.
+
+        no input
+
+        no output
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="file_watcher", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        Checks the files every poll_interval seconds until the watcher is stopped.
+
+        no input
+
+        no output
+        """
+        while not self.stop_event.wait(self.poll_interval):
+            span = self.trace_client.start_span("data_refresh", source="file_watcher")
+            try:
+                if self.database_client.refresh():
+                    self.trace_client.end_span(span)
+            except Exception as e:
+                # A file can be caught in the middle of a rewrite, we try again at the next check.
+                self.trace_client.end_span(span, e)
+
+    def stop(self):
+        """
+        Stops watching the files.
+
+        no input
+
+        no output
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def run_ingestion_check():
+    """
+    Appends rows to a csv file, writes a partial line, rewrites the file (with a partial line) and removes it, with the engine in memory
+    and in a database file, and checks that the engine always holds the rows of the file. The changes are loaded
+    by the watcher, whose failed refresh must be traced.
+
+    no input
+
+    output:
+        (list) of dict, the outcome of each step
+    """
+    import tempfile
+    import time
+
+    from helper.database_client import DatabaseClient
+
+    outcomes = []
+    trace_client = get_shared_resource("trace_client", TraceClient)
+    with tempfile.TemporaryDirectory() as folder:
+        csv_path = os.path.join(folder, "sales.csv")
+        for database_file in (None, os.path.join(folder, "engine.sqlite")):
+            with open(csv_path, "w") as f:
+                f.write("provider;price\n" + "".join(f"A;{price}\n" for price in range(100)))
+            database_client = DatabaseClient(["sales"], folder, ";", database_file=database_file)
+            file_watcher_client = FileWatcherClient(database_client, poll_interval=0.05)
+            file_watcher_client.start()
+
+            def wait_for_refresh():
+                data_version = database_client.data_version
+                deadline = time.monotonic() + 5
+                while database_client.data_version == data_version and time.monotonic() < deadline:
+                    time.sleep(0.01)
+
+            def check(step, expected_rows):
+                loaded = database_client.execute("SELECT provider, price FROM sales")
+                expected = pd.read_csv(io.StringIO("".join(expected_rows)), sep=";")
+                outcome = {"engine": "file" if database_file else "memory", "step": step, "rows": len(loaded),
+                           "offset": database_client.ingestion_client.get_offset("sales")}
+                assert loaded.sort_values(["provider", "price"]).reset_index(drop=True).equals(expected.sort_values(["provider", "price"]).reset_index(drop=True)), outcome
+                outcomes.append(outcome)
+
+            expected_rows = ["provider;price\n"] + [f"A;{price}\n" for price in range(100)]
+            check("loaded", expected_rows)
+
+            with open(csv_path, "a") as f:
+                f.write("B;1000\nB;1001\n")
+            expected_rows += ["B;1000\n", "B;1001\n"]
+            wait_for_refresh()
+            check("appended", expected_rows)
+
+            # A line still being written is loaded once it is complete.
+            with open(csv_path, "a") as f:
+                f.write("C;20")
+            wait_for_refresh()
+            check("partial line", expected_rows)
+            with open(csv_path, "a") as f:
+                f.write("00\n")
+            expected_rows += ["C;2000\n"]
+            wait_for_refresh()
+            check("line completed", expected_rows)
+
+            # The same size but other values : the file was rewritten, the table is reloaded entirely.
+            expected_rows = [row.replace("A;", "Z;") for row in expected_rows]
+            with open(csv_path, "w") as f:
+                f.write("".join(expected_rows))
+            wait_for_refresh()
+            check("rewritten", expected_rows)
+
+            expected_rows = ["provider;price\n", "D;1\n"]
+            with open(csv_path, "w") as f:
+                f.write("".join(expected_rows))
+            wait_for_refresh()
+            check("shortened", expected_rows)
+
+            # The file is rewritten with a line still being written : the reload stops at the last complete line
+            # and the line is loaded once, when it is complete.
+            expected_rows = ["provider;price\n", "E;1\n", "E;2\n"]
+            with open(csv_path, "w") as f:
+                f.write("".join(expected_rows) + "E;3")
+            wait_for_refresh()
+            check("rewritten with a partial line", expected_rows)
+            with open(csv_path, "a") as f:
+                f.write("0\n")
+            expected_rows += ["E;30\n"]
+            wait_for_refresh()
+            check("partial line of the reload completed", expected_rows)
+
+            # The file disappears in the middle of a rewrite : the refresh fails, is traced, and the data is kept.
+            trace_client.clear()
+            os.remove(csv_path)
+            deadline = time.monotonic() + 5
+            while not any(span["name"] == "data_refresh" and span["status"] == "ERROR" for span in trace_client.get_spans()) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert any(span["name"] == "data_refresh" and span["status"] == "ERROR" for span in trace_client.get_spans()), "the failed refresh is not traced"
+            file_watcher_client.stop()
+            with open(csv_path, "w") as f:
+                f.write("".join(expected_rows))
+            database_client.refresh()
+            check("refresh failed then file restored", expected_rows)
+            database_client.connection.close()
+    return outcomes
+
+
+if __name__ == "__main__":
+    for outcome in run_ingestion_check():
+        print(outcome)
@@ -2,11 +2,14 @@
 An interface client which standardizes how the application is supposed to look like.
 """
 
-import pandas as pd
+import html
 from PIL import Image
 import streamlit as st
 from streamlit_extras.stylable_container import stylable_container
-import time
+
+from helper.resource_client import get_shared_resource
+from helper.result_summary_client import ResultSummaryClient
+from helper.trace_client import TraceClient
 
 
 class InterfaceClient:
@@ -14,11 +17,29 @@ class InterfaceClient:
     An interface client which standardizes how the application is supposed to look like.
     """
     def __init__(self) -> None:
-        self.logo = Image.open('images/logo.png')
-        self.large_logo = Image.open('images/logo-wide.png')
+        # The decoded images are shared by every session of the process.
+        self.logo, self.large_logo = get_shared_resource("interface_images", self.load_images)
+        self.result_summary_client = get_shared_resource("result_summary_client", ResultSummaryClient)
+        self.trace_client = get_shared_resource("trace_client", TraceClient)
         self.title = "Query your data"
         self.display_history = []
 
+    @staticmethod
+    def load_images():
+        """
+        Opens and decodes the logos displayed on every page.
+
+        no input
+
+        output:
+            (tuple) logo and large logo
+        """
+        logo = Image.open('images/logo.png')
+        logo.load()
+        large_logo = Image.open('images/logo-wide.png')
+        large_logo.load()
+        return logo, large_logo
+
     def add_message_to_history(self, role, content):
         """
         Method to add a message to the list of messages to display on screen
@@ -42,7 +63,7 @@ class InterfaceClient:
         """
         st.set_page_config(page_title=page_title, page_icon=self.logo, layout="centered", initial_sidebar_state="auto", menu_items=None)
 
-    def create_sidebar(self, header_text=None, paragraph_text="", clear_conversation_button=False):
+    def create_sidebar(self, header_text=None, paragraph_text="", clear_conversation_button=False, on_clear_conversation=None):
         """
         Create a sidebar with text and a reset conversation button.
 
@@ -50,6 +71,7 @@ class InterfaceClient:
             header_text (str)
             paragraph_text (str)
             clear_conversation_button (bool)
+            on_clear_conversation (callable) called when the conversation is cleared, to clear the memory of the LLM
 
         no output
         """
@@ -77,6 +99,8 @@ class InterfaceClient:
                 ):
                     if st.button("Effacer la conversation →"):
                         self.display_history = []
+                        if on_clear_conversation is not None:
+                            on_clear_conversation()
 
     def display_intro_sentence(self, intro_sentence):
         """
@@ -88,13 +112,11 @@ class InterfaceClient:
         no output
         """
         if self.display_history == []:
-            message_placeholder = st.empty()
-            streamed_content = ""
-            for splitted_content in intro_sentence.split(" "):
-                streamed_content = streamed_content + " " + splitted_content 
-                message_placeholder.markdown(streamed_content)
-                time.sleep(0.07)
-            message_placeholder.markdown(intro_sentence)
+            # The typing effect is done by the browser (each word appears after a delay) so the script is not blocked.
+            words = "".join(
+                f"<span style='opacity: 0; animation: intro-word 0s {index * 0.07:.2f}s forwards;'>{html.escape(word)} </span>"
+                for index, word in enumerate(intro_sentence.split(" ")))
+            st.markdown(f"<style>@keyframes intro-word {{ to {{ opacity: 1; }} }}</style><p>{words}</p>", unsafe_allow_html=True)
 
     def display_markdown_in_container(self, container, header_text, paragraph_text):
         """
@@ -135,20 +157,71 @@ class InterfaceClient:
         output:
             str
         """
-        answer = f"""
+        return self.format_answer_beginning(reasoning, table) + self.format_answer_conclusion(interpretation)
+
+    def format_answer_beginning(self, reasoning, table):
+        """
+        Formats the reasoning and the data of an answer, which are known before the conclusion is streamed.
+
+        input:
+            reasoning (str)
+            table (str)
+
+        output:
+            str
+        """
+        return f"""
 **Raisonnement** : {self.replace_malformed_characters(reasoning)}
 
 ---
 
 **Données** : 
 
-{pd.DataFrame(table).to_markdown()}
+{self.result_summary_client.to_display_markdown(table)}
 
 ---
 
-**Conclusion** : {self.replace_malformed_characters(interpretation)}
+"""
+
+    def format_answer_conclusion(self, interpretation):
+        """
+        Formats the conclusion of an answer.
+
+        input:
+            interpretation (str)
+
+        output:
+            str
+        """
+        return f"""**Conclusion** : {self.replace_malformed_characters(interpretation)}
     """
-        return answer
+
+    def stream_answer(self, message_placeholder, reasoning, table, interpretation_stream):
+        """
+        Displays the reasoning and the data of an answer right away and then streams its conclusion.
+
+        input:
+            message_placeholder (streamlit object)
+            reasoning (str)
+            table (str)
+            interpretation_stream (generator) of str
+
+        output:
+            interpretation (str)
+            answer (str) the complete formatted answer
+        """
+        # The table is sent to the browser once, the conclusion is streamed in its own placeholder below it.
+        message_container = message_placeholder.container()
+        with self.trace_client.span("render_table", rows=len(table) if hasattr(table, "__len__") and not isinstance(table, str) else 0):
+            answer_beginning = self.format_answer_beginning(reasoning, table)
+            message_container.markdown(answer_beginning)
+        conclusion_placeholder = message_container.empty()
+        interpretation = ""
+        with self.trace_client.span("interpretation"):
+            for chunk in interpretation_stream:
+                interpretation += chunk
+                conclusion_placeholder.markdown(self.format_answer_conclusion(interpretation))
+        return interpretation, answer_beginning + self.format_answer_conclusion(interpretation)
     
     def replace_malformed_characters(self, text):
         """
@@ -0,0 +1,372 @@
+"""
+The chat models the LLM client can use. The model is chosen with LLM_BACKEND :
+- azure : the Azure OpenAI deployment, and the fallback deployment when it is set
+- record : the Azure deployment, every request and its answer are written in LLM_RECORD_FILE
+- replay : the answers recorded in LLM_RECORD_FILE, served with a simulated latency, without network
+- fake : a fake model answering from a script, without network
+The replay and fake models make the batch runs and the benchmarks deterministic and offline.
+"""
+
+from abc import ABC, abstractmethod
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_openai import AzureChatOpenAI
+from pydantic import PrivateAttr
+
+from helper.resilience_client import ResilienceClient, ResilientChatModel
+from helper.resource_client import get_shared_resource
+
+
+def hash_messages(messages):
+    """
+    Returns a hash identifying a conversation sent to the LLM.
+
+    input:
+        messages (list) of langchain messages
+
+    output:
+        (str)
+    """
+    content = json.dumps([[message.type, message.content] for message in messages], ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_user_message(messages):
+    """
+    Returns the content of the last user message of a conversation.
+
+    input:
+        messages (list) of langchain messages
+
+    output:
+        (str)
+    """
+    return next((message.content for message in reversed(messages) if isinstance(message, HumanMessage)), "")
+
+
+class SimulatedLatencyChatModel(BaseChatModel, ABC):
+    """
+    A chat model answering without network after a simulated latency : latency seconds (or the recorded
+    latency of the answer when latency is None) plus a random jitter between 0 and jitter seconds.
+    The subclasses give the answers, see get_answer.
+    """
+    latency: Optional[float] = 0.0
+    jitter: float = 0.0
+    seed: int = 42
+    # Content of the system message of each stage, to know which stage is asked.
+    stage_by_system_message: dict = {}
+    _random: Any = PrivateAttr(default=None)
+
+    def model_post_init(self, context):
+        # The jitter is drawn from a seeded generator so that two runs wait the same times.
+        self._random = random.Random(self.seed)
+
+    def get_stage(self, messages):
+        """
+        Returns the stage asked by a conversation, from its system message.
+
+        input:
+            messages (list) of langchain messages
+
+        output:
+            (str) or None
+        """
+        return self.stage_by_system_message.get(messages[0].content) if messages else None
+
+    @abstractmethod
+    def get_answer(self, messages):
+        """
+        Returns the answer to a conversation and its recorded latency.
+
+        input:
+            messages (list) of langchain messages
+
+        output:
+            (str)
+            (float) recorded latency in seconds, or None
+        """
+
+    def get_latency(self, recorded_seconds):
+        """
+        Returns the time to wait before answering.
+
+        input:
+            recorded_seconds (float) or None
+
+        output:
+            (float)
+        """
+        latency = recorded_seconds if self.latency is None else self.latency
+        return (latency or 0.0) + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        answer, recorded_seconds = self.get_answer(messages)
+        time.sleep(self.get_latency(recorded_seconds))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        # The latency is awaited so that concurrent calls wait at the same time, like network calls.
+        answer, recorded_seconds = self.get_answer(messages)
+        await asyncio.sleep(self.get_latency(recorded_seconds))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
+
+
+class ScriptedChatModel(SimulatedLatencyChatModel):
+    """
+    A fake chat model answering from a script : the answer of each stage (list_operation, operation_figure,
+    figure_template, figure_answer, interpretation) for each question.
+    """
+    # Entries of the script : {"question": str, "answers": {stage: str or dict}}.
+    script: list = []
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    @staticmethod
+    def read_script(address):
+        """
+        Reads a script : a json list or a jsonl file of entries with the keys question and answers.
+        The questions files of the batch runner can be used as scripts.
+
+        input:
+            address (str)
+
+        output:
+            (list) of dict
+        """
+        with open(address, "r", encoding="utf-8") as f:
+            content = f.read()
+        if content.lstrip().startswith("["):
+            entries = json.loads(content)
+        else:
+            entries = [json.loads(line) for line in content.splitlines() if line.strip()]
+        return [entry for entry in entries if "answers" in entry]
+
+    def get_answer(self, messages):
+        """
+        Returns the scripted answer to a conversation : the answer of the stage of the system message for the
+        longest question of the script contained in the last user message.
+
+        input:
+            messages (list) of langchain messages
+
+        output:
+            (str)
+            (None) no recorded latency
+        """
+        stage = self.get_stage(messages)
+        user_message = get_user_message(messages)
+        entries = sorted((entry for entry in self.script if entry["question"] in user_message), key=lambda entry: -len(entry["question"]))
+        for entry in entries:
+            if stage in entry["answers"]:
+                answer = entry["answers"][stage]
+                return (answer if isinstance(answer, str) else json.dumps(answer, ensure_ascii=False)), None
+        raise ValueError(f"No scripted answer of the stage {stage} for the message : {user_message[:200]}")
+
+
+class ReplayChatModel(SimulatedLatencyChatModel):
+    """
+    A chat model serving the answers recorded by RecordingChatModel. A conversation is matched exactly, or
+    by its stage and last user message when the static part of the prompts changed since the recording.
+    """
+    # Recorded entries by hash of the conversation and by (stage, user message).
+    recordings: dict = {}
+    recordings_by_message: dict = {}
+
+    @property
+    def _llm_type(self):
+        return "replay"
+
+    @classmethod
+    def from_file(cls, address, **kwargs):
+        """
+        Creates the model from a file written by RecordingChatModel. The last recording of a conversation is kept.
+
+        input:
+            address (str)
+            kwargs : the other fields of the model (latency, jitter, seed, stage_by_system_message)
+
+        output:
+            (ReplayChatModel)
+        """
+        recordings, recordings_by_message = {}, {}
+        with open(address, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    recordings[entry["key"]] = entry
+                    recordings_by_message[(entry["stage"], entry["user_message"])] = entry
+        return cls(recordings=recordings, recordings_by_message=recordings_by_message, **kwargs)
+
+    def get_answer(self, messages):
+        """
+        Returns the recorded answer to a conversation and its recorded latency.
+
+        input:
+            messages (list) of langchain messages
+
+        output:
+            (str)
+            (float)
+        """
+        entry = self.recordings.get(hash_messages(messages)) or self.recordings_by_message.get((self.get_stage(messages), get_user_message(messages)))
+        if entry is None:
+            raise ValueError(f"No recorded answer for the message : {get_user_message(messages)[:200]}")
+        return entry["answer"], entry["seconds"]
+
+
+class RecordingChatModel(BaseChatModel):
+    """
+    A chat model forwarding the conversations to another model and appending each conversation and its
+    answer to a file, to replay them later with ReplayChatModel.
+    """
+    chat_model: Any
+    record_file: str
+    stage_by_system_message: dict = {}
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self):
+        return "recording"
+
+    def record(self, messages, answer, seconds):
+        """
+        Appends a conversation and its answer to the record file.
+
+        input:
+            messages (list) of langchain messages
+            answer (str)
+            seconds (float) latency of the answer
+
+        no output
+        """
+        entry = {
+            "key": hash_messages(messages),
+            "stage": self.stage_by_system_message.get(messages[0].content) if messages else None,
+            "user_message": get_user_message(messages),
+            "answer": answer,
+            "seconds": seconds,
+        }
+        with self._lock:
+            if os.path.dirname(self.record_file):
+                os.makedirs(os.path.dirname(self.record_file), exist_ok=True)
+            with open(self.record_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        start = time.perf_counter()
+        message = self.chat_model.invoke(messages, stop=stop, **kwargs)
+        self.record(messages, message.content, time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        start = time.perf_counter()
+        message = await self.chat_model.ainvoke(messages, stop=stop, **kwargs)
+        self.record(messages, message.content, time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    @staticmethod
+    def to_chunk(message):
+        # A model without streaming gives its whole answer as a message, not as a chunk.
+        return ChatGenerationChunk(message=message if isinstance(message, AIMessageChunk) else AIMessageChunk(content=message.content, response_metadata=message.response_metadata))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        # The streamed answer is recorded whole once the stream ended, it is replayed as a single chunk.
+        start = time.perf_counter()
+        contents = []
+        for chunk in self.chat_model.stream(messages, stop=stop, **kwargs):
+            contents.append(chunk.content)
+            yield self.to_chunk(chunk)
+        self.record(messages, "".join(contents), time.perf_counter() - start)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        start = time.perf_counter()
+        contents = []
+        async for chunk in self.chat_model.astream(messages, stop=stop, **kwargs):
+            contents.append(chunk.content)
+            yield self.to_chunk(chunk)
+        self.record(messages, "".join(contents), time.perf_counter() - start)
+
+
+class LLMBackendClient:
+    """
+    A client creating the chat model of the LLM client.
+    """
+    BACKENDS = ("azure", "record", "replay", "fake")
+
+    def __init__(self, backend=None, script_file=None, record_file=None, latency=None, jitter=None, seed=None) -> None:
+        self.backend = backend or os.environ.get("LLM_BACKEND", "azure")
+        # Answers of the fake backend.
+        self.script_file = script_file or os.environ.get("LLM_FAKE_SCRIPT", "data/fake_llm_script.jsonl")
+        # Conversations written by the record backend and read by the replay backend.
+        self.record_file = record_file or os.environ.get("LLM_RECORD_FILE", "data/llm_recordings.jsonl")
+        # Simulated latency of the replay and fake backends : "recorded" replays the latency of each recorded answer.
+        latency = latency if latency is not None else os.environ.get("LLM_SIMULATED_LATENCY", "recorded")
+        self.latency = None if latency == "recorded" else float(latency)
+        self.jitter = jitter if jitter is not None else float(os.environ.get("LLM_SIMULATED_JITTER", "0"))
+        self.seed = seed if seed is not None else int(os.environ.get("LLM_SIMULATED_SEED", "42"))
+
+    def create_chat_model(self, stage_by_system_message):
+        """
+        Creates the chat model of the configured backend.
+
+        input:
+            stage_by_system_message (dict) content of the system message of each stage -> stage
+
+        output:
+            (langchain chat model)
+        """
+        if self.backend not in self.BACKENDS:
+            raise ValueError(f"Unknown LLM backend {self.backend}, the backends are {', '.join(self.BACKENDS)}.")
+        if self.backend == "fake":
+            return ScriptedChatModel(script=ScriptedChatModel.read_script(self.script_file), latency=self.latency or 0.0,
+                                     jitter=self.jitter, seed=self.seed, stage_by_system_message=stage_by_system_message)
+        if self.backend == "replay":
+            return ReplayChatModel.from_file(self.record_file, latency=self.latency, jitter=self.jitter, seed=self.seed,
+                                             stage_by_system_message=stage_by_system_message)
+        # The calls to Azure have a deadline, are retried and fall back to the secondary deployment when it is set.
+        azure_chat_model = ResilientChatModel(chat_models=self.create_azure_chat_models(), resilience_client=get_shared_resource("resilience_client", ResilienceClient))
+        if self.backend == "record":
+            return RecordingChatModel(chat_model=azure_chat_model, record_file=self.record_file, stage_by_system_message=stage_by_system_message)
+        return azure_chat_model
+
+    @staticmethod
+    def create_azure_chat_models():
+        """
+        Creates the chat models of the Azure deployments : the primary deployment and, if OPENAI_FALLBACK_DEPLOYMENT_ID
+        is set, a secondary (smaller, faster) deployment. The retries are left to the resilience client.
+
+        no input
+
+        output:
+            (dict) name of the deployment -> chat model, the primary deployment first
+        """
+        resilience_client = get_shared_resource("resilience_client", ResilienceClient)
+        deployments = {os.environ.get("OPENAI_DEPLOYMENT_ID"): (os.environ.get("OPENAI_API_ENDPOINT"), os.environ.get("OPENAI_API_KEY"))}
+        if os.environ.get("OPENAI_FALLBACK_DEPLOYMENT_ID"):
+            deployments[os.environ.get("OPENAI_FALLBACK_DEPLOYMENT_ID")] = (
+                os.environ.get("OPENAI_FALLBACK_API_ENDPOINT", os.environ.get("OPENAI_API_ENDPOINT")),
+                os.environ.get("OPENAI_FALLBACK_API_KEY", os.environ.get("OPENAI_API_KEY")))
+        return {deployment: AzureChatOpenAI(
+            azure_endpoint=endpoint,
+            openai_api_key=api_key,
+            api_version=os.environ.get("OPENAI_API_VERSION"),
+            azure_deployment=deployment,
+            temperature=0,
+            top_p = 0,
+            max_tokens=2048,
+            seed=42,
+            timeout=resilience_client.attempt_timeout_seconds,
+            max_retries=0
+            ) for deployment, (endpoint, api_key) in deployments.items()}
@@ -0,0 +1,185 @@
+"""
+A client to remember the conversation of a session for the multi-turn insights. The last turns are kept verbatim
+(question, reasoning, SQL query, reference to the result and conclusion), the older turns are rolled into a summary
+of one line each, and the whole memory sent to the LLM stays within a token budget. The results of the recent turns
+are kept in the session (they are never sent to the LLM), so that a follow-up question asking for the same query
+reuses them without running it again.
+"""
+
+from collections import deque
+import json
+import os
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from helper.resource_client import get_shared_resource
+from helper.result_summary_client import ResultSummaryClient
+from helper.token_client import TokenClient
+
+
+class ConversationMemoryClient:
+    """
+    A client to remember the conversation of a session.
+    """
+    def __init__(self, recent_turns=None, max_tokens=None, answer_max_tokens=150, extract_rows=3) -> None:
+        # Turns kept verbatim, the older ones are summarized.
+        self.recent_turns = recent_turns if recent_turns is not None else int(os.environ.get("MEMORY_RECENT_TURNS", "3"))
+        # Tokens of the whole memory sent to the LLM : the summary and the verbatim turns.
+        self.max_tokens = max_tokens if max_tokens is not None else int(os.environ.get("MEMORY_MAX_TOKENS", "2000"))
+        self.answer_max_tokens = answer_max_tokens
+        self.extract_rows = extract_rows
+        self.token_client = get_shared_resource("token_client", TokenClient)
+        self.result_summary_client = get_shared_resource("result_summary_client", ResultSummaryClient)
+        self.turns = deque()
+        self.summary_lines = []
+        # Number of summarized turns dropped to stay within the budget.
+        self.forgotten_turns = 0
+
+    @staticmethod
+    def normalize_sql(sql_operation):
+        """
+        Normalizes a SQL query to compare it with the queries of the previous turns : the whitespace is collapsed
+        and the final semicolon removed.
+
+        input:
+            sql_operation (str)
+
+        output:
+            (str)
+        """
+        return " ".join(str(sql_operation).split()).rstrip("; ")
+
+    def shorten(self, text, budget):
+        """
+        Cuts a text to the number of tokens of the budget.
+
+        input:
+            text (str)
+            budget (int)
+
+        output:
+            (str)
+        """
+        text = " ".join(str(text).split())
+        if self.token_client.count_text(text) <= budget:
+            return text
+        words = text.split(" ")
+        while len(words) > 1 and self.token_client.count_text(" ".join(words) + " ...") > budget:
+            words = words[:max(1, int(len(words) * 0.8))]
+        return " ".join(words) + " ..."
+
+    def describe_result(self, result):
+        """
+        Returns a compact reference to the result of a query : its size, its columns and its first rows.
+
+        input:
+            result (pd.DataFrame)
+
+        output:
+            (str)
+        """
+        description = f"{len(result)} lignes, colonnes : {', '.join(str(column) for column in result.columns)}"
+        if len(result):
+            description += "\nPremières lignes :\n" + self.result_summary_client.to_compact_text(result.head(self.extract_rows), note=True)
+        return description
+
+    def add_turn(self, question, full_response, result, answer, data_stamp=None):
+        """
+        Remembers a turn of the conversation. The oldest verbatim turn is summarized when there are more than
+        recent_turns turns.
+
+        input:
+            question (str)
+            full_response (dict) with the keys reasoning and sql
+            result (pd.DataFrame) result of the query
+            answer (str) conclusion given to the user
+            data_stamp (str) version of the data the query ran on
+
+        no output
+        """
+        self.turns.append({
+            "question": question,
+            "reasoning": full_response.get("reasoning", ""),
+            "sql": full_response.get("sql", ""),
+            "result_reference": self.describe_result(result),
+            "rows": len(result),
+            "answer": self.shorten(answer, self.answer_max_tokens),
+            "result": result,
+            "data_stamp": data_stamp,
+        })
+        while len(self.turns) > self.recent_turns:
+            self.summarize_turn(self.turns.popleft())
+
+    def summarize_turn(self, turn):
+        """
+        Rolls a turn into the summary, as a single line. The oldest lines are dropped when the summary takes more
+        than half of the budget.
+
+        input:
+            turn (dict)
+
+        no output
+        """
+        self.summary_lines.append(
+            f"- Question : {self.shorten(turn['question'], 60)} | Requête : {turn['sql']} | {turn['rows']} lignes | Conclusion : {self.shorten(turn['answer'], 60)}")
+        while len(self.summary_lines) > 1 and self.token_client.count_messages(self.summary_lines) > self.max_tokens // 2:
+            self.summary_lines.pop(0)
+            self.forgotten_turns += 1
+
+    def get_result(self, sql_operation, data_stamp=None):
+        """
+        Returns the result of a recent turn which ran the same query on the same data, or None.
+
+        input:
+            sql_operation (str)
+            data_stamp (str)
+
+        output:
+            (pd.DataFrame) or None
+        """
+        sql_operation = self.normalize_sql(sql_operation)
+        for turn in reversed(self.turns):
+            if self.normalize_sql(turn["sql"]) == sql_operation and turn["data_stamp"] == data_stamp:
+                return turn["result"]
+        return None
+
+    def get_messages(self):
+        """
+        Returns the memory as messages for the LLM : a system message with the summary of the older turns, then
+        the most recent turns which fit in the budget, a question and an answer each.
+
+        no input
+
+        output:
+            (list) of langchain messages
+        """
+        if not self.turns and not self.summary_lines:
+            return []
+        header = ("Voici les échanges précédents avec l'utilisateur. Si la nouvelle question y fait suite et qu'une requête SQL "
+                  "précédente suffit pour y répondre, réutilise-la telle quelle.")
+        if self.summary_lines:
+            omitted = f"\n({self.forgotten_turns} échanges plus anciens omis)" if self.forgotten_turns else ""
+            header += "\nRésumé des échanges les plus anciens :" + omitted + "\n" + "\n".join(self.summary_lines)
+        budget = self.max_tokens - self.token_client.count_messages([header])
+        turn_messages = []
+        for turn in reversed(self.turns):
+            answer = json.dumps({"reasoning": turn["reasoning"], "sql": turn["sql"]}, ensure_ascii=False)
+            answer += f"\nRésultat de la requête : {turn['result_reference']}\nConclusion : {turn['answer']}"
+            messages = [HumanMessage(content = turn["question"]), AIMessage(content = answer)]
+            budget -= self.token_client.count_messages([message.content for message in messages])
+            if budget < 0:
+                break
+            turn_messages = messages + turn_messages
+        return [SystemMessage(content = header)] + turn_messages
+
+    def clear(self):
+        """
+        Forgets the conversation.
+
+        no input
+
+        no output
+        """
+        self.turns.clear()
+        self.summary_lines = []
+        self.forgotten_turns = 0
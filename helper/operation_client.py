@@ -1,11 +1,20 @@
 """
 A class to compute operations on data.
 """
-from colour import Color
+import asyncio
+import os
 import pandas as pd
-from pandasql import sqldf
+import threading
 import plotly.express as px
-import plotly.graph_objects as go
+
+from helper.catalog_client import CatalogClient
+from helper.database_client import get_shared_database_client
+from helper.figure_render_client import FigureRenderClient
+from helper.figure_spec_client import FigureSpecClient, FigureSpecError
+from helper.guardrail_client import GuardrailClient
+from helper.query_cache_client import QueryCacheClient
+from helper.resource_client import get_shared_resource
+from helper.trace_client import TraceClient, bind_context
 
 
 class OperationClient:
@@ -13,58 +22,195 @@ class OperationClient:
     A class to compute operations on data.
     """
     def __init__(self):
-        self.list_table_name = ["driver_ml", "historical_sales_data", "variation_prediction_df"]
-        self.table_dict = {}
-        for table_name in self.list_table_name:
-            self.table_dict[table_name] = pd.read_csv(f"data/{table_name}.csv", sep=";")
+        # The tables of the catalog (data/catalog.json and the csv files of the data folder).
+        self.catalog_client = get_shared_resource("catalog_client", CatalogClient)
+        self.list_table_name = self.catalog_client.list_table_name
+        # The tables are loaded once in a SQL engine shared by every session and reloaded when a csv file changes.
+        self.database_client = get_shared_database_client(self.list_table_name)
+        # Checks of the queries written by the LLM before they run.
+        self.guardrail_client = GuardrailClient()
+        # Results of the queries, invalidated when the data changes. SQL_RESULT_CACHE_SPILL_FOLDER enables the spill on disk.
+        self.query_cache_client = QueryCacheClient(
+            max_memory_bytes=int(os.environ.get("SQL_RESULT_CACHE_MAX_MB", "256")) * 1024 * 1024,
+            spill_folder=os.environ.get("SQL_RESULT_CACHE_SPILL_FOLDER"))
+        # Reduction of the points of the figures of large results (downsampling, binning, WebGL).
+        self.figure_render_client = FigureRenderClient()
+        # Checks of the figure templates written by the LLM against the results.
+        self.figure_spec_client = FigureSpecClient()
+        self.trace_client = get_shared_resource("trace_client", TraceClient)
+
+    def execute(self, sql_operation, cancel_event=None, max_result_rows=None):
+        """
+        Runs a query on the data, or returns its result from the cache if the same query already ran on the same data.
+        The result is truncated at max_result_rows rows (see GuardrailClient.truncate).
 
-    def read_operation(self, sql_operation):
+        input:
+            sql_operation (str)
+            cancel_event (threading.Event) set from another thread to cancel the query
+            max_result_rows (int) default : SQL_MAX_RESULT_ROWS
+
+        output:
+            (pd.DataFrame)
+        """
+        max_result_rows = max_result_rows or self.guardrail_client.max_result_rows
+        with self.trace_client.span("sql_query") as span:
+            # The only refresh of the query : the cache of results and the engine see the same version of the data.
+            self.database_client.refresh()
+            data_stamp = self.database_client.data_stamp
+            result = self.query_cache_client.get(sql_operation, data_stamp)
+            if result is not None and result.attrs.get("truncated_at", max_result_rows) < max_result_rows:
+                # The cached result was truncated below the rows asked now.
+                result = None
+            self.trace_client.add_attributes(span, cache_hit=result is not None)
+            if result is None:
+                result = self.database_client.execute(
+                    self.guard_query(self.database_client.rewrite_on_rollup(sql_operation), max_result_rows),
+                    timeout_seconds=self.guardrail_client.timeout_seconds,
+                    cancel_event=cancel_event)
+                result = self.guardrail_client.truncate(result, max_result_rows)
+                self.query_cache_client.set(sql_operation, data_stamp, result)
+                self.database_client.record_query(sql_operation)
+            else:
+                result = self.guardrail_client.truncate(result, max_result_rows)
+            self.trace_client.add_attributes(span, rows=len(result), truncated=bool(result.attrs.get("truncated_at")))
+        return result
+
+    def guard_query(self, sql_operation, max_result_rows=None):
+        """
+        Checks a query before it runs : it must be a single read query without cartesian join and its estimated
+        cost must be reasonable. Returns the query with a LIMIT, raises QueryRejectedError otherwise.
+
+        input:
+            sql_operation (str)
+            max_result_rows (int)
+
+        output:
+            (str)
+        """
+        self.guardrail_client.check_statement(sql_operation)
+        query_plan = self.database_client.explain(self.guardrail_client.strip_query_end(sql_operation))
+        return self.guardrail_client.prepare_query(sql_operation, query_plan, self.database_client.table_row_count, max_result_rows)
+
+    def get_cache_statistics(self):
+        """
+        Returns the hit and miss counters of the cache of query results.
+
+        no input
+
+        output:
+            (dict)
+        """
+        return self.query_cache_client.get_statistics()
+
+    def read_operation(self, sql_operation, cancel_event=None, max_result_rows=None):
         """
         Given a list of operations and their input parameters, returns the output of the last operation.
 
         input:
             list_operations (str)
+            cancel_event (threading.Event)
+            max_result_rows (int)
 
         output:
             (pd.DataFrame)
         """
-        result = sqldf(sql_operation, self.table_dict)
+        result = self.execute(sql_operation, cancel_event, max_result_rows)
         return result
     
-    def plot_figure(self, sql_operation, figure_instruction):
+    def plot_figure(self, sql_operation, figure_instruction, cancel_event=None):
         """
         Given a list of operations and their input parameters, returns the output of the last operation.
 
         input:
             list_operations (str)
             figure_instruction (dict)
+            cancel_event (threading.Event)
+
+        output:
+            (plotly figure)
+        """
+        result = pd.DataFrame(self.execute(sql_operation, cancel_event, self.guardrail_client.figure_max_result_rows))
+        with self.trace_client.span("build_figure", rows=len(result)):
+            return self.build_figure(result, figure_instruction)
+
+    async def aread_operation(self, sql_operation, max_result_rows=None):
+        """
+        Asynchronous version of read_operation. The query runs in an executor so that the event loop is not blocked.
+        When the coroutine is cancelled (timeout of the stage), the query is cancelled.
+
+        input:
+            sql_operation (str)
+            max_result_rows (int)
+
+        output:
+            (pd.DataFrame)
+        """
+        cancel_event = threading.Event()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, bind_context(self.read_operation), sql_operation, cancel_event, max_result_rows)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    async def aplot_figure(self, sql_operation, figure_instruction):
+        """
+        Asynchronous version of plot_figure. The query and the figure are built in an executor.
+        When the coroutine is cancelled (timeout of the stage), the query is cancelled.
+
+        input:
+            sql_operation (str)
+            figure_instruction (dict)
+
+        output:
+            (plotly figure)
+        """
+        cancel_event = threading.Event()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, bind_context(self.plot_figure), sql_operation, figure_instruction, cancel_event)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    def build_figure(self, result, figure_instruction):
+        """
+        Given the result of a query and the template of a figure, returns the figure. The template is checked against
+        the result first and the column names which almost match a column are fixed.
+
+        input:
+            result (pd.DataFrame)
+            figure_instruction (dict)
 
         output:
             (plotly figure)
         """
-        result = pd.DataFrame(sqldf(sql_operation, self.table_dict))
+        figure_instruction, problems = self.figure_spec_client.repair(figure_instruction, result)
+        if problems:
+            raise FigureSpecError(" ".join(problems))
+        x_column, y_column, color_column = figure_instruction["x_label"], figure_instruction["y_label"], figure_instruction["color"]
+        if figure_instruction["figure_type"] in ("line", "scatter"):
+            method = self.figure_render_client.line_method if figure_instruction["figure_type"] == "line" else self.figure_render_client.scatter_method
+            result = self.figure_render_client.downsample(result, x_column, y_column, color_column, method)
+        render_mode = self.figure_render_client.get_render_mode(len(result))
+        if figure_instruction["figure_type"] == "histogram" and x_column in result.columns and len(result) > self.figure_render_client.webgl_threshold:
+            # The bins are computed here and drawn as bars instead of sending every row to the browser.
+            binned = self.figure_render_client.bin_histogram(result, x_column, y_column, color_column)
+            value_column = y_column if y_column in binned.columns else "count"
+            plotly_fig = px.bar(binned, x=x_column, y=value_column, title=figure_instruction["title"], color=color_column if color_column in binned.columns else None, barmode="group", text_auto=True)
+            if "width" in binned.columns:
+                plotly_fig.update_traces(width=binned["width"].iloc[0])
+            return plotly_fig
 
         match figure_instruction["figure_type"]:
             case "bar":
-                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=figure_instruction["x_label"].lower(), y=figure_instruction["y_label"].lower(), title=figure_instruction["title"], color=figure_instruction["color"].lower(), barmode="group", text_auto=True)
+                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=x_column, y=y_column, title=figure_instruction["title"], color=color_column, barmode="group", text_auto=True)
             case "histogram":
-                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=figure_instruction["x_label"].lower(), y=figure_instruction["y_label"].lower(), title=figure_instruction["title"], color=figure_instruction["color"].lower(), barmode="group", text_auto=True)
+                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=x_column, y=y_column, title=figure_instruction["title"], color=color_column, barmode="group", text_auto=True)
             case "scatter":
-                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=figure_instruction["x_label"].lower(), y=figure_instruction["y_label"].lower(), title=figure_instruction["title"], color=figure_instruction["color"].lower(), symbol=figure_instruction["color"])
-                # Part of code used to get more beautiful colors for scatterplots
-                #blue = Color("blue")
-                #unique_value = result[figure_instruction["color"]].unique()
-                #colors = list(blue.range_to(Color("red"), len(unique_value)))
-                #dict_color = {}
-                #for i in range(len(unique_value)):
-                #    dict_color[unique_value[i]] = colors[i].hex_l
-                #plotly_fig = go.Figure()
-                #plotly_fig.add_trace(go.Scatter(x = result[figure_instruction["x_label"].lower()], y = result[figure_instruction["y_label"].lower()], mode = 'lines+markers', marker_color = [dict_color[element] for element in result[figure_instruction["color"].lower()].values]))
-                #plotly_fig.update_layout(title=figure_instruction["title"], xaxis_title=figure_instruction["x_label"], yaxis_title=figure_instruction["y_label"])
+                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=x_column, y=y_column, title=figure_instruction["title"], color=color_column, symbol=color_column, render_mode=render_mode)
             case "pie":
-                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, names=figure_instruction["x_label"].lower(), values=figure_instruction["y_label"].lower(), title=figure_instruction["title"], color=figure_instruction["color"].lower())
+                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, names=x_column, values=y_column, title=figure_instruction["title"], color=color_column)
             case "line":
-                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=figure_instruction["x_label"].lower(), y=figure_instruction["y_label"].lower(), title=figure_instruction["title"], color=figure_instruction["color"].lower(), markers = False)
+                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=x_column, y=y_column, title=figure_instruction["title"], color=color_column, markers = False, render_mode=render_mode)
             case _:
-                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=figure_instruction["x_label"].lower(), y=figure_instruction["y_label"].lower(), title=figure_instruction["title"], color=figure_instruction["color"].lower())
+                plotly_fig = getattr(px, figure_instruction["figure_type"])(result, x=x_column, y=y_column, title=figure_instruction["title"], color=color_column)
         return plotly_fig
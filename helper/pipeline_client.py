@@ -0,0 +1,417 @@
+"""
+An orchestrator running the stages of the insight and figure flows asynchronously, with a timeout per stage.
+Can be run to benchmark the figure flows on recorded answers : LLM_BACKEND=replay python -m helper.pipeline_client questions.jsonl
+or the throughput of the insight flow for concurrent users on a synthetic table : python -m helper.pipeline_client --users 1 4 16 64
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+import pandas as pd
+
+from helper.figure_spec_client import FigureSpecError
+from helper.resource_client import get_shared_resource
+from helper.trace_client import TraceClient
+
+
+class PipelineClient:
+    """
+    An orchestrator running the stages of the insight and figure flows asynchronously, with a timeout per stage.
+    """
+    # Keys of the figure template, given by get_figure_template or by get_figure_answer in the combined flow.
+    FIGURE_TEMPLATE_KEYS = ("figure_type", "title", "x_label", "y_label", "color")
+
+    def __init__(self, llm_client, operation_client, stage_timeout=None, figure_flow=None) -> None:
+        self.llm_client = llm_client
+        self.operation_client = operation_client
+        # two_calls : get_operation_figure then get_figure_template, combined : a single get_figure_answer call.
+        self.figure_flow = figure_flow or os.environ.get("FIGURE_FLOW", "two_calls")
+        # In the two calls flow, a figure chosen without the LLM can be shown while the LLM chooses the figure.
+        self.speculative_figure = os.environ.get("FIGURE_SPECULATIVE", "0") == "1"
+        # Timeouts in seconds of each stage.
+        self.stage_timeout = {
+            "list_operation": 60,
+            "read_operation": 30,
+            "interpretation": 60,
+            "operation_figure": 60,
+            "figure_template": 60,
+            "figure_answer": 60,
+            "plot_figure": 30,
+        }
+        self.stage_timeout.update(stage_timeout or {})
+        # Each stage is a span of the trace of the request.
+        self.trace_client = get_shared_resource("trace_client", TraceClient)
+
+    async def run_stage(self, stage_name, coroutine):
+        """
+        Runs a stage and raises a TimeoutError if it takes longer than its timeout. The stage is cancelled at the
+        timeout (a query stage cancels its query). The stage is traced, with the number of rows of its result when
+        it is a table.
+
+        input:
+            stage_name (str)
+            coroutine (coroutine)
+
+        output:
+            (object) the result of the stage
+        """
+        with self.trace_client.span(stage_name) as span:
+            try:
+                result = await asyncio.wait_for(coroutine, self.stage_timeout[stage_name])
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"The stage {stage_name} took more than {self.stage_timeout[stage_name]} seconds.")
+            if isinstance(result, pd.DataFrame):
+                self.trace_client.add_attributes(span, rows=len(result))
+            return result
+
+    def stream_stage(self, stage_name, stream):
+        """
+        Yields the chunks of a streamed stage. Raises a TimeoutError if the stream lasts longer than the timeout
+        of the stage and a ValueError if the stream ends without any chunk.
+
+        input:
+            stage_name (str)
+            stream (generator)
+
+        output:
+            (generator) the chunks of the stream
+        """
+        deadline = time.monotonic() + self.stage_timeout[stage_name]
+        is_empty = True
+        try:
+            for chunk in stream:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"The stage {stage_name} took more than {self.stage_timeout[stage_name]} seconds.")
+                is_empty = False
+                yield chunk
+        finally:
+            # The request to the LLM is closed when the stream is abandoned.
+            stream.close()
+        if is_empty:
+            raise ValueError(f"The stage {stage_name} gave an empty answer.")
+
+    async def run_insight_query(self, prompt, full_response=None):
+        """
+        Runs the first part of the insight flow : SQL generation and query.
+        The interpretation can then be streamed with LLMClient.stream_interpretation.
+
+        input:
+            prompt (str)
+            full_response (dict) the answer of get_list_operation if it was already asked
+
+        output:
+            (dict) with the keys full_response and table_answer
+        """
+        if full_response is None:
+            full_response = await self.run_stage("list_operation", self.llm_client.aget_list_operation(prompt))
+        # A follow-up question asking for the query of a recent turn reuses its result, if the data didn't change since.
+        table_answer = None
+        if self.llm_client.conversation_memory.get_result(full_response["sql"], self.operation_client.database_client.data_stamp) is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.operation_client.database_client.refresh)
+            table_answer = self.llm_client.conversation_memory.get_result(full_response["sql"], self.operation_client.database_client.data_stamp)
+        if table_answer is not None:
+            self.trace_client.end_span(self.trace_client.start_span("read_operation", reused_from_memory=True, rows=len(table_answer)))
+        else:
+            table_answer = await self.run_stage("read_operation", self.operation_client.aread_operation(full_response["sql"]))
+        return {"full_response": full_response, "table_answer": table_answer}
+
+    def remember_insight(self, prompt, full_response, table_answer, interpretation):
+        """
+        Adds a turn of the insight flow to the memory of the conversation, with the version of the data its
+        query ran on.
+
+        input:
+            prompt (str)
+            full_response (dict)
+            table_answer (pd.DataFrame)
+            interpretation (str)
+
+        no output
+        """
+        self.llm_client.add_turn_to_history(prompt, full_response, table_answer, interpretation, self.operation_client.database_client.data_stamp)
+
+    async def run_insight(self, prompt, full_response=None):
+        """
+        Runs the insight flow : SQL generation, query and interpretation of the result.
+
+        input:
+            prompt (str)
+            full_response (dict) the answer of get_list_operation if it was already asked
+
+        output:
+            (dict) with the keys full_response, table_answer and interpretation
+        """
+        insight_answer = await self.run_insight_query(prompt, full_response)
+        insight_answer["interpretation"] = await self.run_stage("interpretation", self.llm_client.aget_interpretation(
+            prompt, insight_answer["full_response"], insight_answer["table_answer"]))
+        return insight_answer
+
+    async def run_figure(self, prompt, full_response=None, on_preview=None):
+        """
+        Runs the figure flow : SQL generation, then the query and the choice of the figure template at the same time,
+        and finally the construction of the figure. In the combined flow, the SQL and the figure template come from
+        a single call and only the query remains.
+        If on_preview is given, a figure chosen without the LLM is built as soon as the query returns and passed
+        to on_preview while the LLM is still choosing the figure (speculative plotting).
+
+        input:
+            prompt (str)
+            full_response (dict) the answer of get_operation_figure (or get_figure_answer) if it was already streamed
+            on_preview (callable) called with a preview plotly figure
+
+        output:
+            (dict) with the keys full_response, figure_answer and plotly_figure
+        """
+        if full_response is None and self.figure_flow == "combined":
+            full_response = await self.run_stage("figure_answer", self.llm_client.aget_figure_answer(prompt))
+        elif full_response is None:
+            full_response = await self.run_stage("operation_figure", self.llm_client.aget_operation_figure(prompt))
+
+        # The query doesn't depend on the figure template so it runs while the LLM is answering.
+        # The figures reduce their points themselves, their queries return more rows than the ones of the insights.
+        read_task = asyncio.ensure_future(self.run_stage("read_operation", self.operation_client.aread_operation(
+            full_response["sql"], self.operation_client.guardrail_client.figure_max_result_rows)))
+        if all(key in full_response for key in self.FIGURE_TEMPLATE_KEYS):
+            template_task = None
+            figure_answer = {key: full_response[key] for key in self.FIGURE_TEMPLATE_KEYS}
+        else:
+            template_task = asyncio.ensure_future(self.run_stage("figure_template", self.llm_client.aget_figure_template(prompt, full_response)))
+        try:
+            result = pd.DataFrame(await read_task)
+            if template_task is not None and on_preview is not None and not template_task.done():
+                preview_answer = self.operation_client.figure_spec_client.get_default_template(result)
+                with self.trace_client.span("preview_figure", rows=len(result)):
+                    on_preview(await asyncio.get_running_loop().run_in_executor(None, self.operation_client.build_figure, result, preview_answer))
+            if template_task is not None:
+                figure_answer = await template_task
+        finally:
+            if template_task is not None and not template_task.done():
+                template_task.cancel()
+        figure_answer = await self.check_figure_template(prompt, full_response, result, figure_answer)
+        plotly_figure = await self.run_stage("plot_figure", asyncio.get_running_loop().run_in_executor(
+            None, self.operation_client.build_figure, result, figure_answer))
+        return {"full_response": full_response, "figure_answer": figure_answer, "plotly_figure": plotly_figure}
+
+    async def check_figure_template(self, prompt, full_response, result, figure_answer):
+        """
+        Checks the figure template against the result of the query. What can be fixed locally is fixed, otherwise
+        the LLM is asked once to fix the template. Raises a FigureSpecError if the template still doesn't match.
+
+        input:
+            prompt (str)
+            full_response (dict)
+            result (pd.DataFrame)
+            figure_answer (dict)
+
+        output:
+            (dict) the template to plot
+        """
+        figure_spec_client = self.operation_client.figure_spec_client
+        # The combined flow wrote the SQL query and the template in a single call.
+        template_calls = 1 if all(key in full_response for key in self.FIGURE_TEMPLATE_KEYS) else 2
+        repaired_answer, problems = figure_spec_client.repair(figure_answer, result)
+        if not problems:
+            is_unchanged = all((repaired_answer[key] or None) == (figure_answer.get(key) or None) for key in ("figure_type", "x_label", "y_label", "color"))
+            figure_spec_client.record("valid" if is_unchanged else "repaired_locally", template_calls)
+            return repaired_answer
+
+        figure_answer = await self.run_stage("figure_template", self.llm_client.arepair_figure_template(
+            prompt, full_response, figure_answer, figure_spec_client.describe_result(result), problems))
+        repaired_answer, problems = figure_spec_client.repair(figure_answer, result)
+        if problems:
+            figure_spec_client.record("failed", template_calls)
+            raise FigureSpecError(" ".join(problems))
+        figure_spec_client.record("repaired_by_llm", template_calls)
+        return repaired_answer
+
+    async def run_many(self, prompts, flow="insight"):
+        """
+        Runs a flow for several prompts at the same time. Failed prompts return their exception.
+
+        input:
+            prompts (list)
+            flow (str) insight or figure
+
+        output:
+            (list)
+        """
+        run = self.run_insight if flow == "insight" else self.run_figure
+        return await asyncio.gather(*[run(prompt) for prompt in prompts], return_exceptions=True)
+
+
+def run_benchmark(questions):
+    """
+    Prints, for each figure flow, the time until the first and the final figure of the figure questions and the
+    calls to the LLM per figure. The answers come from the LLM backend : with LLM_BACKEND=replay, the recorded
+    answers of each stage are served with their recorded latency, so the flows are compared without network.
+    The queries run on the data, the query cache is cleared before each figure.
+
+    input:
+        questions (list) of dict with the keys question and flow, only the figure questions are run
+
+    output:
+        (list) of dict, the measures of each flow
+    """
+    from helper.figure_spec_client import FigureSpecClient
+    from helper.LLM_client import LLMClient
+    from helper.operation_client import OperationClient
+
+    llm_client = LLMClient()
+    # The answers of the LLM are not taken from the response cache, to measure the backend.
+    llm_client.response_cache = None
+    operation_client = get_shared_resource("operation_client", OperationClient)
+    prompts = [question["question"] for question in questions if question.get("flow", "insight") == "figure"]
+
+    async def run_flow(pipeline_client, speculative):
+        first_figure_seconds, final_figure_seconds, errors = [], [], 0
+        for prompt in prompts:
+            operation_client.query_cache_client.clear()
+            first_figure = []
+            start = time.perf_counter()
+            on_preview = (lambda figure: first_figure.append(time.perf_counter() - start)) if speculative else None
+            try:
+                await pipeline_client.run_figure(prompt, on_preview=on_preview)
+            except Exception as e:
+                print(f"The question {prompt[:80]} failed in the {pipeline_client.figure_flow} flow : {e}")
+                errors += 1
+                continue
+            final_figure_seconds.append(time.perf_counter() - start)
+            first_figure_seconds.append((first_figure or final_figure_seconds[-1:])[0])
+        return first_figure_seconds, final_figure_seconds, errors
+
+    measures = []
+    print("flow	figures	errors	llm_calls_per_figure	first_figure_seconds	final_figure_seconds")
+    for flow, speculative in (("two_calls", False), ("two_calls", True), ("combined", False)):
+        # Each flow counts its own calls to the LLM.
+        operation_client.figure_spec_client = FigureSpecClient()
+        pipeline_client = PipelineClient(llm_client, operation_client, figure_flow=flow)
+        first_figure_seconds, final_figure_seconds, errors = asyncio.run(run_flow(pipeline_client, speculative))
+        measure = {
+            "flow": flow + (" + speculative" if speculative else ""),
+            "figures": len(final_figure_seconds),
+            "errors": errors,
+            "llm_calls_per_figure": operation_client.figure_spec_client.get_statistics()["llm_calls_per_figure"],
+            "first_figure_seconds": sum(first_figure_seconds) / len(first_figure_seconds) if first_figure_seconds else None,
+            "final_figure_seconds": sum(final_figure_seconds) / len(final_figure_seconds) if final_figure_seconds else None,
+        }
+        measures.append(measure)
+        if measure["figures"]:
+            print(f"{measure['flow']}\t{measure['figures']}\t{errors}\t{measure['llm_calls_per_figure']:.2f}\t{measure['first_figure_seconds']:.2f}\t{measure['final_figure_seconds']:.2f}")
+        else:
+            print(f"{measure['flow']}\t0\t{errors}\t-\t-\t-")
+    return measures
+
+
+def run_throughput_benchmark(user_counts=(1, 4, 16, 64), llm_latency=1.0, row_count=200000, questions_per_user=2):
+    """
+    Prints the throughput of the insight flow when user_counts users ask their questions at the same time, with a
+    LLM answering after llm_latency seconds. The queries run on the real operation client, on a synthetic table
+    of row_count rows in a temporary data folder : each question asks a different query so that none is read
+    from the cache of results.
+    The queries of every session share one SQLite connection behind the lock of the database client, so the SQL
+    is serialized : sql_busy_share, the time the queries would take one after the other over the measured time,
+    gets close to 1 when the connection is the bottleneck, whatever the number of executor threads.
+
+    input:
+        user_counts (tuple) of int
+        llm_latency (float)
+        row_count (int) rows of the synthetic table
+        questions_per_user (int) asked one after the other by each user
+
+    output:
+        (list) of dict, the measures for each number of users
+    """
+    import tempfile
+
+    import numpy as np
+
+    from helper.operation_client import OperationClient
+    from helper.resource_client import clear_shared_resources
+
+    class BenchmarkLLMClient:
+        class conversation_memory:
+            @staticmethod
+            def get_result(sql, data_stamp):
+                return None
+
+        async def aget_list_operation(self, prompt):
+            await asyncio.sleep(llm_latency)
+            return {"reasoning": "", "sql": prompt}
+
+        async def aget_interpretation(self, prompt, full_response, table_answer):
+            await asyncio.sleep(llm_latency)
+            return "interpretation"
+
+    async def run_users(pipeline_client, user_count, first_question):
+        async def run_user(user):
+            for question in range(questions_per_user):
+                # The question is its own query, the price threshold makes every query different.
+                await pipeline_client.run_insight(f"SELECT provider, year, AVG(price) AS price FROM sales WHERE price > {first_question + user * questions_per_user + question} GROUP BY provider, year")
+        await asyncio.gather(*[run_user(user) for user in range(user_count)])
+
+    environment = dict(os.environ)
+    working_folder = os.getcwd()
+    measures = []
+    with tempfile.TemporaryDirectory() as folder:
+        os.makedirs(os.path.join(folder, "data"))
+        random_generator = np.random.default_rng(0)
+        pd.DataFrame({"provider": random_generator.choice(["A", "B", "C", "D"], row_count), "year": random_generator.integers(2015, 2026, row_count),
+                      "price": random_generator.uniform(0, 10000, row_count).round(2)}).to_csv(os.path.join(folder, "data", "sales.csv"), sep=";", index=False)
+        with open(os.path.join(folder, "data", "catalog.json"), "w", encoding="utf-8") as f:
+            f.write('{"scan_data_folder": true, "tables": {}}')
+        # The operation client finds its tables in the data folder of the working folder.
+        os.chdir(folder)
+        os.environ.pop("DATABASE_FILE", None)
+        os.environ.pop("DATA_WATCH_INTERVAL", None)
+        clear_shared_resources()
+        try:
+            operation_client = get_shared_resource("operation_client", OperationClient)
+            trace_client = get_shared_resource("trace_client", TraceClient)
+            # Time of a query alone on the connection.
+            start = time.perf_counter()
+            operation_client.read_operation("SELECT provider, year, AVG(price) AS price FROM sales WHERE price > -1 GROUP BY provider, year")
+            sql_seconds = time.perf_counter() - start
+
+            print("users	questions	seconds	questions_per_second	p50_sql_seconds	sql_busy_share")
+            first_question = 0
+            for user_count in user_counts:
+                trace_client.clear()
+                pipeline_client = PipelineClient(BenchmarkLLMClient(), operation_client)
+                start = time.perf_counter()
+                asyncio.run(run_users(pipeline_client, user_count, first_question))
+                seconds = time.perf_counter() - start
+                first_question += user_count * questions_per_user
+                questions = user_count * questions_per_user
+                sql_statistics = next((stage for stage in trace_client.get_stage_statistics() if stage["stage"] == "sql_query"), {})
+                measure = {"users": user_count, "questions": questions, "seconds": seconds, "questions_per_second": questions / seconds,
+                           "p50_sql_seconds": sql_statistics.get("p50_seconds"), "sql_busy_share": min(1.0, questions * sql_seconds / seconds)}
+                measures.append(measure)
+                print(f"{user_count}\t{questions}\t{seconds:.2f}\t{measure['questions_per_second']:.2f}\t{measure['p50_sql_seconds']:.3f}\t{measure['sql_busy_share']:.2f}")
+            print(f"A query alone takes {sql_seconds:.3f} s. The queries of all the sessions run one at a time on the shared connection : "
+                  f"the throughput is bounded by {1 / sql_seconds:.1f} questions per second.")
+            operation_client.database_client.index_executor.shutdown()
+            operation_client.database_client.connection.close()
+        finally:
+            clear_shared_resources()
+            os.chdir(working_folder)
+            os.environ.clear()
+            os.environ.update(environment)
+    return measures
+
+
+if __name__ == "__main__":
+    from helper.batch_client import DEFAULT_QUESTIONS, BatchClient
+
+    parser = argparse.ArgumentParser(description="Benchmarks the figure flows, or the throughput of the insight flow for concurrent users.")
+    parser.add_argument("questions_file", nargs="?", help="jsonl file of questions (same format as the batch runner) to benchmark the figure flows, the questions of the README by default")
+    parser.add_argument("--users", type=int, nargs="+", help="numbers of users asking at the same time, benchmarks the throughput of the insight flow")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="seconds before each answer of the stubbed LLM of the throughput benchmark")
+    parser.add_argument("--rows", type=int, default=200000, help="rows of the synthetic table queried by the throughput benchmark")
+    arguments = parser.parse_args()
+
+    if arguments.users:
+        run_throughput_benchmark(arguments.users, arguments.llm_latency, arguments.rows)
+    else:
+        run_benchmark(BatchClient.read_questions(arguments.questions_file) if arguments.questions_file else DEFAULT_QUESTIONS)
@@ -0,0 +1,214 @@
+"""
+A cache for the results of the SQL queries, keyed on the normalized query and the version of the data.
+The cache is bounded in memory with LRU eviction and can spill the evicted results on disk.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import re
+import shutil
+import threading
+
+import pandas as pd
+
+
+class QueryCacheClient:
+    """
+    A cache for the results of the SQL queries, keyed on the normalized query and the version of the data.
+    """
+    # String literals, quoted identifiers, comments, numbers, words and any other character.
+    SQL_TOKEN_PATTERN = re.compile(r"""
+        (?P<string>'(?:[^']|'')*')
+        | (?P<identifier>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])
+        | (?P<comment>--[^\n]*|/\*.*?\*/)
+        | (?P<number>\d+\.\d*|\.\d+|\d+)(?![\w.])
+        | (?P<word>[^\W\d]\w*)
+        | (?P<space>\s+)
+        | (?P<other>.)
+        """, re.VERBOSE | re.DOTALL)
+
+    def __init__(self, max_memory_bytes=256 * 1024 * 1024, spill_folder=None) -> None:
+        self.max_memory_bytes = max_memory_bytes
+        # Results evicted from memory are written in spill_folder (if given) and read back on the next hit.
+        self.spill_folder = spill_folder
+        self.memory_cache = OrderedDict()
+        self.memory_bytes = 0
+        self.data_stamp = None
+        self.lock = threading.RLock()
+        self.statistics = {"memory_hit": 0, "disk_hit": 0, "miss": 0}
+
+    def normalize_sql(self, sql_operation):
+        """
+        Normalizes a query so that queries differing only by their whitespace, comments, keyword case
+        or the writing of their numbers share the same key. String literals are kept as they are.
+
+        input:
+            sql_operation (str)
+
+        output:
+            (str)
+        """
+        tokens = []
+        for match in self.SQL_TOKEN_PATTERN.finditer(sql_operation):
+            kind, value = match.lastgroup, match.group()
+            if kind in ("space", "comment"):
+                continue
+            if kind == "word":
+                value = value.lower()
+            elif kind == "number" and "." in value:
+                # The decimal point is kept because 2 and 2.0 don't give the same divisions in SQLite.
+                integer_part, decimal_part = value.split(".")
+                value = f"{integer_part or '0'}.{decimal_part.rstrip('0') or '0'}"
+            elif kind == "identifier" and value[0] == '"' and re.fullmatch(r'"[^\W\d]\w*"', value):
+                # A double quoted identifier without special characters is the same as an unquoted one.
+                value = value[1:-1].lower()
+            tokens.append(value)
+        while tokens and tokens[-1] == ";":
+            tokens.pop()
+        return " ".join(tokens)
+
+    def make_key(self, sql_operation, data_stamp):
+        """
+        Returns the key of a query for a version of the data.
+
+        input:
+            sql_operation (str)
+            data_stamp (str)
+
+        output:
+            (str)
+        """
+        return hashlib.sha256(f"{data_stamp}\x00{self.normalize_sql(sql_operation)}".encode("utf-8")).hexdigest()
+
+    def get_spill_path(self, key):
+        """
+        Returns the address of a result spilled on disk.
+
+        input:
+            key (str)
+
+        output:
+            (str)
+        """
+        return os.path.join(self.spill_folder, f"{key}.pkl")
+
+    def check_data_stamp(self, data_stamp):
+        """
+        Forgets every cached result if the data changed.
+
+        input:
+            data_stamp (str)
+
+        no output
+        """
+        if data_stamp != self.data_stamp:
+            self.clear()
+            self.data_stamp = data_stamp
+
+    def get(self, sql_operation, data_stamp):
+        """
+        Returns the cached result of a query, or None if it is not in the cache.
+
+        input:
+            sql_operation (str)
+            data_stamp (str) version of the data the query runs on
+
+        output:
+            (pd.DataFrame) or None
+        """
+        key = self.make_key(sql_operation, data_stamp)
+        with self.lock:
+            self.check_data_stamp(data_stamp)
+            if key in self.memory_cache:
+                self.memory_cache.move_to_end(key)
+                self.statistics["memory_hit"] += 1
+                return self.memory_cache[key]
+            if self.spill_folder is not None and os.path.exists(self.get_spill_path(key)):
+                result = pd.read_pickle(self.get_spill_path(key))
+                self.store_in_memory(key, result)
+                self.statistics["disk_hit"] += 1
+                return result
+            self.statistics["miss"] += 1
+            return None
+
+    def set(self, sql_operation, data_stamp, result):
+        """
+        Caches the result of a query.
+
+        input:
+            sql_operation (str)
+            data_stamp (str)
+            result (pd.DataFrame)
+
+        no output
+        """
+        key = self.make_key(sql_operation, data_stamp)
+        with self.lock:
+            self.check_data_stamp(data_stamp)
+            self.store_in_memory(key, result)
+
+    def store_in_memory(self, key, result):
+        """
+        Stores a result in memory and evicts the least recently used results above max_memory_bytes.
+
+        input:
+            key (str)
+            result (pd.DataFrame)
+
+        no output
+        """
+        if key in self.memory_cache:
+            self.memory_bytes -= self.get_size(self.memory_cache.pop(key))
+        self.memory_cache[key] = result
+        self.memory_bytes += self.get_size(result)
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory_cache) > 1:
+            evicted_key, evicted_result = self.memory_cache.popitem(last=False)
+            self.memory_bytes -= self.get_size(evicted_result)
+            if self.spill_folder is not None:
+                os.makedirs(self.spill_folder, exist_ok=True)
+                evicted_result.to_pickle(self.get_spill_path(evicted_key))
+
+    @staticmethod
+    def get_size(result):
+        """
+        Returns the memory used by a result.
+
+        input:
+            result (pd.DataFrame)
+
+        output:
+            (int) bytes
+        """
+        return int(result.memory_usage(index=True, deep=True).sum())
+
+    def clear(self):
+        """
+        Forgets every cached result, in memory and on disk.
+
+        no input
+
+        no output
+        """
+        with self.lock:
+            self.memory_cache.clear()
+            self.memory_bytes = 0
+            if self.spill_folder is not None and os.path.isdir(self.spill_folder):
+                shutil.rmtree(self.spill_folder, ignore_errors=True)
+
+    def get_statistics(self):
+        """
+        Returns the hit and miss counters of the cache.
+
+        no input
+
+        output:
+            (dict)
+        """
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics["memory_bytes"] = self.memory_bytes
+            statistics["entries"] = len(self.memory_cache)
+        total = statistics["memory_hit"] + statistics["disk_hit"] + statistics["miss"]
+        statistics["hit_rate"] = (statistics["memory_hit"] + statistics["disk_hit"]) / total if total else 0.0
+        return statistics
@@ -0,0 +1,716 @@
+"""
+A client making the calls to the LLM resilient : each call has a deadline, the calls which failed because the
+deployment is throttled, slow or unavailable are retried with an exponential backoff (or after the delay asked by the
+Retry-After header of a 429 error), a circuit breaker stops calling a deployment which keeps failing, the calls fall
+back to a secondary deployment and a limiter shared by every session caps the calls running at the same time.
+Run `python -m helper.resilience_client` to check it against a local fake server injecting latency and errors.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
+import os
+import random
+import threading
+import time
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from helper.resource_client import get_shared_resource
+from helper.trace_client import TraceClient, bind_context
+
+
+# Deployments which answered the calls made in a block of record_deployments. The list is shared by the contexts
+# copied from the one of the block (the tasks and executors of langchain), so the answers of the calls are seen.
+answering_deployments = contextvars.ContextVar("answering_deployments", default=None)
+
+
+@contextmanager
+def record_deployments(deployments=None):
+    """
+    Records the deployments which answer the calls to the LLM made in the block.
+
+    input:
+        deployments (list) to complete, a new list by default
+
+    output:
+        (list) of str, completed by the calls of the block
+    """
+    deployments = deployments if deployments is not None else []
+    token = answering_deployments.set(deployments)
+    try:
+        yield deployments
+    finally:
+        answering_deployments.reset(token)
+
+
+class LLMUnavailableError(RuntimeError):
+    """
+    Raised when no deployment of the LLM answered : every attempt failed, the circuits are open or too many
+    calls are waiting.
+    """
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker : after failure_threshold failures in a row, the circuit opens and the deployment is not
+    called for reset_seconds. Then a single call is let through (half open) : the circuit closes if it succeeds
+    and opens again if it fails.
+    """
+    def __init__(self, failure_threshold=5, reset_seconds=30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        Returns the state letting the deployment be called : closed, or half_open for the trial call.
+        None if the deployment can't be called.
+
+        no input
+
+        output:
+            (str) or None
+        """
+        with self.lock:
+            if self.state == "closed":
+                return "closed"
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                # The trial call : the other calls are refused until it ends.
+                self.state = "half_open"
+                return "half_open"
+            return None
+
+    def release_trial(self):
+        """
+        Ends a trial call which neither succeeded nor failed (refused prompt, call given up or cancelled) :
+        the circuit is open again and the next call is the trial.
+
+        no input
+
+        no output
+        """
+        with self.lock:
+            if self.state == "half_open":
+                self.state = "open"
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class ConcurrencyLimiter:
+    """
+    Caps the calls to the LLM running at the same time. It is shared by the sessions of the process, which run
+    their calls in different threads and event loops, so it is a thread semaphore awaited by polling in the
+    event loops.
+    """
+    def __init__(self, max_concurrency=8) -> None:
+        self.max_concurrency = max_concurrency
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def count(self, in_flight=0, waiting=0):
+        with self.lock:
+            self.in_flight += in_flight
+            self.waiting += waiting
+
+    def acquire(self, timeout):
+        """
+        Waits for a slot, at most timeout seconds.
+
+        input:
+            timeout (float)
+
+        output:
+            (bool) False if no slot was free in time
+        """
+        self.count(waiting=1)
+        acquired = self.semaphore.acquire(timeout=timeout)
+        self.count(in_flight=int(acquired), waiting=-1)
+        return acquired
+
+    async def aacquire(self, timeout, poll_seconds=0.01):
+        """
+        Waits for a slot without blocking the event loop, at most timeout seconds.
+
+        input:
+            timeout (float)
+            poll_seconds (float)
+
+        output:
+            (bool) False if no slot was free in time
+        """
+        self.count(waiting=1)
+        deadline = time.monotonic() + timeout
+        acquired = self.semaphore.acquire(blocking=False)
+        while not acquired and time.monotonic() < deadline:
+            await asyncio.sleep(poll_seconds)
+            acquired = self.semaphore.acquire(blocking=False)
+        self.count(in_flight=int(acquired), waiting=-1)
+        return acquired
+
+    def release(self):
+        self.count(in_flight=-1)
+        self.semaphore.release()
+
+
+class ResilienceClient:
+    """
+    A client making the calls to the LLM resilient. The deployments are tried in order : the primary deployment,
+    then the fallback deployment when the primary one failed or its circuit is open.
+    """
+    def __init__(self, timeout_seconds=None, attempt_timeout_seconds=None, max_retries=None, base_delay=None, max_delay=None, failure_threshold=None, reset_seconds=None, max_concurrency=None) -> None:
+        # Deadline of each call, its attempts, the waits between them and for a slot of the limiter included.
+        self.timeout_seconds = timeout_seconds if timeout_seconds is not None else float(os.environ.get("LLM_TIMEOUT_SECONDS", "45"))
+        # Deadline of each attempt, so that a slow deployment leaves time to the other attempts.
+        self.attempt_timeout_seconds = attempt_timeout_seconds if attempt_timeout_seconds is not None else float(os.environ.get("LLM_ATTEMPT_TIMEOUT_SECONDS", "30"))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("LLM_MAX_RETRIES", "3"))
+        self.base_delay = base_delay if base_delay is not None else float(os.environ.get("LLM_RETRY_BASE_DELAY", "1"))
+        # A Retry-After longer than this is not waited for, the call fails.
+        self.max_delay = max_delay if max_delay is not None else float(os.environ.get("LLM_RETRY_MAX_DELAY", "30"))
+        self.failure_threshold = failure_threshold if failure_threshold is not None else int(os.environ.get("LLM_CIRCUIT_FAILURE_THRESHOLD", "5"))
+        self.reset_seconds = reset_seconds if reset_seconds is not None else float(os.environ.get("LLM_CIRCUIT_RESET_SECONDS", "30"))
+        max_concurrency = max_concurrency if max_concurrency is not None else int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+        self.limiter = ConcurrencyLimiter(max_concurrency)
+        # Runs the synchronous calls, so that the caller stops waiting at the deadline.
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm_call")
+        self.breakers = {}
+        self.statistics = {"calls": 0, "retries": 0, "fallbacks": 0, "timeouts": 0, "rate_limited": 0, "rejected_by_circuit": 0, "limiter_timeouts": 0, "failures": 0}
+        self.lock = threading.Lock()
+        self.trace_client = get_shared_resource("trace_client", TraceClient)
+
+    def get_breaker(self, deployment):
+        with self.lock:
+            if deployment not in self.breakers:
+                self.breakers[deployment] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+            return self.breakers[deployment]
+
+    def record(self, key, count=1):
+        with self.lock:
+            self.statistics[key] += count
+
+    @staticmethod
+    def get_status_code(error):
+        return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+    @classmethod
+    def get_retry_after(cls, error):
+        """
+        Returns the delay asked by the Retry-After (or retry-after-ms) header of an error, or None.
+        The error raised in place of the error of the API is looked into too.
+
+        input:
+            error (Exception)
+
+        output:
+            (float) or None
+        """
+        while error is not None:
+            headers = getattr(getattr(error, "response", None), "headers", None)
+            if headers is not None:
+                try:
+                    if headers.get("retry-after-ms") is not None:
+                        return float(headers.get("retry-after-ms")) / 1000
+                    if headers.get("retry-after") is not None:
+                        return float(headers.get("retry-after"))
+                except (TypeError, ValueError):
+                    pass
+            error = error.__cause__
+        return None
+
+    @classmethod
+    def is_retryable(cls, error):
+        """
+        Returns True if an error comes from a throttled, slow or unavailable deployment, and the call is worth
+        another attempt. The other errors (a refused prompt, a wrong key) fail the call right away.
+
+        input:
+            error (Exception)
+
+        output:
+            (bool)
+        """
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        if type(error).__name__ in ("APITimeoutError", "APIConnectionError", "RateLimitError", "InternalServerError"):
+            return True
+        return cls.get_status_code(error) in (408, 409, 429, 500, 502, 503, 504)
+
+    def on_error(self, deployment, error):
+        """
+        Counts a failed attempt. The error is raised again if it is not worth another attempt, without counting
+        it as a failure of the deployment.
+
+        input:
+            deployment (str)
+            error (Exception)
+
+        no output
+        """
+        if not self.is_retryable(error):
+            raise error
+        self.get_breaker(deployment).record_failure()
+        self.record("failures")
+        if isinstance(error, TimeoutError) or type(error).__name__ == "APITimeoutError":
+            self.record("timeouts")
+        if self.get_status_code(error) == 429 or type(error).__name__ == "RateLimitError":
+            self.record("rate_limited")
+
+    def allow_request(self, deployment):
+        """
+        Checks the circuit of a deployment right before calling it.
+
+        input:
+            deployment (str)
+
+        output:
+            (str) closed or half_open if the deployment can be called, None otherwise
+        """
+        state = self.get_breaker(deployment).allow_request()
+        if state is None:
+            self.record("rejected_by_circuit")
+        return state
+
+    def end_attempt(self, deployment, state):
+        """
+        Ends an attempt on a deployment : a trial call which neither succeeded nor failed is released, so that
+        the circuit doesn't stay half open.
+
+        input:
+            deployment (str)
+            state (str) returned by allow_request
+
+        no output
+        """
+        if state == "half_open":
+            self.get_breaker(deployment).release_trial()
+
+    def get_attempt_timeout(self, deadline):
+        """
+        Returns the time left to an attempt : its own deadline, within the deadline of the call.
+
+        input:
+            deadline (float) time.monotonic() at the deadline of the call
+
+        output:
+            (float)
+        """
+        return max(0.0, min(self.attempt_timeout_seconds, deadline - time.monotonic()))
+
+    def get_delay(self, errors, attempt):
+        """
+        Returns the time to wait before the next attempt : the longest Retry-After of the errors, or an exponential
+        backoff with jitter. None if the deployment asked to wait longer than max_delay.
+
+        input:
+            errors (list) of Exception, the errors of the attempt
+            attempt (int) number of the failed attempt, starting at 0
+
+        output:
+            (float) or None
+        """
+        retry_after = [delay for delay in (self.get_retry_after(error) for error in errors) if delay is not None]
+        if retry_after:
+            return max(retry_after) if max(retry_after) <= self.max_delay else None
+        return min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def on_success(self, deployments, deployment, attempt):
+        self.get_breaker(deployment).record_success()
+        if answering_deployments.get() is not None:
+            answering_deployments.get().append(deployment)
+        if deployment != next(iter(deployments)):
+            self.record("fallbacks")
+        self.trace_client.add_attributes(**{"llm.deployment": deployment, "llm.retries": attempt})
+
+    def get_unavailable_error(self, errors):
+        if not errors:
+            return LLMUnavailableError("The circuits of every LLM deployment are open.")
+        return LLMUnavailableError(f"No LLM deployment answered : {type(errors[-1]).__name__}: {errors[-1]}")
+
+    def call(self, deployments, function):
+        """
+        Calls function(chat model) on the deployments until one answers before the deadline of the call.
+
+        input:
+            deployments (dict) name -> chat model, the primary deployment first
+            function (callable) the call of a chat model
+
+        output:
+            the result of function
+        """
+        self.record("calls")
+        deadline = time.monotonic() + self.timeout_seconds
+        errors = []
+        for attempt in range(self.max_retries + 1):
+            attempt_errors = []
+            for deployment, chat_model in deployments.items():
+                if time.monotonic() >= deadline:
+                    break
+                state = self.allow_request(deployment)
+                if state is None:
+                    continue
+                try:
+                    if not self.limiter.acquire(self.get_attempt_timeout(deadline)):
+                        # No slot freed in time : like a timeout, the call falls through to the next deployment.
+                        self.record("limiter_timeouts")
+                        attempt_errors.append(TimeoutError("Too many calls to the LLM are waiting."))
+                        continue
+                    future = self.executor.submit(bind_context(function), chat_model)
+                    # The slot is freed when the call really ends, even if the caller stopped waiting for it.
+                    future.add_done_callback(lambda _: self.limiter.release())
+                    try:
+                        result = future.result(timeout=self.get_attempt_timeout(deadline))
+                    except Exception as e:
+                        self.on_error(deployment, e)
+                        attempt_errors.append(e)
+                        continue
+                    self.on_success(deployments, deployment, attempt)
+                    return result
+                finally:
+                    self.end_attempt(deployment, state)
+            errors.extend(attempt_errors)
+            delay = self.get_delay(attempt_errors, attempt)
+            if attempt == self.max_retries or delay is None or time.monotonic() + delay >= deadline:
+                break
+            self.record("retries")
+            time.sleep(delay)
+        raise self.get_unavailable_error(errors) from (errors[-1] if errors else None)
+
+    async def acall(self, deployments, function):
+        """
+        Awaits function(chat model) on the deployments until one answers before the deadline of the call.
+
+        input:
+            deployments (dict) name -> chat model, the primary deployment first
+            function (callable) returning the coroutine of a call of a chat model
+
+        output:
+            the result of function
+        """
+        self.record("calls")
+        deadline = time.monotonic() + self.timeout_seconds
+        errors = []
+        for attempt in range(self.max_retries + 1):
+            attempt_errors = []
+            for deployment, chat_model in deployments.items():
+                if time.monotonic() >= deadline:
+                    break
+                state = self.allow_request(deployment)
+                if state is None:
+                    continue
+                try:
+                    if not await self.limiter.aacquire(self.get_attempt_timeout(deadline)):
+                        # No slot freed in time : like a timeout, the call falls through to the next deployment.
+                        self.record("limiter_timeouts")
+                        attempt_errors.append(TimeoutError("Too many calls to the LLM are waiting."))
+                        continue
+                    try:
+                        result = await asyncio.wait_for(function(chat_model), self.get_attempt_timeout(deadline))
+                    except Exception as e:
+                        self.on_error(deployment, e)
+                        attempt_errors.append(e)
+                        continue
+                    finally:
+                        self.limiter.release()
+                    self.on_success(deployments, deployment, attempt)
+                    return result
+                finally:
+                    self.end_attempt(deployment, state)
+            errors.extend(attempt_errors)
+            delay = self.get_delay(attempt_errors, attempt)
+            if attempt == self.max_retries or delay is None or time.monotonic() + delay >= deadline:
+                break
+            self.record("retries")
+            await asyncio.sleep(delay)
+        raise self.get_unavailable_error(errors) from (errors[-1] if errors else None)
+
+    def stream(self, deployments, function):
+        """
+        Streams function(chat model) from the deployments. The deadline of the call applies to the first chunk :
+        once a chunk was given, the stream can't be retried and its errors are raised.
+
+        input:
+            deployments (dict) name -> chat model, the primary deployment first
+            function (callable) returning the stream of a chat model
+
+        output:
+            (generator) the chunks
+        """
+        self.record("calls")
+        deadline = time.monotonic() + self.timeout_seconds
+        errors = []
+        for attempt in range(self.max_retries + 1):
+            attempt_errors = []
+            for deployment, chat_model in deployments.items():
+                if time.monotonic() >= deadline:
+                    break
+                state = self.allow_request(deployment)
+                if state is None:
+                    continue
+                try:
+                    if not self.limiter.acquire(self.get_attempt_timeout(deadline)):
+                        # No slot freed in time : like a timeout, the call falls through to the next deployment.
+                        self.record("limiter_timeouts")
+                        attempt_errors.append(TimeoutError("Too many calls to the LLM are waiting."))
+                        continue
+                    iterator = iter(function(chat_model))
+                    future = self.executor.submit(bind_context(lambda: next(iterator, None)))
+                    try:
+                        first_chunk = future.result(timeout=self.get_attempt_timeout(deadline))
+                    except Exception as e:
+                        future.add_done_callback(lambda _: self.limiter.release())
+                        self.on_error(deployment, e)
+                        attempt_errors.append(e)
+                        continue
+                    self.on_success(deployments, deployment, attempt)
+                    try:
+                        if first_chunk is not None:
+                            yield first_chunk
+                        yield from iterator
+                    finally:
+                        self.limiter.release()
+                    return
+                finally:
+                    self.end_attempt(deployment, state)
+            errors.extend(attempt_errors)
+            delay = self.get_delay(attempt_errors, attempt)
+            if attempt == self.max_retries or delay is None or time.monotonic() + delay >= deadline:
+                break
+            self.record("retries")
+            time.sleep(delay)
+        raise self.get_unavailable_error(errors) from (errors[-1] if errors else None)
+
+    async def astream(self, deployments, function):
+        """
+        Streams function(chat model) from the deployments in the event loop, see stream.
+
+        input:
+            deployments (dict) name -> chat model, the primary deployment first
+            function (callable) returning the asynchronous stream of a chat model
+
+        output:
+            (async generator) the chunks
+        """
+        self.record("calls")
+        deadline = time.monotonic() + self.timeout_seconds
+        errors = []
+        for attempt in range(self.max_retries + 1):
+            attempt_errors = []
+            for deployment, chat_model in deployments.items():
+                if time.monotonic() >= deadline:
+                    break
+                state = self.allow_request(deployment)
+                if state is None:
+                    continue
+                try:
+                    if not await self.limiter.aacquire(self.get_attempt_timeout(deadline)):
+                        # No slot freed in time : like a timeout, the call falls through to the next deployment.
+                        self.record("limiter_timeouts")
+                        attempt_errors.append(TimeoutError("Too many calls to the LLM are waiting."))
+                        continue
+                    iterator = function(chat_model).__aiter__()
+                    try:
+                        first_chunk = await asyncio.wait_for(anext(iterator, None), self.get_attempt_timeout(deadline))
+                    except Exception as e:
+                        self.limiter.release()
+                        await iterator.aclose()
+                        self.on_error(deployment, e)
+                        attempt_errors.append(e)
+                        continue
+                    self.on_success(deployments, deployment, attempt)
+                    try:
+                        if first_chunk is not None:
+                            yield first_chunk
+                        async for chunk in iterator:
+                            yield chunk
+                    finally:
+                        self.limiter.release()
+                    return
+                finally:
+                    self.end_attempt(deployment, state)
+            errors.extend(attempt_errors)
+            delay = self.get_delay(attempt_errors, attempt)
+            if attempt == self.max_retries or delay is None or time.monotonic() + delay >= deadline:
+                break
+            self.record("retries")
+            await asyncio.sleep(delay)
+        raise self.get_unavailable_error(errors) from (errors[-1] if errors else None)
+
+    def get_statistics(self):
+        """
+        Returns the counts of the calls, retries, fallbacks and failures, the state of the circuit of each deployment
+        and the calls running and waiting.
+
+        no input
+
+        output:
+            (dict)
+        """
+        with self.lock:
+            statistics = dict(self.statistics)
+            breakers = dict(self.breakers)
+        statistics["circuits"] = {deployment: breaker.state for deployment, breaker in breakers.items()}
+        statistics["in_flight"] = self.limiter.in_flight
+        statistics["waiting"] = self.limiter.waiting
+        return statistics
+
+
+class ResilientChatModel(BaseChatModel):
+    """
+    A chat model calling the deployments through the resilience client : the primary deployment, then the
+    fallback deployment.
+    """
+    # Chat model of each deployment, the primary deployment first.
+    chat_models: dict
+    resilience_client: Any
+
+    @property
+    def _llm_type(self):
+        return "resilient"
+
+    @staticmethod
+    def to_result(message):
+        # The token usage counted by the API is kept for the traces.
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"token_usage": message.response_metadata.get("token_usage")})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return self.to_result(self.resilience_client.call(self.chat_models, lambda chat_model: chat_model.invoke(messages, stop=stop, **kwargs)))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return self.to_result(await self.resilience_client.acall(self.chat_models, lambda chat_model: chat_model.ainvoke(messages, stop=stop, **kwargs)))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self.resilience_client.stream(self.chat_models, lambda chat_model: chat_model.stream(messages, stop=stop, **kwargs)):
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async for chunk in self.resilience_client.astream(self.chat_models, lambda chat_model: chat_model.astream(messages, stop=stop, **kwargs)):
+            yield ChatGenerationChunk(message=chunk)
+
+
+def run_resilience_check():
+    """
+    Checks the resilience client against a local fake server : a slow primary deployment, a throttled one,
+    a failing one, many calls at the same time and a full limiter. The outcome of each scenario is asserted.
+
+    no input
+
+    output:
+        (list) of dict, the outcome of each scenario
+    """
+    from langchain_core.messages import HumanMessage
+    from langchain_openai import AzureChatOpenAI
+
+    from helper.fake_llm_server import FakeLLMServer
+
+    server = FakeLLMServer().start()
+
+    def create_chat_model(deployment, timeout_seconds):
+        return AzureChatOpenAI(azure_endpoint=server.endpoint, openai_api_key="fake", api_version="2024-06-01",
+                               azure_deployment=deployment, timeout=timeout_seconds, max_retries=0)
+
+    def run_scenario(name, resilience_client, deployments, calls=1, concurrent=False, held_slot_seconds=0.0):
+        chat_model = ResilientChatModel(chat_models={deployment: create_chat_model(deployment, resilience_client.attempt_timeout_seconds) for deployment in deployments},
+                                        resilience_client=resilience_client)
+        # The requests abandoned at the deadline by the previous scenario end first.
+        while server.in_flight:
+            time.sleep(0.05)
+        server.statistics.clear()
+        server.max_in_flight = 0
+        if held_slot_seconds:
+            # Another call holds a slot of the limiter for held_slot_seconds.
+            resilience_client.limiter.acquire(0)
+            threading.Timer(held_slot_seconds, resilience_client.limiter.release).start()
+        errors = []
+        start = time.perf_counter()
+        if concurrent:
+            async def call():
+                try:
+                    await chat_model.ainvoke([HumanMessage("question")])
+                except Exception as e:
+                    errors.append(str(e))
+
+            async def call_all():
+                await asyncio.gather(*[call() for _ in range(calls)])
+            asyncio.run(call_all())
+        else:
+            for _ in range(calls):
+                try:
+                    "".join(chunk.content for chunk in chat_model.stream([HumanMessage("question")])) if name.startswith("stream") else chat_model.invoke([HumanMessage("question")])
+                except Exception as e:
+                    errors.append(str(e))
+        # The faults planned for the scenario and not used are forgotten.
+        server.planned_faults.clear()
+        return {
+            "scenario": name,
+            "seconds": round(time.perf_counter() - start, 2),
+            "errors": len(errors),
+            "requests": {deployment: statistics["requests"] for deployment, statistics in server.statistics.items()},
+            "max_in_flight": server.max_in_flight,
+            **{key: value for key, value in resilience_client.get_statistics().items() if key in ("retries", "fallbacks", "timeouts", "rate_limited", "rejected_by_circuit", "limiter_timeouts", "circuits")},
+        }
+
+    def check(outcome, condition):
+        assert condition, f"Unexpected outcome of the scenario {outcome['scenario']} : {outcome}"
+
+    outcomes = []
+    try:
+        # The primary deployment answers after the deadline : the fallback deployment answers.
+        server.plan("primary", [{"latency": 2.0}])
+        outcomes.append(run_scenario("slow_primary", ResilienceClient(timeout_seconds=2.0, attempt_timeout_seconds=0.5, max_retries=0), ["primary", "fallback"]))
+        check(outcomes[-1], outcomes[-1]["errors"] == 0 and outcomes[-1]["fallbacks"] == 1 and outcomes[-1]["seconds"] < 2.0)
+        # The primary deployment stays slow : the retries stop at the deadline of the call (about 1.2 seconds).
+        server.plan("primary", [{"latency": 2.0}] * 4)
+        outcomes.append(run_scenario("deadline", ResilienceClient(timeout_seconds=1.2, attempt_timeout_seconds=0.5, max_retries=3, base_delay=0.1), ["primary"]))
+        # One deadline for the whole call : the attempts and the waits between them end within the 1.2 seconds.
+        check(outcomes[-1], outcomes[-1]["errors"] == 1 and outcomes[-1]["seconds"] < 1.5)
+        # The deployment is throttled : the call waits for the Retry-After of the error and succeeds.
+        server.plan("primary", [{"status": 429, "retry_after": 1}])
+        outcomes.append(run_scenario("rate_limited", ResilienceClient(timeout_seconds=3.0, attempt_timeout_seconds=2.0, max_retries=2), ["primary"]))
+        check(outcomes[-1], outcomes[-1]["errors"] == 0 and outcomes[-1]["rate_limited"] == 1 and outcomes[-1]["seconds"] >= 1.0)
+        # The primary deployment keeps failing : its circuit opens after 3 failures and it is not called anymore.
+        server.plan("primary", [{"status": 500}] * 3)
+        outcomes.append(run_scenario("failing_primary", ResilienceClient(timeout_seconds=2.0, attempt_timeout_seconds=2.0, max_retries=0, failure_threshold=3), ["primary", "fallback"], calls=6))
+        check(outcomes[-1], outcomes[-1]["errors"] == 0 and outcomes[-1]["circuits"]["primary"] == "open" and outcomes[-1]["requests"]["primary"] == 3
+              and outcomes[-1]["rejected_by_circuit"] == 3)
+        # The trial call of a half open circuit gets a refused prompt : the trial is released and the next call closes the circuit.
+        server.plan("primary", [{"status": 500}, {"status": 400}])
+        outcomes.append(run_scenario("refused_trial", ResilienceClient(timeout_seconds=2.0, attempt_timeout_seconds=2.0, max_retries=0, failure_threshold=1, reset_seconds=0), ["primary"], calls=3))
+        check(outcomes[-1], outcomes[-1]["errors"] == 2 and outcomes[-1]["circuits"]["primary"] == "closed")
+        # The streamed answer of a slow primary deployment comes from the fallback deployment.
+        server.plan("primary", [{"latency": 2.0}])
+        outcomes.append(run_scenario("stream_slow_primary", ResilienceClient(timeout_seconds=2.0, attempt_timeout_seconds=0.5, max_retries=0), ["primary", "fallback"]))
+        check(outcomes[-1], outcomes[-1]["errors"] == 0 and outcomes[-1]["fallbacks"] == 1 and outcomes[-1]["seconds"] < 2.0)
+        # 20 calls at the same time, at most 4 reach the deployment at the same time.
+        server.plan("primary", [{"latency": 0.2}] * 20)
+        outcomes.append(run_scenario("concurrent_calls", ResilienceClient(timeout_seconds=5.0, attempt_timeout_seconds=5.0, max_retries=0, max_concurrency=4), ["primary"], calls=20, concurrent=True))
+        check(outcomes[-1], outcomes[-1]["errors"] == 0 and outcomes[-1]["max_in_flight"] <= 4)
+        # No slot of the limiter is freed before the attempt timeout : the call falls through to the fallback deployment.
+        outcomes.append(run_scenario("limiter_timeout", ResilienceClient(timeout_seconds=2.0, attempt_timeout_seconds=0.2, max_retries=0, max_concurrency=1), ["primary", "fallback"],
+                                     held_slot_seconds=0.3))
+        check(outcomes[-1], outcomes[-1]["errors"] == 0 and outcomes[-1]["limiter_timeouts"] == 1 and outcomes[-1]["fallbacks"] == 1)
+    finally:
+        server.stop()
+    return outcomes
+
+
+if __name__ == "__main__":
+    for outcome in run_resilience_check():
+        print(outcome)
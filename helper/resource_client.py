@@ -0,0 +1,126 @@
+"""
+A resource layer to share immutable objects (tables, prompts, LLM client, images) once per process between all sessions.
+Only the chat histories are kept per session.
+The memory held per session can be checked : python -m helper.resource_client
+"""
+
+import threading
+
+
+_shared_resources = {}
+# Reentrant because a factory can itself get shared resources (the operation client uses the shared database client).
+_shared_resources_lock = threading.RLock()
+
+
+def get_shared_resource(key, factory):
+    """
+    Returns the resource stored under a key, creates it with the factory on first call.
+    The same object is returned to every session of the process so it must not be modified.
+
+    input:
+        key (hashable)
+        factory (callable)
+
+    output:
+        (object)
+    """
+    with _shared_resources_lock:
+        if key not in _shared_resources:
+            _shared_resources[key] = factory()
+        return _shared_resources[key]
+
+
+def clear_shared_resources():
+    """
+    Forgets every shared resource. The next call to get_shared_resource recreates them.
+
+    no input
+
+    no output
+    """
+    with _shared_resources_lock:
+        _shared_resources.clear()
+
+
+def run_memory_check(session_counts=(1, 10, 50, 100), max_kb_per_session=64):
+    """
+    Simulates growing numbers of sessions, built like the pages build them, and measures the memory they hold.
+    The memory per session must stay small and flat : only the chat histories are kept per session. The check
+    runs on a synthetic data folder with the fake LLM backend, it needs neither the data nor the network.
+
+    input:
+        session_counts (tuple) of int, increasing
+        max_kb_per_session (float) memory added by each new session at most
+
+    output:
+        (list) of dict, the memory held for each number of sessions
+    """
+    import gc
+    import os
+    import tempfile
+    import tracemalloc
+
+    import pandas as pd
+
+    environment = dict(os.environ)
+    working_folder = os.getcwd()
+    outcomes = []
+    with tempfile.TemporaryDirectory() as folder:
+        os.makedirs(os.path.join(folder, "data"))
+        pd.DataFrame({"provider": ["A", "B"] * 50, "year": [2020 + index % 5 for index in range(100)], "price": [6000.0 + index for index in range(100)]}).to_csv(
+            os.path.join(folder, "data", "sales.csv"), sep=";", index=False)
+        # Only the synthetic table is listed, the default catalog lists the tables of the real data folder.
+        with open(os.path.join(folder, "data", "catalog.json"), "w", encoding="utf-8") as f:
+            f.write('{"scan_data_folder": true, "tables": {}}')
+        with open(os.path.join(folder, "data", "fake_llm_script.jsonl"), "w", encoding="utf-8") as f:
+            f.write("")
+        # The pages find the data in the data folder of the working folder.
+        os.chdir(folder)
+        os.environ.update({"LLM_BACKEND": "fake", "LLM_FAKE_SCRIPT": os.path.join(folder, "data", "fake_llm_script.jsonl"), "LLM_RESPONSE_CACHE": "0"})
+        os.environ.pop("DATABASE_FILE", None)
+        os.environ.pop("DATA_WATCH_INTERVAL", None)
+        clear_shared_resources()
+        try:
+            from helper.LLM_client import LLMClient
+            from helper.operation_client import OperationClient
+            from helper.pipeline_client import PipelineClient
+
+            # The shared resources are created before the measure, as the first session of the process does.
+            operation_client = get_shared_resource("operation_client", OperationClient)
+            LLMClient()
+
+            for session_count in session_counts:
+                gc.collect()
+                tracemalloc.start()
+                start_bytes = tracemalloc.get_traced_memory()[0]
+                sessions = []
+                for _ in range(session_count):
+                    llm_client = LLMClient()
+                    sessions.append({"llm_client": llm_client,
+                                     "operation_client": get_shared_resource("operation_client", OperationClient),
+                                     "pipeline_client": PipelineClient(llm_client, operation_client)})
+                gc.collect()
+                held_bytes = tracemalloc.get_traced_memory()[0] - start_bytes
+                tracemalloc.stop()
+                assert all(session["operation_client"] is operation_client for session in sessions)
+                outcomes.append({"sessions": session_count, "held_mb": round(held_bytes / 1024 ** 2, 3),
+                                 "kb_per_session": round(held_bytes / 1024 / session_count, 1)})
+                del sessions
+            operation_client.database_client.connection.close()
+        finally:
+            clear_shared_resources()
+            os.chdir(working_folder)
+            os.environ.clear()
+            os.environ.update(environment)
+
+    # The memory grows by at most max_kb_per_session for each new session, whatever the number of sessions.
+    for previous, outcome in zip(outcomes, outcomes[1:]):
+        growth_kb = (outcome["held_mb"] - previous["held_mb"]) * 1024 / (outcome["sessions"] - previous["sessions"])
+        assert growth_kb <= max_kb_per_session, f"Each session between {previous['sessions']} and {outcome['sessions']} sessions holds {growth_kb:.1f} KB."
+    assert outcomes[-1]["kb_per_session"] <= max_kb_per_session, outcomes[-1]
+    return outcomes
+
+
+if __name__ == "__main__":
+    for outcome in run_memory_check():
+        print(outcome)
@@ -0,0 +1,235 @@
+"""
+A client to serialize the results of the SQL queries compactly before sending them to the LLM or displaying them.
+Large results are replaced by aggregates and an extract of their rows.
+The serialization of duplicate columns is checked and the size of the prompts against the number of rows measured : python -m helper.result_summary_client
+"""
+
+import os
+
+import pandas as pd
+
+from helper.resource_client import get_shared_resource
+from helper.token_client import TokenClient
+
+
+class ResultSummaryClient:
+    """
+    A client to serialize the results of the SQL queries compactly before sending them to the LLM or displaying them.
+    """
+    ELISION_NOTE = "Une cellule vide signifie la même valeur qu'à la ligne précédente."
+
+    def __init__(self, max_rows=None, max_tokens=None, extract_rows=10, decimals=2, strategy="head_tail", max_distinct_values=20, display_max_rows=200) -> None:
+        # Above max_rows rows or max_tokens tokens, the result is summarized.
+        self.max_rows = max_rows or int(os.environ.get("RESULT_MAX_ROWS", "50"))
+        self.max_tokens = max_tokens or int(os.environ.get("RESULT_MAX_TOKENS", "3000"))
+        self.extract_rows = extract_rows
+        self.decimals = decimals
+        # head_tail shows the first and last rows of a summarized result, sample shows random rows.
+        self.strategy = strategy
+        self.max_distinct_values = max_distinct_values
+        self.display_max_rows = display_max_rows
+        self.token_client = get_shared_resource("token_client", TokenClient)
+
+    def serialize(self, table):
+        """
+        Serializes a result for the LLM : the whole table if it is small enough, otherwise a summary.
+
+        input:
+            table (pd.DataFrame or dict)
+
+        output:
+            (str)
+        """
+        truncation_note = self.get_truncation_note(table)
+        table = pd.DataFrame(table)
+        if len(table) <= self.max_rows:
+            text = self.to_compact_text(table, note=True)
+            if self.token_client.count_text(text) <= self.max_tokens:
+                return truncation_note + text
+        return truncation_note + self.summarize(table)
+
+    @staticmethod
+    def get_truncation_note(table):
+        """
+        Returns a note telling that a result was truncated by the limit of rows of the queries, or an empty string.
+
+        input:
+            table (pd.DataFrame or dict)
+
+        output:
+            (str)
+        """
+        truncated_at = getattr(table, "attrs", {}).get("truncated_at")
+        if not truncated_at:
+            return ""
+        return f"Attention : le résultat a été tronqué à ses {truncated_at} premières lignes, les lignes suivantes ne sont pas connues.\n"
+
+    @staticmethod
+    def deduplicate_columns(table):
+        """
+        Renames the duplicate columns of a table (product, product_1, ...), a join selecting every column of
+        two tables returns their common columns twice.
+
+        input:
+            table (pd.DataFrame)
+
+        output:
+            (pd.DataFrame)
+        """
+        if table.columns.is_unique:
+            return table
+        labels = []
+        for column in table.columns:
+            label, suffix = str(column), 0
+            while label in labels:
+                suffix += 1
+                label = f"{column}_{suffix}"
+            labels.append(label)
+        return table.set_axis(labels, axis=1)
+
+    def to_compact_text(self, table, note=False):
+        """
+        Serializes a table as tab separated values, with rounded numbers. In the leading text columns, a value
+        identical to the one of the previous row is left empty.
+
+        input:
+            table (pd.DataFrame)
+            note (bool) starts the text with ELISION_NOTE when values were left empty
+
+        output:
+            (str)
+        """
+        table = self.deduplicate_columns(table)
+        text_table = table.round(self.decimals).astype(str)
+        repeated = pd.Series(True, index=table.index)
+        is_elided = False
+        for column in table.columns:
+            if pd.api.types.is_numeric_dtype(table[column]):
+                break
+            # A value is elided only if the values of the previous columns were elided too.
+            repeated = repeated & (table[column] == table[column].shift())
+            text_table.loc[repeated, column] = ""
+            is_elided = is_elided or bool(repeated.any())
+        lines = [self.ELISION_NOTE] if note and is_elided else []
+        lines += ["\t".join(str(column) for column in table.columns)]
+        lines += ["\t".join(row) for row in text_table.itertuples(index=False, name=None)]
+        return "\n".join(lines)
+
+    def summarize(self, table):
+        """
+        Summarizes a large result : its size, aggregates of its numeric columns, the distinct values of its
+        text columns and an extract of its rows, reduced until the summary fits in max_tokens.
+
+        input:
+            table (pd.DataFrame)
+
+        output:
+            (str)
+        """
+        table = self.deduplicate_columns(table)
+        parts = [f"La requête a retourné {len(table)} lignes et {len(table.columns)} colonnes. Seul un résumé est présenté. {self.ELISION_NOTE}"]
+        numeric_table = table.select_dtypes("number")
+        if not numeric_table.empty:
+            aggregates = numeric_table.agg(["min", "mean", "max"]).T.reset_index(names="colonne")
+            parts.append("Statistiques des colonnes numériques :\n" + self.to_compact_text(aggregates))
+        for column in table.columns.difference(numeric_table.columns, sort=False):
+            distinct_values = table[column].dropna().unique()
+            if len(distinct_values) <= self.max_distinct_values:
+                parts.append(f"Valeurs de {column} : " + ", ".join(str(value) for value in distinct_values))
+
+        extract_rows = self.extract_rows
+        while True:
+            summary = "\n\n".join(parts + [self.get_extract(table, extract_rows)])
+            if extract_rows <= 1 or self.token_client.count_text(summary) <= self.max_tokens:
+                return summary
+            extract_rows //= 2
+
+    def get_extract(self, table, extract_rows):
+        """
+        Returns an extract of the rows of a table according to the strategy.
+
+        input:
+            table (pd.DataFrame)
+            extract_rows (int)
+
+        output:
+            (str)
+        """
+        if self.strategy == "sample":
+            extract = table.sample(min(2 * extract_rows, len(table)), random_state=42).sort_index()
+            return "Echantillon de lignes :\n" + self.to_compact_text(extract)
+        return (f"{extract_rows} premières lignes :\n" + self.to_compact_text(table.head(extract_rows))
+                + f"\n\n{extract_rows} dernières lignes :\n" + self.to_compact_text(table.tail(extract_rows)))
+
+    def to_display_markdown(self, table):
+        """
+        Renders a result as markdown for the chat, limited to display_max_rows rows.
+
+        input:
+            table (pd.DataFrame or dict)
+
+        output:
+            (str)
+        """
+        truncation_note = ""
+        if getattr(table, "attrs", {}).get("truncated_at"):
+            truncation_note = f"\n\n*Résultat tronqué à ses {table.attrs['truncated_at']} premières lignes.*"
+        table = pd.DataFrame(table)
+        if len(table) <= self.display_max_rows:
+            return table.to_markdown() + truncation_note
+        return table.head(self.display_max_rows).to_markdown() + f"\n\n*... {len(table) - self.display_max_rows} lignes supplémentaires*" + truncation_note
+
+
+def run_duplicate_columns_check():
+    """
+    Checks that a result with duplicate columns (SELECT * of a join) is serialized, small and summarized.
+
+    no input
+
+    no output
+    """
+    result_summary_client = ResultSummaryClient(max_rows=5)
+    table = pd.DataFrame([["Copper", 2024, 6000.0, "Copper", 2024, 0.1]] * 3 + [["Lead", 2024, 2000.0, "Lead", 2024, 0.2]] * 3,
+                         columns=["product", "year", "price", "product", "year", "variation"])
+    small_text = result_summary_client.serialize(table.head(4))
+    assert small_text.splitlines()[1] == "product\tyear\tprice\tproduct_1\tyear_1\tvariation", small_text
+    summary = result_summary_client.serialize(table)
+    assert "Valeurs de product_1 : Copper, Lead" in summary, summary
+    print("Duplicate columns : ok")
+
+
+def run_prompt_size_benchmark(row_counts=(10, 50, 200, 1000, 10000, 100000)):
+    """
+    Prints the number of tokens of a result sent to the LLM against its number of rows, serialized compactly
+    (or summarized) and as a markdown table.
+
+    input:
+        row_counts (tuple) of int
+
+    output:
+        (list) of dict, the measures for each number of rows
+    """
+    import numpy as np
+
+    result_summary_client = ResultSummaryClient()
+    token_client = result_summary_client.token_client
+    random = np.random.default_rng(42)
+    measures = []
+    print("rows\tcompact_tokens\tmarkdown_tokens")
+    for row_count in row_counts:
+        table = pd.DataFrame({
+            "provider": np.sort(random.choice([f"Fournisseur {index}" for index in range(20)], row_count)),
+            "year": random.integers(2015, 2025, row_count),
+            "month": random.integers(1, 13, row_count),
+            "price": random.uniform(5000, 9000, row_count)})
+        measure = {"rows": row_count,
+                   "compact_tokens": token_client.count_text(result_summary_client.serialize(table)),
+                   "markdown_tokens": token_client.count_text(table.to_markdown())}
+        measures.append(measure)
+        print(f"{row_count}\t{measure['compact_tokens']}\t{measure['markdown_tokens']}")
+    return measures
+
+
+if __name__ == "__main__":
+    run_duplicate_columns_check()
+    run_prompt_size_benchmark()
@@ -0,0 +1,284 @@
+"""
+A client to maintain pre-aggregated rollup tables of the sales history and to rewrite the aggregate queries
+on the raw table into queries on the rollups when they are equivalent.
+"""
+
+import re
+
+
+class RollupClient:
+    """
+    A client to maintain pre-aggregated rollup tables of the sales history.
+    """
+    SOURCE_TABLE = "historical_sales_data"
+    MEASURE = "price"
+    # Rollups from the smallest to the largest, a query uses the first rollup containing all its columns.
+    ROLLUPS = {
+        "historical_sales_yearly": ("product", "country", "year"),
+        "historical_sales_monthly": ("product", "country", "provider", "year", "month"),
+    }
+    AGGREGATE_PATTERN = re.compile(r"\b(avg|sum|min|max|count)\s*\(\s*(price|\*)\s*\)", re.IGNORECASE)
+    OTHER_AGGREGATE_PATTERN = re.compile(r"\b(avg|sum|min|max|count|total|group_concat)\s*\(", re.IGNORECASE)
+    CLAUSE_KEYWORDS = ("where", "group", "order", "limit", "having")
+    WORD_PATTERN = re.compile(r"'(?:[^']|'')*'|\b[^\W\d]\w*\b")
+    # The alias ending a column of the select list, with or without AS.
+    ALIAS_PATTERN = re.compile(r"(?:\bas\s+|(?<=[)\w\"'])\s+)(\"[^\"]*\"|\[[^\]]*\]|`[^`]*`|[^\W\d]\w*)\s*$", re.IGNORECASE)
+
+    def __init__(self) -> None:
+        self.statistics = {"rewritten": 0, "not_rewritten": 0, "rewrite_failed": 0}
+
+    def get_aggregate_columns(self):
+        """
+        Returns the aggregates stored in each rollup, as SQL expressions on the raw table.
+
+        no input
+
+        output:
+            (dict) column name -> SQL expression
+        """
+        return {
+            "sum_price": f"SUM({self.MEASURE})",
+            "count_price": f"COUNT({self.MEASURE})",
+            "count_rows": "COUNT(*)",
+            "min_price": f"MIN({self.MEASURE})",
+            "max_price": f"MAX({self.MEASURE})",
+        }
+
+    def build(self, connection, table_name):
+        """
+        (Re)builds the rollups of a table from scratch, called when the table is (re)loaded.
+
+        input:
+            connection (sqlite3 connection)
+            table_name (str)
+
+        output:
+            (dict) rollup name -> number of rows
+        """
+        if table_name != self.SOURCE_TABLE:
+            return {}
+        row_count = {}
+        aggregate_list = ", ".join(f"{expression} AS {column}" for column, expression in self.get_aggregate_columns().items())
+        for rollup_name, dimensions in self.ROLLUPS.items():
+            dimension_list = ", ".join(dimensions)
+            connection.execute(f"DROP TABLE IF EXISTS {rollup_name}")
+            connection.execute(f"CREATE TABLE {rollup_name} AS SELECT {dimension_list}, {aggregate_list} FROM {self.SOURCE_TABLE} GROUP BY {dimension_list}")
+            connection.execute(f"CREATE UNIQUE INDEX idx_{rollup_name}_key ON {rollup_name} ({dimension_list})")
+            row_count[rollup_name] = connection.execute(f"SELECT COUNT(*) FROM {rollup_name}").fetchone()[0]
+        return row_count
+
+    def update(self, connection, table_name, delta_table_name):
+        """
+        Updates the rollups incrementally with rows appended to a table. The appended rows must be in delta_table_name.
+
+        input:
+            connection (sqlite3 connection)
+            table_name (str)
+            delta_table_name (str) table containing only the appended rows
+
+        output:
+            (dict) rollup name -> number of rows
+        """
+        if table_name != self.SOURCE_TABLE:
+            return {}
+        row_count = {}
+        aggregate_columns = self.get_aggregate_columns()
+        aggregate_list = ", ".join(f"{expression} AS {column}" for column, expression in aggregate_columns.items())
+        merge = {
+            "sum_price": "COALESCE(sum_price, 0) + COALESCE(excluded.sum_price, 0)",
+            "count_price": "count_price + excluded.count_price",
+            "count_rows": "count_rows + excluded.count_rows",
+            "min_price": "MIN(COALESCE(min_price, excluded.min_price), COALESCE(excluded.min_price, min_price))",
+            "max_price": "MAX(COALESCE(max_price, excluded.max_price), COALESCE(excluded.max_price, max_price))",
+        }
+        for rollup_name, dimensions in self.ROLLUPS.items():
+            dimension_list = ", ".join(dimensions)
+            update_list = ", ".join(f"{column} = {merge[column]}" for column in aggregate_columns)
+            # "WHERE true" is needed by SQLite to parse the upsert of a SELECT.
+            connection.execute(
+                f"INSERT INTO {rollup_name} ({dimension_list}, {', '.join(aggregate_columns)}) "
+                f"SELECT {dimension_list}, {aggregate_list} FROM {delta_table_name} WHERE true GROUP BY {dimension_list} "
+                f"ON CONFLICT ({dimension_list}) DO UPDATE SET {update_list}")
+            row_count[rollup_name] = connection.execute(f"SELECT COUNT(*) FROM {rollup_name}").fetchone()[0]
+        return row_count
+
+    def get_rollup_expression(self, function_name, argument):
+        """
+        Returns the expression computing an aggregate of the raw table from a rollup.
+
+        input:
+            function_name (str) avg, sum, min, max or count
+            argument (str) price or *
+
+        output:
+            (str)
+        """
+        function_name = function_name.lower()
+        if function_name == "count":
+            return "SUM(count_rows)" if argument == "*" else "SUM(count_price)"
+        if argument == "*":
+            return None
+        return {
+            # In parentheses because the aggregate can be an operand (2 / AVG(price)).
+            "avg": "(SUM(sum_price) * 1.0 / SUM(count_price))",
+            "sum": "SUM(sum_price)",
+            "min": "MIN(min_price)",
+            "max": "MAX(max_price)",
+        }[function_name]
+
+    def rewrite(self, sql_operation, source_columns, prepare=None):
+        """
+        Rewrites an aggregate query on the raw table into a query on a rollup when it is equivalent :
+        a single select on the raw table, without join, whose only aggregates are on the price and whose
+        other columns are all dimensions of the rollup. Otherwise the query is returned as it is, as well as
+        when the rewritten query can't be prepared.
+
+        input:
+            sql_operation (str)
+            source_columns (set) columns of the raw table
+            prepare (callable) raises an exception if a query can't be prepared by the engine
+
+        output:
+            (str)
+        """
+        rewritten = self.try_rewrite(sql_operation, source_columns)
+        if rewritten is not None and prepare is not None:
+            try:
+                prepare(rewritten)
+            except Exception:
+                self.statistics["rewrite_failed"] += 1
+                return sql_operation
+        self.statistics["rewritten" if rewritten is not None else "not_rewritten"] += 1
+        return rewritten if rewritten is not None else sql_operation
+
+    @staticmethod
+    def split_select_list(select_list):
+        """
+        Splits a select list into its columns, on the commas outside of parentheses and string literals.
+
+        input:
+            select_list (str)
+
+        output:
+            (list) of str
+        """
+        columns, depth, start = [], 0, 0
+        for match in re.finditer(r"'(?:[^']|'')*'|\"[^\"]*\"|[(),]", select_list):
+            if match.group(0) == "(":
+                depth += 1
+            elif match.group(0) == ")":
+                depth -= 1
+            elif match.group(0) == "," and depth == 0:
+                columns.append(select_list[start:match.start()])
+                start = match.end()
+        columns.append(select_list[start:])
+        return columns
+
+    def has_alias(self, column):
+        """
+        Checks if a column of a select list ends with an alias.
+
+        input:
+            column (str)
+
+        output:
+            (bool)
+        """
+        match = self.ALIAS_PATTERN.search(column.strip())
+        return match is not None and match.group(1).lower() != "end"
+
+    def try_rewrite(self, sql_operation, source_columns):
+        """
+        Returns the query rewritten on a rollup, or None if it can't be rewritten.
+
+        input:
+            sql_operation (str)
+            source_columns (set)
+
+        output:
+            (str) or None
+        """
+        words = [word.lower() for word in self.WORD_PATTERN.findall(sql_operation) if not word.startswith("'")]
+        if words.count("select") != 1 or words.count("from") != 1 or any(word in words for word in ("join", "union", "intersect", "except", "over", "with")):
+            return None
+        from_match = re.search(rf"\bfrom\s+{self.SOURCE_TABLE}\b(?:\s+(?:as\s+)?(\w+))?", sql_operation, re.IGNORECASE)
+        if from_match is None or (from_match.group(1) is not None and from_match.group(1).lower() not in self.CLAUSE_KEYWORDS):
+            return None
+        if from_match.group(1) is not None:
+            # We keep the clause keyword in the rest of the query.
+            from_match = re.search(rf"\bfrom\s+{self.SOURCE_TABLE}\b", sql_operation, re.IGNORECASE)
+        # Joins written with a comma and columns prefixed by their table are left to the raw table.
+        if sql_operation[from_match.end():].lstrip().startswith(",") or "." in re.sub(r"'(?:[^']|'')*'|\d+\.\d+", "", sql_operation):
+            return None
+        if self.AGGREGATE_PATTERN.search(sql_operation) is None:
+            return None
+
+        select_match = re.search(r"\bselect\s", sql_operation, re.IGNORECASE)
+        select_list = sql_operation[select_match.end():from_match.start()]
+        rest = sql_operation[from_match.end():]
+
+        def replace_aggregate(match):
+            expression = self.get_rollup_expression(match.group(1), match.group(2).lower())
+            if expression is None:
+                raise ValueError(match.group(0))
+            return expression
+
+        try:
+            new_columns = []
+            for column in self.split_select_list(select_list):
+                new_column = self.AGGREGATE_PATTERN.sub(replace_aggregate, column)
+                if new_column != column and not self.has_alias(column):
+                    # The rewritten column keeps the name SQLite would have given to the original expression.
+                    stripped_column = column.strip().replace('"', '""')
+                    new_column = f'{new_column.rstrip()} AS "{stripped_column}"{column[len(column.rstrip()):]}'
+                new_columns.append(new_column)
+            new_select_list = ",".join(new_columns)
+            new_rest = self.AGGREGATE_PATTERN.sub(replace_aggregate, rest)
+        except ValueError:
+            return None
+
+        remaining_text = self.AGGREGATE_PATTERN.sub("", select_list + " " + rest)
+        if self.OTHER_AGGREGATE_PATTERN.search(remaining_text):
+            # Other aggregates (on the dimensions) don't give the same result on a rollup.
+            return None
+        remaining_words = {word.lower() for word in self.WORD_PATTERN.findall(remaining_text) if not word.startswith("'")}
+        used_columns = {column for column in source_columns if column.lower() in remaining_words}
+        if self.MEASURE in used_columns:
+            return None
+        for rollup_name, dimensions in self.ROLLUPS.items():
+            if used_columns <= set(dimensions):
+                return f"{sql_operation[:select_match.end()]}{new_select_list}FROM {rollup_name}{new_rest}"
+        return None
+
+    def get_prompt_description(self):
+        """
+        Returns the description of the rollups for the system prompts of the LLM.
+
+        no input
+
+        output:
+            (str)
+        """
+        descriptions = []
+        for rollup_name, dimensions in self.ROLLUPS.items():
+            dimension_list = "\n".join(f"                - {dimension}" for dimension in dimensions)
+            descriptions.append(f"""
+            {rollup_name} (un dataframe pré-agrégé de historical_sales_data par {", ".join(dimensions)}, plus rapide à interroger pour les moyennes, sommes, minimums et maximums de prix):
+{dimension_list}
+                - sum_price (somme des prix)
+                - count_price (nombre de prix renseignés, le prix moyen est sum_price * 1.0 / count_price)
+                - count_rows (nombre de lignes)
+                - min_price (prix minimum)
+                - max_price (prix maximum)""")
+        return "".join(descriptions)
+
+    def get_statistics(self):
+        """
+        Returns how many queries were rewritten on a rollup.
+
+        no input
+
+        output:
+            (dict)
+        """
+        return dict(self.statistics)
@@ -0,0 +1,205 @@
+"""
+A local index of the schema of the catalog (BM25 on the descriptions, column names, keywords and values of the tables)
+to only describe the tables and columns relevant to a question in the prompts when the catalog is large.
+Can be evaluated on a set of questions : python -m helper.schema_index_client [questions.json]
+"""
+
+from collections import Counter
+import math
+import re
+import unicodedata
+
+
+class SchemaIndexClient:
+    """
+    A local index of the schema of the catalog to retrieve the tables and columns relevant to a question.
+    """
+    # Short words of the questions which don't help to find a table.
+    STOP_WORDS = {
+        "le", "la", "les", "de", "des", "du", "un", "une", "et", "ou", "en", "au", "aux", "a", "l", "d", "que", "qui",
+        "quel", "quelle", "quels", "quelles", "est", "sont", "pour", "par", "sur", "dans", "avec", "je", "tu", "il",
+        "nous", "vous", "ce", "cette", "ces", "mon", "ma", "mes", "moi", "me", "the", "of", "and", "in", "to",
+    }
+
+    def __init__(self, catalog_client, top_k_tables=3, top_k_columns=12, k1=1.5, b=0.75) -> None:
+        self.catalog_client = catalog_client
+        self.top_k_tables = top_k_tables
+        # Measures (float columns) described per table at most, the other columns (keys, dimensions) are always described.
+        self.top_k_columns = top_k_columns
+        self.k1 = k1
+        self.b = b
+        self.table_documents = {}
+        self.column_documents = {}
+        self.document_frequency = Counter()
+        self.average_length = 1.0
+        self.build()
+
+    @classmethod
+    def tokenize(cls, text):
+        """
+        Splits a text into normalized words : lower case, without accents, snake_case names split, plurals removed.
+
+        input:
+            text (str)
+
+        output:
+            (list) of str
+        """
+        text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii").lower()
+        words = []
+        for word in re.findall(r"[a-z0-9]+", text):
+            if word in cls.STOP_WORDS:
+                continue
+            if len(word) > 3 and word[-1] in "sx":
+                word = word[:-1]
+            words.append(word)
+        return words
+
+    def build(self):
+        """
+        Indexes every table (description, keywords, column names and values) and every column of the catalog.
+
+        no input
+
+        no output
+        """
+        for table_name in self.catalog_client.list_table_name:
+            table_config = self.catalog_client.catalog["tables"][table_name]
+            profile = self.catalog_client.get_profile(table_name)
+            column_descriptions = table_config.get("columns", {})
+            table_words = self.tokenize(" ".join([table_name, table_config.get("description", "")] + table_config.get("keywords", [])))
+            column_words = {}
+            for column, column_profile in profile.items():
+                values = " ".join(str(value) for value in column_profile.get("values", []))
+                column_words[column] = self.tokenize(f"{column} {column_descriptions.get(column, '')} {values}")
+                self.column_documents[(table_name, column)] = Counter(column_words[column])
+            self.table_documents[table_name] = Counter(table_words + [word for words in column_words.values() for word in words])
+
+        documents = list(self.table_documents.values())
+        for document in documents:
+            self.document_frequency.update(document.keys())
+        self.average_length = sum(sum(document.values()) for document in documents) / max(len(documents), 1) or 1.0
+
+    def score(self, query_words, document):
+        """
+        Returns the BM25 score of a document for a query.
+
+        input:
+            query_words (list) of str
+            document (Counter) word -> number of occurrences
+
+        output:
+            (float)
+        """
+        document_length = sum(document.values())
+        document_count = len(self.table_documents)
+        score = 0.0
+        for word in set(query_words):
+            if word not in document:
+                continue
+            idf = math.log(1 + (document_count - self.document_frequency[word] + 0.5) / (self.document_frequency[word] + 0.5))
+            frequency = document[word]
+            score += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * document_length / self.average_length))
+        return score
+
+    def retrieve(self, question):
+        """
+        Returns the tables relevant to a question and the columns to describe for each of them.
+        Tables without any word in common with the question are only returned if no table matches.
+
+        input:
+            question (str)
+
+        output:
+            (dict) table name -> list of columns, in the order of the catalog
+        """
+        query_words = self.tokenize(question)
+        table_scores = {table_name: self.score(query_words, document) for table_name, document in self.table_documents.items()}
+        ranked_tables = sorted(table_scores, key=lambda table_name: -table_scores[table_name])
+        selected_tables = [table_name for table_name in ranked_tables[:self.top_k_tables] if table_scores[table_name] > 0] or ranked_tables[:self.top_k_tables]
+
+        selection = {}
+        for table_name in self.catalog_client.list_table_name:
+            if table_name not in selected_tables:
+                continue
+            profile = self.catalog_client.get_profile(table_name)
+            measures = [column for column, column_profile in profile.items() if column_profile["type"].startswith("float")]
+            measure_scores = {column: self.score(query_words, self.column_documents[(table_name, column)]) for column in measures}
+            # Measures matching the question first, then the first measures of the table.
+            kept_measures = set(sorted(measures, key=lambda column: -measure_scores[column])[:self.top_k_columns])
+            columns = [column for column in profile if column not in measures or column in kept_measures]
+            selection[table_name] = columns[:self.catalog_client.max_prompt_columns]
+        return selection
+
+    def get_prompt_schema(self, question):
+        """
+        Returns the description of the tables and columns relevant to a question for the prompts of the LLM.
+
+        input:
+            question (str)
+
+        output:
+            (str)
+        """
+        selection = self.retrieve(question)
+        return self.catalog_client.get_prompt_schema(list(selection), selection)
+
+    def evaluate(self, questions, token_client):
+        """
+        Compares the retrieved schema with the full schema on a set of questions : number of tokens of the
+        description and share of the questions for which every expected table and column is described.
+
+        input:
+            questions (list) of dict with the keys question, tables (list) and optionally columns (list of "table.column")
+            token_client (TokenClient)
+
+        output:
+            (dict)
+        """
+        full_tokens = token_client.count_text(self.catalog_client.get_prompt_schema())
+        retrieved_tokens = []
+        table_recall = []
+        complete_schema = []
+        for question in questions:
+            selection = self.retrieve(question["question"])
+            retrieved_tokens.append(token_client.count_text(self.catalog_client.get_prompt_schema(list(selection), selection)))
+            expected_tables = set(question["tables"])
+            table_recall.append(len(expected_tables & set(selection)) / max(len(expected_tables), 1))
+            expected_columns = [column.split(".", 1) for column in question.get("columns", [])]
+            complete_schema.append(expected_tables <= set(selection) and all(column in selection.get(table_name, []) for table_name, column in expected_columns))
+        question_count = max(len(questions), 1)
+        return {
+            "questions": len(questions),
+            "full_schema_tokens": full_tokens,
+            "retrieved_schema_tokens": sum(retrieved_tokens) / question_count,
+            "table_recall": sum(table_recall) / question_count,
+            "complete_schema_rate": sum(complete_schema) / question_count,
+        }
+
+
+# Questions of the README with the tables needed to answer them.
+EVALUATION_QUESTIONS = [
+    {"question": "Je suis en octobre 2024. Mon fournisseur de cuivre me propose un prix de 6000. Est-ce que je devrais acheter chez lui ou chez un autre fournisseur ?", "tables": ["historical_sales_data"], "columns": ["historical_sales_data.price", "historical_sales_data.provider"]},
+    {"question": "D'après les prédictions, quel sera le meilleur mois pour acheter du plomb en 2025 et dans quel pays ?", "tables": ["historical_sales_data"], "columns": ["historical_sales_data.price", "historical_sales_data.month", "historical_sales_data.country"]},
+    {"question": "Nous sommes en 2024. Est-ce que je devrais faire du stock de cuivre cette année ou est-ce que je devrais acheter l'année prochaine ?", "tables": ["historical_sales_data"], "columns": ["historical_sales_data.price", "historical_sales_data.year"]},
+    {"question": "Nous sommes en Octobre 2024. Sur les six derniers mois, sommes-nous sur une tendance à la hausse pour le plomb ?", "tables": ["historical_sales_data"], "columns": ["historical_sales_data.price", "historical_sales_data.date"]},
+    {"question": "En utilisant les drivers, comment expliquer le hausse du prix du cuivre en 2025 ?", "tables": ["driver_ml"], "columns": ["driver_ml.driver", "driver_ml.value"]},
+    {"question": "Trace l'évolution du prix du cuivre au cours du temps. Sépare les fournisseurs et inclut les prédictions.", "tables": ["historical_sales_data"], "columns": ["historical_sales_data.price", "historical_sales_data.provider", "historical_sales_data.date"]},
+    {"question": "Pour les drivers de couts du cuivre aux US, tu peux me tracer un camembert qui m'indique leur importance (en valeur absolue) à chacun ?", "tables": ["driver_ml"], "columns": ["driver_ml.driver", "driver_ml.value", "driver_ml.country"]},
+    {"question": "Pour chaque fournisseur de plomb, donne moi un bar chart qui présente la moyenne des prix pour chaque année entre 2023 et 2025", "tables": ["historical_sales_data"], "columns": ["historical_sales_data.price", "historical_sales_data.provider", "historical_sales_data.year"]},
+]
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+
+    from helper.catalog_client import CatalogClient
+    from helper.token_client import TokenClient
+
+    questions = EVALUATION_QUESTIONS
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r", encoding="utf-8") as f:
+            questions = json.load(f)
+    schema_index_client = SchemaIndexClient(CatalogClient())
+    print(json.dumps(schema_index_client.evaluate(questions, TokenClient()), indent=4))
@@ -0,0 +1,98 @@
+"""
+A client to count the tokens of the prompts (offline with tiktoken) and keep them within a budget.
+"""
+
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+class TokenClient:
+    """
+    A client to count the tokens of the prompts (offline with tiktoken) and keep them within a budget.
+    """
+    # Tokens added by the chat format around each message.
+    TOKENS_PER_MESSAGE = 4
+
+    def __init__(self, encoding_name="o200k_base") -> None:
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.get_encoding(encoding_name)
+            except Exception:
+                # The encoding could not be loaded (no network and no local copy), we fall back to an estimation.
+                self.encoding = None
+        # The system prompts are counted many times, the counts are cached.
+        self.count_text = lru_cache(maxsize=2048)(self._count_text)
+
+    def _count_text(self, text):
+        """
+        Counts the tokens of a text. Without tiktoken the count is estimated (about 4 characters per token).
+
+        input:
+            text (str)
+
+        output:
+            (int)
+        """
+        if self.encoding is None:
+            return (len(text) + 3) // 4
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, contents):
+        """
+        Counts the tokens of a list of messages.
+
+        input:
+            contents (list) of str, the content of each message
+
+        output:
+            (int)
+        """
+        return sum(self.count_text(str(content)) + self.TOKENS_PER_MESSAGE for content in contents)
+
+    def trim_messages(self, messages, budget):
+        """
+        Keeps the most recent messages of a chat history whose tokens fit in the budget.
+
+        input:
+            messages (list) of langchain messages
+            budget (int)
+
+        output:
+            (list) of langchain messages
+        """
+        kept_messages = []
+        for message in reversed(messages):
+            budget -= self.count_text(str(message.content)) + self.TOKENS_PER_MESSAGE
+            if budget < 0:
+                break
+            kept_messages.append(message)
+        return kept_messages[::-1]
+
+    def trim_table(self, table, budget):
+        """
+        Keeps the first lines of a table (markdown, csv, etc.) whose tokens fit in the budget
+        and indicates how many lines were left out.
+
+        input:
+            table (str)
+            budget (int)
+
+        output:
+            (str)
+        """
+        if self.count_text(table) <= budget:
+            return table
+        lines = table.split("\n")
+        kept_lines = []
+        for line in lines:
+            budget -= self.count_text(line) + 1
+            if budget < 0:
+                break
+            kept_lines.append(line)
+        kept_lines.append(f"... ({len(lines) - len(kept_lines)} lignes omises)")
+        return "\n".join(kept_lines)
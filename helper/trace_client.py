@@ -0,0 +1,382 @@
+"""
+A client to trace the requests : each stage of a request (LLM call, parsing of the answer, SQL query, rendering
+of the table, construction of the figure) is a span timed with its tokens, rows and memory. The spans are kept
+in memory for the diagnostics page and can be exported to the console or to a jsonl file in the OpenTelemetry
+(OTLP json) format. A profiler can be turned on for a request.
+"""
+
+from collections import deque
+import contextlib
+import contextvars
+import cProfile
+import json
+import os
+import random
+import secrets
+import threading
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the high-water mark of the memory is then not traced.
+    resource = None
+
+try:
+    # Sampling profiler, used when it is installed. Otherwise cProfile is used.
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+
+# Span of the current stage, the spans opened inside it are its children.
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def bind_context(function):
+    """
+    Returns a function running in the current context, so that the spans opened by a function run in an
+    executor are children of the current span.
+
+    input:
+        function (callable)
+
+    output:
+        (callable)
+    """
+    context = contextvars.copy_context()
+    return lambda *args: context.run(function, *args)
+
+
+class TraceClient:
+    """
+    A client to trace the requests.
+    """
+    def __init__(self, exporter=None, trace_file=None, max_spans=10000, profile_rate=None, profile_folder=None) -> None:
+        # none : the spans are only kept in memory, console : printed, file : appended to trace_file.
+        self.exporter = exporter or os.environ.get("TRACE_EXPORTER", "none")
+        self.trace_file = trace_file or os.environ.get("TRACE_FILE", "data/.cache/traces.jsonl")
+        # Share of the requests profiled when the profiler is not explicitly turned on or off.
+        self.profile_rate = profile_rate if profile_rate is not None else float(os.environ.get("TRACE_PROFILE_RATE", "0"))
+        self.profile_folder = profile_folder or os.environ.get("TRACE_PROFILE_FOLDER", "data/.cache/profiles")
+        self.spans = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_max_resident_memory_mb():
+        """
+        Returns the high-water mark of the memory used by the process, or None if it can't be read.
+
+        no input
+
+        output:
+            (float)
+        """
+        if resource is None:
+            return None
+        # ru_maxrss is in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def start_span(self, name, parent=None, **attributes):
+        """
+        Opens a span, child of parent (or of the current span).
+
+        input:
+            name (str)
+            parent (dict) span
+            attributes : attributes of the span
+
+        output:
+            (dict) the span
+        """
+        parent = parent if parent is not None else current_span.get()
+        return {
+            "trace_id": parent["trace_id"] if parent is not None else secrets.token_hex(16),
+            "span_id": secrets.token_hex(8),
+            "parent_span_id": parent["span_id"] if parent is not None else None,
+            "name": name,
+            "start_time_unix_nano": time.time_ns(),
+            "end_time_unix_nano": None,
+            "start": time.perf_counter(),
+            "duration_seconds": None,
+            "max_rss_start_mb": self.get_max_resident_memory_mb(),
+            "attributes": dict(attributes),
+            "status": "OK",
+        }
+
+    def end_span(self, span, error=None):
+        """
+        Closes a span, stores it and exports it.
+
+        input:
+            span (dict)
+            error (Exception) the error which ended the span, if any
+
+        no output
+        """
+        span["duration_seconds"] = time.perf_counter() - span.pop("start")
+        span["end_time_unix_nano"] = time.time_ns()
+        max_rss_mb = self.get_max_resident_memory_mb()
+        max_rss_start_mb = span.pop("max_rss_start_mb")
+        if max_rss_mb is not None:
+            # How much the stage raised the high-water mark of the memory of the process.
+            span["attributes"]["memory.max_rss_mb"] = round(max_rss_mb, 1)
+            span["attributes"]["memory.max_rss_growth_mb"] = round(max_rss_mb - max_rss_start_mb, 1)
+        if error is not None:
+            span["status"] = "ERROR"
+            span["attributes"]["error"] = f"{type(error).__name__}: {error}"
+        with self.lock:
+            self.spans.append(span)
+        if self.exporter != "none":
+            self.export(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """
+        Times a stage. The span is the current span inside the block, its attributes can be completed with
+        add_attributes.
+
+        input:
+            name (str)
+            attributes : attributes of the span
+
+        output:
+            (dict) the span
+        """
+        span = self.start_span(name, **attributes)
+        token = current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            try:
+                current_span.reset(token)
+            except ValueError:
+                # The block ended in another context (a generator resumed elsewhere).
+                current_span.set(None)
+            self.end_span(span, error)
+
+    @contextlib.contextmanager
+    def request(self, name, profile=None, **attributes):
+        """
+        Traces a request (the root span of a chat turn). The request is profiled if profile is True, or with
+        a probability of profile_rate if profile is None. The address of the profile is an attribute of the span.
+
+        input:
+            name (str)
+            profile (bool)
+            attributes : attributes of the span
+
+        output:
+            (dict) the span
+        """
+        if profile is None:
+            profile = self.profile_rate > 0 and random.random() < self.profile_rate
+        with self.span(name, **attributes) as span:
+            if not profile:
+                yield span
+                return
+            profiler = Profiler() if Profiler is not None else cProfile.Profile()
+            profiler.start() if Profiler is not None else profiler.enable()
+            try:
+                yield span
+            finally:
+                os.makedirs(self.profile_folder, exist_ok=True)
+                profile_path = os.path.join(self.profile_folder, f"{name}_{span['trace_id']}")
+                if Profiler is not None:
+                    profiler.stop()
+                    profile_path += ".html"
+                    with open(profile_path, "w", encoding="utf-8") as f:
+                        f.write(profiler.output_html())
+                else:
+                    profiler.disable()
+                    profile_path += ".prof"
+                    profiler.dump_stats(profile_path)
+                span["attributes"]["profile.file"] = profile_path
+
+    def add_attributes(self, span=None, **attributes):
+        """
+        Adds attributes to a span (the current span by default). Numeric attributes already set are summed,
+        for example the tokens of several calls to the LLM in the same stage. Boolean attributes are replaced.
+
+        input:
+            span (dict)
+            attributes
+
+        no output
+        """
+        span = span if span is not None else current_span.get()
+        if span is None:
+            return
+        for key, value in attributes.items():
+            previous_value = span["attributes"].get(key)
+            # bool is a subclass of int : two cache hits would make a cache_hit of 2.
+            if isinstance(value, (int, float)) and isinstance(previous_value, (int, float)) and not isinstance(value, bool) and not isinstance(previous_value, bool):
+                value += previous_value
+            span["attributes"][key] = value
+
+    @staticmethod
+    def to_otlp(span):
+        """
+        Converts a span into the OpenTelemetry json format (OTLP).
+
+        input:
+            span (dict)
+
+        output:
+            (dict)
+        """
+        def to_value(value):
+            if isinstance(value, bool):
+                return {"boolValue": value}
+            if isinstance(value, int):
+                return {"intValue": str(value)}
+            if isinstance(value, float):
+                return {"doubleValue": value}
+            return {"stringValue": str(value)}
+
+        return {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "parentSpanId": span["parent_span_id"] or "",
+            "name": span["name"],
+            "startTimeUnixNano": str(span["start_time_unix_nano"]),
+            "endTimeUnixNano": str(span["end_time_unix_nano"]),
+            "attributes": [{"key": key, "value": to_value(value)} for key, value in span["attributes"].items()],
+            "status": {"code": "STATUS_CODE_ERROR" if span["status"] == "ERROR" else "STATUS_CODE_OK"},
+        }
+
+    def export(self, span):
+        """
+        Prints a span or appends it to the trace file.
+
+        input:
+            span (dict)
+
+        no output
+        """
+        line = json.dumps(self.to_otlp(span), ensure_ascii=False)
+        if self.exporter == "console":
+            print(line)
+            return
+        with self.lock:
+            if os.path.dirname(self.trace_file):
+                os.makedirs(os.path.dirname(self.trace_file), exist_ok=True)
+            with open(self.trace_file, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def get_spans(self):
+        """
+        Returns the spans kept in memory, the oldest first.
+
+        no input
+
+        output:
+            (list) of dict
+        """
+        with self.lock:
+            return list(self.spans)
+
+    def get_stage_statistics(self):
+        """
+        Aggregates the spans kept in memory per stage : number of calls and of errors, p50 and p95 of the
+        duration and of the time to first token of the streamed answers, tokens and rows per call and largest
+        growth of the memory high-water mark.
+
+        no input
+
+        output:
+            (list) of dict, one per stage, the slowest p95 first
+        """
+        spans_by_name = {}
+        for span in self.get_spans():
+            spans_by_name.setdefault(span["name"], []).append(span)
+
+        def mean(spans, key):
+            values = [span["attributes"][key] for span in spans if key in span["attributes"]]
+            return sum(values) / len(values) if values else None
+
+        def percentile(values, share):
+            values = sorted(values)
+            return values[min(int(share * len(values)), len(values) - 1)] if values else None
+
+        statistics = []
+        for name, spans in spans_by_name.items():
+            durations = [span["duration_seconds"] for span in spans]
+            times_to_first_token = [span["attributes"]["llm.time_to_first_token_seconds"] for span in spans if "llm.time_to_first_token_seconds" in span["attributes"]]
+            memory_growth = [span["attributes"]["memory.max_rss_growth_mb"] for span in spans if "memory.max_rss_growth_mb" in span["attributes"]]
+            statistics.append({
+                "stage": name,
+                "calls": len(spans),
+                "errors": sum(span["status"] == "ERROR" for span in spans),
+                "p50_seconds": percentile(durations, 0.5),
+                "p95_seconds": percentile(durations, 0.95),
+                "p50_ttft_seconds": percentile(times_to_first_token, 0.5),
+                "p95_ttft_seconds": percentile(times_to_first_token, 0.95),
+                "prompt_tokens": mean(spans, "llm.prompt_tokens"),
+                "completion_tokens": mean(spans, "llm.completion_tokens"),
+                "rows": mean(spans, "rows"),
+                "max_rss_growth_mb": max(memory_growth) if memory_growth else None,
+            })
+        return sorted(statistics, key=lambda stage_statistics: -stage_statistics["p95_seconds"])
+
+    def clear(self):
+        """
+        Forgets the spans kept in memory.
+
+        no input
+
+        no output
+        """
+        with self.lock:
+            self.spans.clear()
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """
+    A langchain callback opening a span for each call to the chat model and each parsing of its answer,
+    children of the current span.
+    """
+    # Called in the task of the chain, so that the current span is the span of the stage.
+    run_inline = True
+
+    def __init__(self, trace_client) -> None:
+        self.trace_client = trace_client
+        self.open_spans = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        self.open_spans[run_id] = self.trace_client.start_span("llm_call")
+
+    def on_llm_end(self, response, *, run_id, parent_run_id=None, **kwargs):
+        span = self.open_spans.pop(run_id, None)
+        if span is None:
+            return
+        # Tokens counted by the API, when it gives them.
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if token_usage:
+            self.trace_client.add_attributes(span, **{"llm.api_prompt_tokens": token_usage.get("prompt_tokens", 0), "llm.api_completion_tokens": token_usage.get("completion_tokens", 0)})
+        self.trace_client.end_span(span)
+
+    def on_llm_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        span = self.open_spans.pop(run_id, None)
+        if span is not None:
+            self.trace_client.end_span(span, error)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        if str(kwargs.get("name")).endswith("OutputParser"):
+            self.open_spans[run_id] = self.trace_client.start_span("parse_answer", parser=kwargs.get("name"))
+
+    def on_chain_end(self, outputs, *, run_id, parent_run_id=None, **kwargs):
+        span = self.open_spans.pop(run_id, None)
+        if span is not None:
+            self.trace_client.end_span(span)
+
+    def on_chain_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        span = self.open_spans.pop(run_id, None)
+        if span is not None:
+            self.trace_client.end_span(span, error)
@@ -2,23 +2,34 @@
 Streamlit interface for the page to generate insights using generative AI.
 """
 
-import pandas as pd
+import asyncio
 import streamlit as st
 
 from helper.interface_client import InterfaceClient
 from helper.LLM_client import LLMClient
 from helper.operation_client import OperationClient
+from helper.pipeline_client import PipelineClient
+from helper.resilience_client import LLMUnavailableError
+from helper.resource_client import get_shared_resource
+from helper.trace_client import TraceClient
 
 
 if 'llm_client' not in st.session_state:
     st.session_state['llm_client'] = LLMClient()
 
+# The operation client only holds shared data, every session uses the same one. Only chat histories are kept per session.
 if 'operation_client' not in st.session_state:
-    st.session_state['operation_client'] = OperationClient()
+    st.session_state['operation_client'] = get_shared_resource("operation_client", OperationClient)
 
 if 'interface_client' not in st.session_state:
     st.session_state['interface_client'] = InterfaceClient()
 
+if 'trace_client' not in st.session_state:
+    st.session_state['trace_client'] = get_shared_resource("trace_client", TraceClient)
+
+if 'pipeline_client' not in st.session_state:
+    st.session_state['pipeline_client'] = PipelineClient(st.session_state['llm_client'], st.session_state['operation_client'])
+
 intro_sentence = "Je connais l'évolution des prix du marché pour vos fournisseurs. Posez-moi toutes vos questions, je serai enchanté d'y répondre 😃."
 
 st.session_state['interface_client'].configure_page()
@@ -27,7 +38,8 @@ st.title("Generation d'insights")
 st.session_state['interface_client'].create_sidebar(
     header_text = "Génération dynamique d'insights s'appuyant sur vos données",
     paragraph_text = "Le chatbot effectue des recherches sur vos données afin de pouvoir fournir des insights et des recommandations.",
-    clear_conversation_button=True)
+    clear_conversation_button=True,
+    on_clear_conversation=st.session_state['llm_client'].clear_chat_memory)
 
 # Display past conversation history
 st.session_state['interface_client'].display_message_history()
@@ -42,25 +54,31 @@ if prompt := st.chat_input("Comment puis-je vous aider ?"):
 
     # Placeholder for assistant response with initial empty string
     try:
-        with st.chat_message("assistant"):
+        # The turn is traced (and profiled if it is turned on in the diagnostics page).
+        with st.chat_message("assistant"), st.session_state['trace_client'].request("insight_turn", profile=st.session_state.get('profile_requests') or None):
             message_placeholder = st.empty()
-            full_response = st.session_state['llm_client'].get_list_operation(prompt)
-            print(full_response)
-            table_answer = st.session_state['operation_client'].read_operation(full_response["sql"])
-            llm_interpretation = st.session_state['llm_client'].get_interpretation(prompt, full_response, pd.DataFrame(table_answer).to_markdown())
-
-            clean_answer = st.session_state['interface_client'].format_answer_for_history(full_response["reasoning"], table_answer, llm_interpretation)
-            # Update placeholder with complete cleaned response
-            message_placeholder.markdown(clean_answer)
-
-        # Lines to add previous questions to chat history. (Having too large a chat history can degrade performances)
-        #st.session_state['llm_client'].add_message_to_history("user", prompt)
-        #st.session_state['llm_client'].add_message_to_history("assistant", full_response)
+            insight_answer = asyncio.run(st.session_state['pipeline_client'].run_insight_query(prompt))
+            full_response = insight_answer["full_response"]
+            table_answer = insight_answer["table_answer"]
+
+            # The reasoning and the table are displayed right away, then the conclusion is streamed in the placeholder
+            llm_interpretation, clean_answer = st.session_state['interface_client'].stream_answer(
+                message_placeholder,
+                full_response["reasoning"],
+                table_answer,
+                st.session_state['pipeline_client'].stream_stage("interpretation", st.session_state['llm_client'].stream_interpretation(prompt, full_response, table_answer)))
+
+        # The turn is remembered for the follow-up questions : the last turns verbatim, the older ones summarized,
+        # within MEMORY_MAX_TOKENS tokens so that a long conversation doesn't slow down the next answers.
+        st.session_state['pipeline_client'].remember_insight(prompt, full_response, table_answer, llm_interpretation)
         # Append assistant response to session state
         st.session_state['interface_client'].add_message_to_history("assistant", clean_answer)
     except Exception as e:
-        print(e)
-        full_response = "Je suis désolé, je n'arrive pas à répondre à votre question. Pourriez-vous essayer de reformuler ?"
+        if isinstance(e, LLMUnavailableError):
+            # Reformulating won't help : the LLM is throttled or unavailable.
+            full_response = "Le service est momentanément surchargé. Pourriez-vous réessayer dans quelques instants ?"
+        else:
+            full_response = "Je suis désolé, je n'arrive pas à répondre à votre question. Pourriez-vous essayer de reformuler ?"
         message_placeholder.markdown(full_response)
         st.session_state['interface_client'].add_message_to_history("assistant", full_response)
 
@@ -2,22 +2,34 @@
 Streamlit interface for the page to generate figures using generative AI.
 """
 
+import asyncio
 import pandas as pd
 import streamlit as st
 
 from helper.interface_client import InterfaceClient
 from helper.LLM_client import LLMClient
 from helper.operation_client import OperationClient
+from helper.pipeline_client import PipelineClient
+from helper.resilience_client import LLMUnavailableError
+from helper.resource_client import get_shared_resource
+from helper.trace_client import TraceClient
 
 if 'llm_client' not in st.session_state:
     st.session_state['llm_client'] = LLMClient()
 
+# The operation client only holds shared data, every session uses the same one. Only chat histories are kept per session.
 if 'operation_client' not in st.session_state:
-    st.session_state['operation_client'] = OperationClient()
+    st.session_state['operation_client'] = get_shared_resource("operation_client", OperationClient)
 
 if 'interface_client' not in st.session_state:
     st.session_state['interface_client'] = InterfaceClient()
 
+if 'trace_client' not in st.session_state:
+    st.session_state['trace_client'] = get_shared_resource("trace_client", TraceClient)
+
+if 'pipeline_client' not in st.session_state:
+    st.session_state['pipeline_client'] = PipelineClient(st.session_state['llm_client'], st.session_state['operation_client'])
+
 intro_sentence = "Je peux tracer des figures afin de pouvoir vous aider à mieux visualiser l'information. Posez-moi toutes vos questions, je serai enchanté d'y répondre 😃."
 
 st.session_state['interface_client'].configure_page()
@@ -37,18 +49,35 @@ if prompt := st.chat_input("Comment puis-je vous aider ?"):
 
     # Placeholder for assistant response with initial empty string
     try:
-        with st.chat_message("assistant"):
+        # The turn is traced (and profiled if it is turned on in the diagnostics page).
+        with st.chat_message("assistant"), st.session_state['trace_client'].request("figure_turn", profile=st.session_state.get('profile_requests') or None):
             message_placeholder = st.empty()
-            full_response = st.session_state['llm_client'].get_operation_figure(prompt)
-            print("full_response", full_response)
-            figure_answer = st.session_state['llm_client'].get_figure_template(prompt, full_response)
-            print("figure_answer", figure_answer)
-            plotly_figure = st.session_state["operation_client"].plot_figure(full_response["sql"], figure_answer)
+            pipeline_client = st.session_state['pipeline_client']
+            # The reasoning is streamed in the placeholder while the LLM writes the SQL query (and the figure template in the combined flow)
+            if pipeline_client.figure_flow == "combined":
+                stage_name, response_stream = "figure_answer", st.session_state['llm_client'].stream_figure_answer(prompt)
+            else:
+                stage_name, response_stream = "operation_figure", st.session_state['llm_client'].stream_operation_figure(prompt)
+            with st.session_state['trace_client'].span(stage_name):
+                # The stream must end within the timeout of the stage and give an answer.
+                for full_response in pipeline_client.stream_stage(stage_name, response_stream):
+                    if isinstance(full_response, dict):
+                        message_placeholder.markdown(full_response.get("reasoning", ""))
+            # A first figure is shown as soon as the data is read, it is replaced once the LLM has chosen the figure.
+            on_preview = (lambda preview_figure: message_placeholder.plotly_chart(preview_figure, use_container_width=True)) if pipeline_client.speculative_figure else None
+            figure_flow_answer = asyncio.run(pipeline_client.run_figure(prompt, full_response, on_preview))
+            full_response = figure_flow_answer["full_response"]
+            figure_answer = figure_flow_answer["figure_answer"]
+            plotly_figure = figure_flow_answer["plotly_figure"]
 
             # Update placeholder with plotly chart
-            message_placeholder.plotly_chart(plotly_figure, use_container_width=True)
+            with st.session_state['trace_client'].span("render_figure"):
+                message_placeholder.plotly_chart(plotly_figure, use_container_width=True)
 
     except Exception as e:
-        print(e)
-        full_response = "Je suis désolé, je n'arrive pas à répondre à votre question. Pourriez-vous essayer de reformuler ?"
+        if isinstance(e, LLMUnavailableError):
+            # Reformulating won't help : the LLM is throttled or unavailable.
+            full_response = "Le service est momentanément surchargé. Pourriez-vous réessayer dans quelques instants ?"
+        else:
+            full_response = "Je suis désolé, je n'arrive pas à répondre à votre question. Pourriez-vous essayer de reformuler ?"
         message_placeholder.markdown(full_response)
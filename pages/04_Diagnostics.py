@@ -0,0 +1,64 @@
+"""
+Streamlit interface for the page displaying the time spent in each stage of the requests.
+"""
+
+import pandas as pd
+import streamlit as st
+
+from helper.interface_client import InterfaceClient
+from helper.resilience_client import ResilienceClient
+from helper.resource_client import get_shared_resource
+from helper.trace_client import TraceClient
+
+
+if 'interface_client' not in st.session_state:
+    st.session_state['interface_client'] = InterfaceClient()
+
+# The spans of every session are kept in the same trace client.
+if 'trace_client' not in st.session_state:
+    st.session_state['trace_client'] = get_shared_resource("trace_client", TraceClient)
+
+st.session_state['interface_client'].configure_page()
+st.title("Diagnostics")
+
+st.session_state['interface_client'].create_sidebar(
+    header_text = "Temps passé dans chaque étape des requêtes",
+    paragraph_text = "Les étapes des dernières requêtes (appels au LLM, lecture des réponses, requêtes SQL, tables et figures) sont chronométrées.")
+
+trace_client = st.session_state['trace_client']
+
+# The next requests of this session are profiled, the profiles are written in the profile folder.
+st.session_state['profile_requests'] = st.toggle("Profiler mes prochaines requêtes", value=st.session_state.get('profile_requests', False))
+
+stage_statistics = trace_client.get_stage_statistics()
+if not stage_statistics:
+    st.markdown("Aucune requête n'a encore été tracée.")
+else:
+    st.subheader("Durée par étape")
+    st.dataframe(pd.DataFrame(stage_statistics), hide_index=True, use_container_width=True)
+
+    st.subheader("Dernières requêtes")
+    spans = trace_client.get_spans()
+    requests = [span for span in spans if span["parent_span_id"] is None][-20:]
+    for request in reversed(requests):
+        request_spans = [span for span in spans if span["trace_id"] == request["trace_id"] and span is not request]
+        with st.expander(f"{request['name']} : {request['duration_seconds']:.2f} s ({request['status']})"):
+            st.dataframe(pd.DataFrame([{
+                "stage": span["name"],
+                "seconds": span["duration_seconds"],
+                "status": span["status"],
+                **span["attributes"],
+            } for span in sorted(request_spans, key=lambda span: span["start_time_unix_nano"])]), hide_index=True, use_container_width=True)
+            if "profile.file" in request["attributes"]:
+                st.markdown(f"Profil : `{request['attributes']['profile.file']}`")
+
+# Retries, fallbacks and circuits of the calls to the LLM, shared by every session.
+resilience_statistics = get_shared_resource("resilience_client", ResilienceClient).get_statistics()
+st.subheader("Appels au LLM")
+st.dataframe(pd.DataFrame([{key: value for key, value in resilience_statistics.items() if key != "circuits"}]), hide_index=True, use_container_width=True)
+for deployment, state in resilience_statistics["circuits"].items():
+    st.markdown(f"Déploiement `{deployment}` : circuit {'fermé' if state == 'closed' else 'ouvert' if state == 'open' else 'en test'}")
+
+if st.button("Effacer les mesures"):
+    trace_client.clear()
+    st.rerun()
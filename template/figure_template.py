@@ -21,3 +21,15 @@ class FigureInstruction(BaseModel):
     """
     reasoning: str = Field(description="Le raisonnement complet du chatbot pour répondre à la demande utilisateur et le but de chacune des opérations proposées.'.")
     sql: str = Field(description="Une requête SQLlite qui permet d'obtenir l'information nécessaire pour répondre à la demande utilisateur. Tu utilises SQLlite. Les opérations doivent être que des opérations SQLlite.")
+
+class FigureAnswer(BaseModel):
+    """
+    A class to define the template to generate in a single answer the SQL command retrieving the data of a figure and the figure to plot.
+    """
+    reasoning: str = Field(description="Le raisonnement complet du chatbot pour répondre à la demande utilisateur, le but de la requête et le choix de la figure et de ses colonnes.")
+    sql: str = Field(description="Une requête SQLlite qui permet d'obtenir l'information nécessaire pour répondre à la demande utilisateur. Tu utilises SQLlite. Les opérations doivent être que des opérations SQLlite.")
+    figure_type: str = Field(description="Le type de figure que le chatbot doit afficher. Les choix possibles sont scatter, line, bar et pie.")
+    title: str = Field(description="Le titre de la figure.")
+    x_label: str = Field(description="Le nom de la colonne du résultat de la requête correspondant à l'axe des abscisses. Il est important que tu utilises un nom de colonne du résultat de la requête.")
+    y_label: str = Field(description="Le nom de la colonne du résultat de la requête correspondant à l'axe des ordonnées. Il est important que tu utilises un nom de colonne du résultat de la requête.")
+    color: str = Field(description="La colonne du résultat de la requête qui permet de colorer les points de la figure.")